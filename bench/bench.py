@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# Runs the mkimage stages of bench/fixture against generated packages and a
+# plain image file, no root, loop devices or mirror needed.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import prettytable
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__)) + "/"
+sys.path.insert(0, os.path.dirname(BENCH_DIR.rstrip("/")))
+import mkimage  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the mkimage pipeline with fake backends.",
+    epilog="Arguments after -- are passed to mkimage, e.g. -- --codecs xz,zstd",
+)
+parser.add_argument(
+    "-w",
+    "--work_dir",
+    help="Directory to build in, generated packages are kept there",
+    default="/tmp/mkimage-bench",
+)
+parser.add_argument(
+    "--scale",
+    help="Multiplies the number and size of the generated files",
+    type=float,
+    default=1.0,
+)
+parser.add_argument("--seed", help="Seed for the generated rootfs", type=int, default=1)
+parser.add_argument(
+    "--baseline",
+    help="Stored results to compare with",
+    default=BENCH_DIR + "baseline.json",
+)
+parser.add_argument(
+    "--save",
+    help="Store the results as the new baseline",
+    action="store_true",
+)
+parser.add_argument(
+    "--threshold",
+    help="Percent a stage may be slower than the baseline before it counts",
+    type=float,
+    default=15.0,
+)
+parser.add_argument("mkimage_args", nargs=argparse.REMAINDER)
+
+# Package name: (small files, medium files, large files, hardlinks, symlinks)
+# at scale 1, sizes are picked per file kind below
+PACKAGES = {
+    "filesystem": (40, 0, 0, 0, 8),
+    "bench-bin": (600, 40, 1, 300, 200),
+    "bench-libs": (1500, 400, 2, 0, 800),
+    "bench-docs": (18000, 20, 0, 50, 100),
+    "bench-firmware": (200, 100, 3, 0, 20),
+    "bench-kernel": (1000, 30, 1, 0, 0),
+}
+SMALL = (200, 8192)
+MEDIUM = (64 * 1024, 2 * 1024**2)
+LARGE = (16 * 1024**2, 48 * 1024**2)
+# Stages that walk the whole rootfs, they get a files/s figure
+TREE_STAGES = ["pacstrap_packages", "copyfiles", "fixperms", "unmount"]
+
+
+def file_data(rng: random.Random, size: int) -> bytes:
+    # Half random, half repeated text, so the codecs have something to do
+    words = b"bredos arm image builder bench " * (size // 62 + 1)
+    return rng.randbytes(size // 2) + words[: size - size // 2]
+
+
+def make_package(name: str, root: str, rng: random.Random, scale: float) -> None:
+    small, medium, large, hardlinks, symlinks = [
+        int(i * scale + 0.5) for i in PACKAGES[name]
+    ]
+    files = []
+    prefix = {
+        "bench-bin": "usr/bin/",
+        "bench-libs": "usr/lib/",
+        "bench-docs": "usr/share/doc/",
+        "bench-firmware": "usr/lib/firmware/",
+        "bench-kernel": "usr/lib/modules/6.1.0-bench/",
+    }.get(name, "usr/share/")
+    for kind, count, sizes in [
+        ("s", small, SMALL),
+        ("m", medium, MEDIUM),
+        ("l", large, LARGE),
+    ]:
+        for i in range(count):
+            # A few hundred files per directory, like a real /usr
+            path = prefix + name + "-" + str(i // 300) + "/" + kind + str(i)
+            os.makedirs(root + os.path.dirname(path), exist_ok=True)
+            with open(root + path, "wb") as f:
+                f.write(file_data(rng, rng.randint(*sizes)))
+            files.append(path)
+    for i in range(hardlinks if files else 0):
+        target = root + files[i % len(files)]
+        os.link(target, target + ".h" + str(i))
+    for i in range(symlinks if files else 0):
+        target = files[rng.randrange(len(files))]
+        os.symlink(os.path.basename(target), root + target + ".l" + str(i))
+    if name == "filesystem":
+        make_filesystem(root)
+    if name == "bench-kernel":
+        os.makedirs(root + "boot/dtbs")
+        with open(root + "boot/Image", "wb") as f:
+            f.write(file_data(rng, 32 * 1024**2))
+        with open(root + "boot/dtbs/bench.dtb", "wb") as f:
+            f.write(file_data(rng, 64 * 1024))
+
+
+def make_filesystem(root: str) -> None:
+    # The build user owns everything, so fixperms can chown without root
+    uid, gid = str(os.getuid()), str(os.getgid())
+    for i in ["etc", "home/bench", "usr/bin", "usr/lib", "var/log", "boot"]:
+        os.makedirs(root + i, exist_ok=True)
+    with open(root + "etc/passwd", "w") as f:
+        f.write("root:x:" + uid + ":" + gid + "::/root:/bin/bash\n")
+        f.write("bench:x:" + uid + ":" + gid + "::/home/bench:/bin/bash\n")
+    with open(root + "etc/group", "w") as f:
+        f.write("root:x:" + gid + ":\nbench:x:" + gid + ":\n")
+    with open(root + "etc/shadow", "w") as f:
+        f.write("root:!*::::::\nbench:!*::::::\n")
+    open(root + "etc/fstab", "w").close()
+    os.symlink("usr/bin", root + "bin")
+    os.symlink("usr/lib", root + "lib")
+
+
+def make_packages(pkg_dir: str, scale: float, seed: int) -> None:
+    # Generated once per scale and seed, then reused by later runs
+    if os.path.isfile(pkg_dir + "done"):
+        return
+    logging.info("Generating packages in " + pkg_dir)
+    shutil.rmtree(pkg_dir, ignore_errors=True)
+    os.makedirs(pkg_dir)
+    for name in PACKAGES:
+        rng = random.Random(str(seed) + name)
+        root = pkg_dir + name + "/"
+        os.makedirs(root)
+        make_package(name, root, rng, scale)
+        subprocess.run(
+            ["tar", "--zstd", "-cf", pkg_dir + name + ".pkg.tar.zst", "-C", root, "."],
+            check=True,
+        )
+        shutil.rmtree(root)
+    with open(pkg_dir + "u-boot.bin", "wb") as f:
+        f.write(file_data(random.Random(seed), 1024**2))
+    open(pkg_dir + "done", "w").close()
+
+
+def fake_pacstrap(pkg_dir: str):
+    def pacstrap_packages(pacman_conf, packages_file, install_dir) -> None:
+        # Stands in for pacstrap, extracts the packages like pacman would
+        os.makedirs(install_dir, exist_ok=True)
+        for name in mkimage.read_packages(packages_file):
+            pkg = pkg_dir + name + ".pkg.tar.zst"
+            subprocess.run(
+                ["tar", "--zstd", "-xpf", pkg, "-C", install_dir], check=True
+            )
+            mkimage.stage_bytes(bytes_in=os.path.getsize(pkg))
+        logging.info("Pacstrap complete")
+
+    return pacstrap_packages
+
+
+def tree_size(path: str) -> tuple:
+    files = size = 0
+    for root, dirs, names in os.walk(path):
+        files += len(dirs) + len(names)
+        for name in names:
+            st = os.lstat(os.path.join(root, name))
+            size += st.st_size
+    return files, size
+
+
+def results(files: int, size: int) -> dict:
+    # Top level stages, repeated ones are numbered
+    stages = dict()
+    for i in mkimage.build_profile["stages"]:
+        if i["parent"] is not None or i["stage"] == "verify_config":
+            continue
+        name = i["stage"]
+        n = 2
+        while name in stages:
+            name = i["stage"] + "#" + str(n)
+            n += 1
+        moved = max(i["bytes_in"], i["bytes_out"])
+        if i["stage"] in TREE_STAGES and name == i["stage"]:
+            moved = max(moved, size)
+        stages[name] = {
+            "seconds": round(i.get("duration", 0), 3),
+            "mb": round(moved / 1024**2, 1),
+        }
+        if i["stage"] in TREE_STAGES and name == i["stage"]:
+            stages[name]["files"] = files
+    return stages
+
+
+def report(stages: dict, baseline: dict) -> int:
+    # Returns the number of stages slower than the baseline allows
+    table_pretty = prettytable.PrettyTable(
+        ["Stage", "Time", "Files/s", "MB/s", "Baseline", "Change"]
+    )
+    slower = 0
+    for name, i in stages.items():
+        secs = max(i["seconds"], 0.001)
+        row = [
+            name,
+            str(round(i["seconds"], 2)) + "s",
+            str(int(i["files"] / secs)) if "files" in i else "",
+            str(round(i["mb"] / secs, 1)) if i["mb"] else "",
+        ]
+        old = baseline.get(name)
+        if old is None:
+            row += ["", ""]
+        else:
+            change = 100 * (i["seconds"] - old["seconds"]) / max(old["seconds"], 0.001)
+            # Sub second stages are all noise
+            late = change > args.threshold and i["seconds"] - old["seconds"] > 0.5
+            slower += late
+            change = ("+" if change >= 0 else "") + str(round(change)) + "%"
+            row += [
+                str(round(old["seconds"], 2)) + "s",
+                change + (" SLOWER" if late else ""),
+            ]
+        table_pretty.add_row(row)
+    logging.info("\n" + table_pretty.get_string(title="Bench results"))
+    return slower
+
+
+def bench() -> int:
+    work_dir = os.path.abspath(args.work_dir) + "/"
+    pkg_dir = work_dir + "pkgs-" + str(args.scale) + "-" + str(args.seed) + "/"
+    config_dir = work_dir + "config/"
+    build_dir = work_dir + "build/"
+    out_dir = work_dir + "out/"
+    make_packages(pkg_dir, args.scale, args.seed)
+    for i in [config_dir, build_dir, out_dir]:
+        shutil.rmtree(i, ignore_errors=True)
+    shutil.copytree(BENCH_DIR + "fixture", config_dir)
+    shutil.copy(pkg_dir + "u-boot.bin", config_dir)
+
+    argv = ["-c", config_dir, "-w", build_dir, "-o", out_dir]
+    argv += ["--placement", "work", "--auto-size", "--no-cache"]
+    builder = mkimage.Builder.from_argv(
+        argv + [i for i in args.mkimage_args if i != "--"]
+    )
+    mkimage.pacstrap_packages = mkimage.stage(fake_pacstrap(pkg_dir))
+    start_time = time.time()
+    if builder.run():
+        logging.error("Build failed, see above")
+        return 1
+    files, size = tree_size(mkimage.cfg["install_dir"])
+    stages = results(files, size)
+    stages["total"] = {"seconds": round(time.time() - start_time, 3), "mb": 0}
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored["scale"] == args.scale and stored["seed"] == args.seed:
+            baseline = stored["stages"]
+        else:
+            logging.warning("Baseline is for another --scale or --seed, not comparing")
+    slower = report(stages, baseline)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "scale": args.scale,
+                    "seed": args.seed,
+                    "host": platform.node(),
+                    "cpus": os.cpu_count(),
+                    "date": time.strftime("%Y-%m-%d"),
+                    "mkimage_args": args.mkimage_args,
+                    "stages": stages,
+                },
+                f,
+                indent=1,
+            )
+        logging.info("Saved baseline to " + args.baseline)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
+    exit(bench())
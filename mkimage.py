@@ -1,18 +1,41 @@
 #! /usr/bin/python
 
 import argparse
+import ast
+import contextlib
+import fcntl
+import functools
+import glob
+import hashlib
+import importlib.machinery
+import importlib.util
+import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import re
+import shutil
+import stat
+import struct
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 from signal import SIGTERM, signal, SIGINT
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import datetime
+import errno
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
 import prettytable
 
 parser = argparse.ArgumentParser(description="Create archlinux arm based images.")
-parser.add_argument("-w", "--work_dir", help="Directory to work in", required=True)
+parser.add_argument("-w", "--work_dir", help="Directory to work in")
 parser.add_argument(
     "-x", "--no-compress", help="Do not compress into a .xz", action="store_true"
 )
@@ -20,13 +43,263 @@ parser.add_argument(
     "-ff", "--fast-forward", help="Compress very briefly .xz", action="store_true"
 )
 parser.add_argument(
-    "-c", "--config_dir", help="Folder with config files", required=True
+    "-c",
+    "--config_dir",
+    help="Folder with config files, repeat to build several boards",
+    action="append",
 )
-parser.add_argument("-o", "--out_dir", help="Folder to put output files", required=True)
+parser.add_argument("-o", "--out_dir", help="Folder to put output files")
 parser.add_argument(
     "--ci", help="Required for building in GH Actions", action="store_true"
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--cache_dir",
+    help="Folder for caches shared between builds",
+    default="/var/cache/mkimage",
+)
+parser.add_argument(
+    "--no-cache", help="Always pacstrap, ignore the rootfs cache", action="store_true"
+)
+parser.add_argument(
+    "--cache-max-age",
+    help="Evict cached rootfs snapshots older than this many days",
+    type=int,
+    default=14,
+)
+parser.add_argument(
+    "--cache-max-size",
+    help="Maximum size of the rootfs cache in GiB",
+    type=int,
+    default=40,
+)
+parser.add_argument(
+    "--fetch-jobs",
+    help="Number of parallel package downloads",
+    type=int,
+    default=8,
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    help="Number of boards to finish in parallel when building several configs",
+    type=int,
+    default=4,
+)
+parser.add_argument(
+    "--codecs",
+    help="Comma separated output codecs: xz, zstd",
+    default="xz",
+)
+parser.add_argument("--xz-level", help="xz compression level", type=int, default=5)
+parser.add_argument("--zstd-level", help="zstd compression level", type=int, default=3)
+parser.add_argument(
+    "--checksums",
+    help="Comma separated checksums to write next to the output: "
+    + "md5, sha1, sha256, sha512, blake2b",
+    default="sha256",
+)
+parser.add_argument(
+    "--auto-size",
+    help="Size the image from the populated rootfs instead of the profiledef",
+    action="store_true",
+)
+parser.add_argument(
+    "--shrink",
+    help="Shrink the root filesystem, partition and image file after the build",
+    action="store_true",
+)
+parser.add_argument(
+    "--headroom",
+    help="Free space in MiB to leave in the root filesystem when sizing or shrinking",
+    type=int,
+    default=256,
+)
+parser.add_argument(
+    "--no-bmap", help="Do not write a bmaptool block map", action="store_true"
+)
+parser.add_argument(
+    "--no-hashes",
+    help="Do not write the per chunk hash manifest used by --verify",
+    action="store_true",
+)
+parser.add_argument(
+    "--hash-jobs",
+    help="Number of threads hashing chunks for the manifest and --verify",
+    type=int,
+    default=os.cpu_count() or 1,
+)
+parser.add_argument(
+    "--copy-jobs",
+    help="Number of parallel file copies",
+    type=int,
+    default=min(32, (os.cpu_count() or 1) * 2),
+)
+parser.add_argument(
+    "--max-pacstrap",
+    help="Host wide limit of builds running pacstrap at once, 0 for no limit",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--max-compress",
+    help="Host wide limit of builds compressing at once, 0 for no limit",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--trace",
+    help="Also write a Chrome trace-event file of the build",
+    action="store_true",
+)
+parser.add_argument(
+    "--sample-interval",
+    help="Sample CPU, memory, disk and network use every SECONDS during the "
+    "build and classify what each stage was bound by",
+    type=float,
+    metavar="SECONDS",
+)
+parser.add_argument(
+    "--resume",
+    help="Skip the stages whose checkpoint in the work dir is still valid",
+    action="store_true",
+)
+parser.add_argument(
+    "--perms-dry-run",
+    help="Only print the ownership and mode changes fixperms would make",
+    action="store_true",
+)
+parser.add_argument(
+    "--placement",
+    help="auto: rootfs in tmpfs when it fits in RAM and the image on disk, "
+    "work: everything in the work dir",
+    choices=["auto", "work"],
+    default="auto",
+)
+parser.add_argument(
+    "--spill-dir",
+    help="Disk folder for what does not fit in RAM when the work dir is a tmpfs",
+    default="/var/tmp/mkimage",
+)
+parser.add_argument(
+    "--step-jobs",
+    help="Number of build steps that may run at once",
+    type=int,
+    default=4,
+)
+parser.add_argument(
+    "--step-graph",
+    help="Run the statements of mkcmds as a step graph instead of in order",
+    action="store_true",
+)
+parser.add_argument(
+    "--btrfs-send",
+    help="btrfs images: pacstrap into a subvolume of the btrfs work dir and "
+    "receive it into the image as @ instead of copying file by file",
+    action="store_true",
+)
+parser.add_argument(
+    "--btrfs-parent",
+    help="With --btrfs-send, also write the changes since this snapshot "
+    "(a path or a name in <work_dir>/snapshots) as <img_name>.btrfs-delta",
+    metavar="SNAPSHOT",
+)
+parser.add_argument(
+    "--btrfs-keep",
+    help="With --btrfs-send, read-only snapshots of the image and of the rootfs "
+    "cache kept in <work_dir>/snapshots, older ones are deleted",
+    type=int,
+    default=3,
+)
+parser.add_argument(
+    "--variant-of",
+    help="Clone this finished raw image instead of building the rootfs and only "
+    "redo the bootloader writes, overlay, boot configs and output",
+    metavar="IMG",
+)
+parser.add_argument(
+    "--rootfs-from",
+    help="Copy this pacstrapped rootfs instead of running pacstrap, matrix "
+    "builds pass the one their rootfs group shares",
+    metavar="DIR",
+)
+parser.add_argument(
+    "--variants",
+    help="Matrix builds: build one board per rootfs group, the others as "
+    "--variant-of its image",
+    action="store_true",
+)
+parser.add_argument(
+    "--overlap",
+    help="Create, partition and format the image while pacstrap runs, "
+    "--auto-size then sizes it from the package estimate",
+    action="store_true",
+)
+parser.add_argument(
+    "--chunk-store",
+    help="Also cut the raw image into content-defined chunks in this store, "
+    "for --reassemble a directory or an http(s) URL",
+)
+parser.add_argument(
+    "--reassemble",
+    help="Rebuild the image of a .chunks.json index into -o and exit",
+    metavar="INDEX",
+)
+parser.add_argument(
+    "--verify",
+    help="Check an image or flashed device against a .hashes.json manifest and exit",
+    metavar="MANIFEST",
+)
+parser.add_argument(
+    "--verify-target",
+    help="Image file or block device to --verify, "
+    "defaults to the image next to the manifest",
+)
+parser.add_argument(
+    "--seed",
+    help="Older image to take chunks from with --reassemble, can be repeated",
+    action="append",
+)
+parser.add_argument(
+    "--check-layout",
+    help="Check the partition layout of the config on an image of this size "
+    "(e.g. 8GiB) and exit, does not need root",
+    metavar="SIZE",
+)
+parser.add_argument(
+    "--db-max-age",
+    help="Reuse synced package databases younger than this many seconds, "
+    "--serve jobs default to an hour",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--serve",
+    help="Run as a build service taking jobs from this spool directory",
+    metavar="SPOOL",
+)
+parser.add_argument(
+    "--submit",
+    help="Queue a build with the other arguments in a --serve spool and exit",
+    metavar="SPOOL",
+)
+parser.add_argument(
+    "--status-file",
+    help="Keep the current stage of the build in this JSON file",
+)
+parser.add_argument(
+    "--loop-pool",
+    help="Loop devices --serve keeps created for its jobs",
+    type=int,
+    default=16,
+)
+# Importing mkimage as a library must not read the importer's command line
+args = parser.parse_args(None if __name__ == "__main__" else [])
+if __name__ != "__main__" or args.reassemble or args.serve or args.verify:
+    pass
+elif args.config_dir is None:
+    parser.error("the following arguments are required: -c/--config_dir")
+elif not args.check_layout and (args.work_dir is None or args.out_dir is None):
+    parser.error("the following arguments are required: -w/--work_dir, -o/--out_dir")
 
 
 # Convert relative path to absolute path
@@ -34,54 +307,678 @@ def abspath(path):
     return os.path.abspath(path)
 
 
-work_dir = abspath(args.work_dir) + "/"
-config_dir = abspath(args.config_dir) + "/"
-out_dir = abspath(args.out_dir) + "/"
-mnt_dir = work_dir + "mnt/"
-if os.geteuid() != 0:
-    exit("Error: Run this script as root")
+def build_paths(args) -> dict:
+    # Directories of a build, Builder.run() puts them at module level
+    work_dir = abspath(args.work_dir or ".") + "/"
+    config_dirs = [abspath(i) + "/" for i in args.config_dir or ["."]]
+    return {
+        "work_dir": work_dir,
+        "config_dirs": config_dirs,
+        "config_dir": config_dirs[0],
+        "out_dir": abspath(args.out_dir or ".") + "/",
+        "cache_dir": abspath(args.cache_dir) + "/",
+        "mnt_dir": work_dir + "mnt/",
+    }
+
+
+paths = build_paths(args)
+work_dir = paths["work_dir"]
+config_dirs = paths["config_dirs"]
+config_dir = paths["config_dir"]
+out_dir = paths["out_dir"]
+cache_dir = paths["cache_dir"]
+mnt_dir = paths["mnt_dir"]
+# Builder imports mkimage to run builds, root is only needed for loop devices
+if __name__ == "__main__" and os.geteuid() != 0:
+    if not (args.check_layout or args.reassemble or args.submit or args.verify):
+        exit("Error: Run this script as root")
 LOGGING_FORMAT: str = "%(asctime)s [%(levelname)s] %(message)s (%(funcName)s)"
 LOGGING_DATE_FORMAT: str = "%H:%M:%S"
+HOST_LOCK_DIR: str = "/run/lock/mkimage/"
 
+# Settings of the running build, filled by verify_config()
+cfg = dict()
+# Timings of every stage and subprocess, written next to mkimage.log
+build_profile = {"stages": [], "procs": []}
+stage_local = threading.local()
+status_lock = threading.Lock()
+# Held by the Builder whose build owns the module level state
+running_lock = threading.Lock()
 
-def verify_config():
-    cfg = dict()
-    if not os.path.exists(config_dir):
-        logging.error("Config directory " + config_dir + " does not exist")
-        exit(1)
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-    cfg["out_dir"] = out_dir
-    if not os.path.exists(work_dir):
-        os.mkdir(work_dir)
-    sys.path.insert(0, work_dir)
-    subprocess.run(["cp", config_dir + "/profiledef", work_dir + "/profiledef.py"])
 
-    import profiledef  # type: ignore
+def current_stage():
+    stack = getattr(stage_local, "stack", [])
+    return stack[-1] if stack else None
 
-    cfg["arch"] = profiledef.arch
-    try:
-        cfg["cmdline"] = profiledef.cmdline
-    except AttributeError:
-        cfg["cmdline"] = None
-    cfg["configtxt"] = profiledef.configtxt
-    try:
-        cfg["configtxt_suffix"] = profiledef.configtxt_suffix
-    except AttributeError:
-        cfg["configtxt_suffix"] = None
-    cfg["edition"] = profiledef.edition
-    cfg["fs"] = profiledef.fs
-    cfg["img_backend"] = profiledef.img_backend
-    cfg["img_name"] = profiledef.img_name
-    cfg["img_type"] = profiledef.img_type
-    cfg["img_version"] = profiledef.img_version
-    cfg["perms"] = profiledef.perms
-    cfg["mkcmds"] = profiledef.mkcmds
-    try:
-        cfg["grubcmdl"] = profiledef.grubcmdl
-        cfg["grubdtb"] = profiledef.grubdtb
-    except AttributeError:
-        pass
+
+def stage(func):
+    @functools.wraps(func)
+    def wrapper(*fargs, **fkwargs):
+        parent = current_stage()
+        checkpointed = (
+            parent is None
+            and func.__name__ != "verify_config"
+            and checkpoints["enabled"]
+        )
+        if checkpointed:
+            skip, result = checkpoint_skip(func.__name__, fargs)
+            if skip:
+                return result
+        entry = {
+            "stage": func.__name__,
+            "parent": parent["stage"] if parent else None,
+            "start": time.time(),
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        build_profile["stages"].append(entry)
+        stage_local.stack = getattr(stage_local, "stack", []) + [entry]
+        if parent is None:
+            write_status()
+        try:
+            result = func(*fargs, **fkwargs)
+            if checkpointed:
+                checkpoint_done(func.__name__, result)
+            return result
+        except BaseException as e:
+            entry["error"] = repr(e)
+            raise
+        finally:
+            stage_local.stack = stage_local.stack[:-1]
+            entry["end"] = time.time()
+            entry["duration"] = entry["end"] - entry["start"]
+            if parent is None:
+                write_status()
+
+    return wrapper
+
+
+def write_status() -> None:
+    # Top level stages so far, --serve reports them for its jobs
+    if not args.status_file:
+        return
+    stages = [i for i in build_profile["stages"] if i["parent"] is None]
+    status = {
+        "pid": os.getpid(),
+        "updated": time.time(),
+        "stage": [i["stage"] for i in stages if "end" not in i],
+        "done": [i["stage"] for i in stages if "end" in i and "error" not in i],
+        "failed": [i["stage"] for i in stages if "error" in i],
+    }
+    # Overlapping stages finish from their own threads
+    with status_lock:
+        with open(args.status_file + ".tmp", "w") as f:
+            json.dump(status, f)
+        os.replace(args.status_file + ".tmp", args.status_file)
+
+
+def stage_bytes(bytes_in=0, bytes_out=0) -> None:
+    entry = current_stage()
+    if entry is not None:
+        entry["bytes_in"] += bytes_in
+        entry["bytes_out"] += bytes_out
+
+
+class TimedPopen(subprocess.Popen):
+    # Installed as subprocess.Popen so run(), check_output() and the
+    # commands in mkcmds are all timed
+    def __init__(self, cmd, *args, **kwargs):
+        entry = current_stage()
+        self.profile_entry = {
+            "cmd": cmd if isinstance(cmd, str) else " ".join(map(str, cmd)),
+            "stage": entry["stage"] if entry else None,
+            "start": time.time(),
+        }
+        super().__init__(cmd, *args, **kwargs)
+        build_profile["procs"].append(self.profile_entry)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if "end" not in self.profile_entry:
+            self.profile_entry["end"] = time.time()
+            self.profile_entry["duration"] = (
+                self.profile_entry["end"] - self.profile_entry["start"]
+            )
+            self.profile_entry["exit"] = returncode
+        return returncode
+
+
+def trace_events() -> list:
+    # Chrome trace-event format, subprocesses get lanes so they never overlap
+    events = []
+    lanes = []
+    for i in build_profile["stages"]:
+        events.append(
+            {
+                "name": i["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": int(i["start"] * 1e6),
+                "dur": int(i.get("duration", 0) * 1e6),
+                "pid": 1,
+                "tid": 0,
+                "args": {"bytes_in": i["bytes_in"], "bytes_out": i["bytes_out"]},
+            }
+        )
+    for i in sorted(build_profile["procs"], key=lambda i: i["start"]):
+        end = i.get("end", i["start"])
+        for lane, lane_end in enumerate(lanes):
+            if lane_end <= i["start"]:
+                lanes[lane] = end
+                break
+        else:
+            lanes.append(end)
+            lane = len(lanes) - 1
+        events.append(
+            {
+                "name": i["cmd"].split(" ")[0],
+                "cat": "proc",
+                "ph": "X",
+                "ts": int(i["start"] * 1e6),
+                "dur": int(i.get("duration", 0) * 1e6),
+                "pid": 1,
+                "tid": lane + 1,
+                "args": {"cmd": i["cmd"], "exit": i.get("exit")},
+            }
+        )
+    return events
+
+
+# Stages completed in the work dir, each with a fingerprint of its inputs
+# chained to the one before it, so a change re-runs everything after it
+checkpoints = {"done": [], "pos": 0, "resuming": False, "fp": "", "devmap": {}}
+checkpoints["attached"] = []
+checkpoints["enabled"] = True
+
+
+def load_checkpoints() -> None:
+    checkpoints.update(done=[], pos=0, resuming=False, fp="", devmap={})
+    checkpoints.update(attached=[], enabled=True)
+    path = work_dir + "checkpoints.json"
+    if args.resume and os.path.isfile(path):
+        with open(path) as f:
+            checkpoints["done"] = json.load(f)
+        checkpoints["resuming"] = bool(checkpoints["done"])
+    if not checkpoints["resuming"]:
+        save_checkpoints()
+
+
+def save_checkpoints() -> None:
+    with open(work_dir + "checkpoints.json", "w") as f:
+        json.dump(checkpoints["done"], f, indent=1)
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def tree_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.lstat(os.path.join(root, name))
+            digest.update(
+                repr(
+                    [os.path.join(root, name), st.st_size, st.st_mtime_ns, st.st_mode]
+                ).encode("utf-8")
+            )
+    return digest.hexdigest()
+
+
+def config_files_digest() -> str:
+    # Blobs next to the profiledef, like idbloader.img and u-boot.itb
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(config_dir)):
+        if os.path.isfile(config_dir + name) and not name.startswith(
+            ("profiledef", "packages.", "pacman.conf.", "mkimage")
+        ):
+            digest.update((name + file_digest(config_dir + name)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def hook_commands(disk: str) -> str:
+    # What partition_prefix/suffix write, a new u-boot offset or file
+    # in the profiledef has to redo the partitioning
+    commands = [
+        cfg[i](config_dir, disk) for i in ["partition_prefix", "partition_suffix"]
+    ]
+    return re.sub(r"/dev/(mapper/)?loop\d+", "/dev/loop", repr(commands))
+
+
+def stage_inputs(name: str, fargs: tuple) -> str:
+    # Loop devices change between runs, the rest of the arguments count
+    inputs = [
+        re.sub(r"^/dev/(mapper/)?loop\d+", "/dev/loop", i) if isinstance(i, str) else i
+        for i in fargs
+    ]
+    if name == "pacstrap_packages":
+        inputs += [file_digest(fargs[0]), file_digest(fargs[1])]
+    elif name == "copyfiles" and abspath(fargs[0]).startswith(config_dir):
+        inputs.append(tree_digest(fargs[0]))
+    elif name == "fixperms":
+        inputs.append(cfg["perms"])
+    elif name == "makeimg":
+        inputs += [args.auto_size, args.headroom, args.overlap]
+    elif name == "clone_image" and os.path.isfile(fargs[0]):
+        # A rebuilt base makes the clone stale
+        st = os.stat(fargs[0])
+        inputs += [st.st_size, st.st_mtime_ns]
+    elif name in ["partition", "variant_partition"]:
+        inputs += [
+            cfg[i]
+            for i in [
+                "part_type",
+                "boot_set_esp",
+                "uboot_parts",
+                "recreate_part_table",
+                "partitioner",
+            ]
+        ]
+        inputs += [config_files_digest(), hook_commands(fargs[0])]
+    elif name == "copy_skel_to_users":
+        inputs.append(cfg["img_version"])
+    elif name == "create_extlinux_conf":
+        inputs.append(cfg["configtxt_suffix"])
+    elif name == "grub_install":
+        inputs += [cfg.get("grubcmdl"), cfg.get("grubdtb")]
+    elif name == "unmount":
+        inputs += [args.shrink, args.headroom]
+    elif name in ["compressimage", "copyimage"]:
+        inputs += [
+            args.codecs,
+            args.xz_level,
+            args.zstd_level,
+            args.fast_forward,
+            args.checksums,
+            args.no_bmap,
+            args.no_hashes,
+            args.chunk_store,
+        ]
+    return repr(inputs)
+
+
+# Stages returning (img_size, ldev) of an image a resume has to reattach
+IMAGE_STAGES = ["makeimg", "clone_image"]
+
+
+def checkpoint_skip(name: str, fargs: tuple) -> tuple:
+    fp = hashlib.sha256(
+        (checkpoints["fp"] + name + stage_inputs(name, fargs)).encode("utf-8")
+    ).hexdigest()
+    checkpoints["fp"] = fp
+    done = checkpoints["done"]
+    pos = checkpoints["pos"]
+    if checkpoints["resuming"] and pos < len(done):
+        record = done[pos]
+        valid = record["stage"] == name and record["fp"] == fp
+        # A runonce block only finished if a later stage was recorded
+        if name.startswith("runonce_") and pos + 1 >= len(done):
+            valid = False
+        if name == "pacstrap_packages" and not os.listdir(fargs[2]):
+            valid = False
+        if name in IMAGE_STAGES and not os.path.isfile(record["result"][1]):
+            valid = False
+        if valid:
+            checkpoints["pos"] += 1
+            logging.info("Resume: " + name + " is up to date, skipping")
+            if name in IMAGE_STAGES:
+                return True, reattach_image(record)
+            return True, None
+    if checkpoints["resuming"]:
+        logging.info("Resume: continuing from " + name)
+        checkpoints["resuming"] = False
+        if pos:
+            restore_checkpoint(done[pos - 1])
+        del done[pos:]
+        save_checkpoints()
+    return False, None
+
+
+def checkpoint_done(name: str, result) -> None:
+    if name in IMAGE_STAGES:
+        result = [result[0], cfg["images"][result[1]]]
+    checkpoints["done"].append(
+        {
+            "stage": name,
+            "fp": checkpoints["fp"],
+            "result": result,
+            "root_part": cfg.get("root_part"),
+            "images": dict(cfg.get("images", dict())),
+            "fs_table": dict(fs_table),
+            "mounts": mounts_under(mnt_dir),
+        }
+    )
+    checkpoints["pos"] = len(checkpoints["done"])
+    save_checkpoints()
+
+
+def mounts_under(path: str) -> list:
+    mounts = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f.readlines():
+            fields = line.split()
+            sep = fields.index("-")
+            target = fields[4]
+            if target == path.rstrip("/") or target.startswith(path):
+                mounts.append(
+                    [fields[sep + 2], target, fields[sep + 1], fields[sep + 3]]
+                )
+    return mounts
+
+
+def reattach_image(record: dict) -> tuple:
+    img_size, img = record["result"]
+    if cfg["img_backend"] != "loop":
+        cfg.setdefault("images", dict())[img] = img
+        return img_size, img
+    subprocess.run(["modprobe", "loop"])
+    ldev = (
+        subprocess.check_output(["losetup", "-f", "--show", "-P", img])
+        .decode("utf-8")
+        .strip("\n")
+    )
+    logging.info("Resume: reattached " + img + " to " + ldev)
+    cfg.setdefault("images", dict())[ldev] = img
+    checkpoints["attached"].append(ldev)
+    mapper = ldev.replace("/dev/", "/dev/mapper/")
+    if args.ci:
+        subprocess.run(["ln", "-sf", ldev, mapper])
+        subprocess.run(["kpartx", "-avf", mapper])
+        cfg["images"][mapper] = img
+        checkpoints["attached"].append(mapper)
+    # Old device names of this image, as the later records know them
+    for old, old_img in record["images"].items():
+        if old_img == img:
+            checkpoints["devmap"][old] = (
+                mapper if old.startswith("/dev/mapper/") else ldev
+            )
+    return img_size, mapper if args.ci else ldev
+
+
+def translate_dev(dev: str) -> str:
+    # Map partitions of the previous loop device to the reattached one
+    for old, new in checkpoints["devmap"].items():
+        match = re.match(re.escape(old) + r"(p\d+)?$", dev)
+        if match is not None:
+            return new + (match.group(1) or "")
+    return dev
+
+
+def release_reattached() -> None:
+    # Everything after makeimg was skipped, give back what resume attached
+    left = [i for i in checkpoints["attached"] if i in cfg.get("images", dict())]
+    if not left:
+        return
+    subprocess.run(["umount", "-R", mnt_dir])
+    for dev in sorted(left, key=lambda i: not i.startswith("/dev/mapper/")):
+        if dev.startswith("/dev/mapper/"):
+            subprocess.run(["kpartx", "-d", dev])
+            subprocess.run(["unlink", dev])
+        else:
+            subprocess.run(["losetup", "-d", dev])
+        cfg["images"].pop(dev)
+
+
+def restore_checkpoint(record: dict) -> None:
+    # Bring back the state the skipped stages left behind
+    if record["root_part"] is not None:
+        cfg["root_part"] = translate_dev(record["root_part"])
+    for dev, entry in record["fs_table"].items():
+        fs_table[translate_dev(dev)] = entry
+    mounted = [i[1] for i in mounts_under(mnt_dir)]
+    for source, target, fstype, options in record["mounts"]:
+        if target in mounted:
+            continue
+        logging.info("Resume: mounting " + target)
+        subprocess.run(
+            ["mount", "-t", fstype, "-o", options, translate_dev(source), target],
+            check=True,
+        )
+
+
+def read_counters() -> dict:
+    # Cumulative counters, the sampler works on the difference of two reads
+    c = {"tree_cpu": 0, "tree_read": 0, "tree_write": 0, "procs": dict()}
+    with open("/proc/stat") as f:
+        cpu = [int(i) for i in f.readline().split()[1:]]
+    c["busy"] = sum(cpu[:3]) + sum(cpu[5:8])
+    c["iowait"] = cpu[4]
+    c["total"] = sum(cpu[:8])
+    with open("/proc/meminfo") as f:
+        mem = dict(line.split(":", 1) for line in f)
+    c["mem_total"] = int(mem["MemTotal"].split()[0]) * 1024
+    c["mem_avail"] = int(mem["MemAvailable"].split()[0]) * 1024
+    with open("/proc/vmstat") as f:
+        vm = dict(line.split() for line in f)
+    c["swap"] = int(vm.get("pswpin", 0)) + int(vm.get("pswpout", 0))
+    c["disk_read"] = c["disk_write"] = 0
+    c["disk_ticks"] = dict()
+    with open("/proc/diskstats") as f:
+        for line in f:
+            i = line.split()
+            # Whole disks only, loop and dm devices sit on top of them
+            if not os.path.isdir("/sys/block/" + i[2]) or re.match(
+                r"(loop|ram|zram|dm-)", i[2]
+            ):
+                continue
+            c["disk_read"] += int(i[5]) * SECTOR
+            c["disk_write"] += int(i[9]) * SECTOR
+            c["disk_ticks"][i[2]] = int(i[12])
+    c["net"] = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(":", 1)
+            if name.strip() != "lo":
+                data = data.split()
+                c["net"] += int(data[0]) + int(data[8])
+    # Every process below this one, with the reaped children they account
+    stats = dict()
+    for pid in os.listdir("/proc"):
+        try:
+            with open("/proc/" + pid + "/stat") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            continue
+        fields = data[data.rfind(")") + 2 :].split()
+        stats[pid] = (int(fields[1]), data[data.find("(") + 1 : data.rfind(")")])
+        stats[pid] += (sum(int(i) for i in fields[11:13]),)
+        stats[pid] += (sum(int(i) for i in fields[11:15]),)
+    tree = [str(os.getpid())]
+    for pid in tree:
+        tree += [i for i in stats if str(stats[i][0]) == pid]
+    for pid in tree:
+        if pid not in stats:
+            continue
+        c["tree_cpu"] += stats[pid][3]
+        c["procs"][pid] = stats[pid][1:3]
+        try:
+            with open("/proc/" + pid + "/io") as f:
+                io = dict(line.split(": ") for line in f)
+            c["tree_read"] += int(io["read_bytes"])
+            c["tree_write"] += int(io["write_bytes"])
+        except (OSError, KeyError):
+            pass
+    c["time"] = time.time()
+    return c
+
+
+SAMPLE_FIELDS = [
+    "time",
+    "stage",
+    "cpu",
+    "iowait",
+    "disk_util",
+    "disk_read",
+    "disk_write",
+    "net",
+    "mem_avail",
+    "swap",
+    "tree_cpu",
+    "tree_read",
+    "tree_write",
+    "top",
+]
+
+
+def sample(old: dict, new: dict) -> list:
+    # One row of the time series: shares in percent, rates in KiB/s
+    secs = max(new["time"] - old["time"], 0.001)
+    ticks = max(new["total"] - old["total"], 1)
+    hz = os.sysconf("SC_CLK_TCK")
+    stages = [
+        i["stage"]
+        for i in build_profile["stages"]
+        if i["parent"] is None and "end" not in i
+    ]
+    top, top_cpu = "", 0
+    for pid, (comm, cpu) in new["procs"].items():
+        # A process started since the last sample counts with all its time
+        cpu -= old["procs"].get(pid, (comm, 0))[1]
+        if cpu > top_cpu:
+            top, top_cpu = comm, cpu
+    util = [
+        new["disk_ticks"][i] - old["disk_ticks"].get(i, new["disk_ticks"][i])
+        for i in new["disk_ticks"]
+    ]
+
+    def rate(key):
+        return max(int((new[key] - old[key]) / 1024 / secs), 0)
+
+    return [
+        round(new["time"], 2),
+        "+".join(stages) or "-",
+        round(100 * (new["busy"] - old["busy"]) / ticks, 1),
+        round(100 * (new["iowait"] - old["iowait"]) / ticks, 1),
+        round(min(max(util + [0]) / 10 / secs, 100), 1),
+        rate("disk_read"),
+        rate("disk_write"),
+        rate("net"),
+        new["mem_avail"] // 1024**2,
+        rate("swap"),
+        # In cores, so a single threaded xz shows as 100
+        round(100 * max(new["tree_cpu"] - old["tree_cpu"], 0) / hz / secs, 1),
+        rate("tree_read"),
+        rate("tree_write"),
+        top + ":" + str(round(100 * top_cpu / hz / secs)) if top else "",
+    ]
+
+
+def run_sampler(stop, interval: float) -> None:
+    old = read_counters()
+    build_profile["mem_total"] = old["mem_total"]
+    with open(work_dir + "mkimage-samples.tsv", "w") as f:
+        f.write("\t".join(SAMPLE_FIELDS) + "\n")
+        while not stop.wait(interval):
+            new = read_counters()
+            row = sample(old, new)
+            build_profile["samples"].append(row)
+            f.write("\t".join(str(i) for i in row) + "\n")
+            f.flush()
+            old = new
+
+
+def start_sampler():
+    # The sampler only reads /proc, it never blocks the build
+    stop = threading.Event()
+    build_profile["samples"] = []
+    thread = threading.Thread(
+        target=run_sampler, args=(stop, args.sample_interval), daemon=True
+    )
+    thread.start()
+    return stop, thread
+
+
+def sample_avg(rows: list, field: str) -> float:
+    return sum(i[SAMPLE_FIELDS.index(field)] for i in rows) / len(rows)
+
+
+def bottleneck(rows: list) -> str:
+    # What a stage waited on most, from the averages of its samples
+    mem_low = min(i[SAMPLE_FIELDS.index("mem_avail")] for i in rows) * 1024**2
+    if sample_avg(rows, "swap") > 1024 or mem_low < build_profile["mem_total"] / 20:
+        return "memory"
+    ncpu = os.cpu_count() or 1
+    # A process pegging one core is as CPU bound as all cores being busy
+    top = [i[SAMPLE_FIELDS.index("top")] for i in rows]
+    top = sum(int(i.rsplit(":", 1)[1]) for i in top if i) / len(rows)
+    cpu = max(sample_avg(rows, "cpu"), min(top, 100))
+    io = max(sample_avg(rows, "disk_util"), sample_avg(rows, "iowait") * ncpu)
+    if max(cpu, io) < 50 and sample_avg(rows, "net") > 256:
+        return "network"
+    return "cpu" if cpu >= io else "io"
+
+
+def resource_summary() -> list:
+    rows = dict()
+    for i in build_profile["samples"]:
+        for name in i[SAMPLE_FIELDS.index("stage")].split("+"):
+            rows.setdefault(name, []).append(i)
+    summary = []
+    for name, stage_rows in rows.items():
+        mem = [i[SAMPLE_FIELDS.index("mem_avail")] for i in stage_rows]
+        summary.append(
+            {
+                "stage": name,
+                "samples": len(stage_rows),
+                "cpu": round(sample_avg(stage_rows, "cpu"), 1),
+                "disk_util": round(sample_avg(stage_rows, "disk_util"), 1),
+                "net": int(sample_avg(stage_rows, "net")),
+                "mem_avail": min(mem),
+                "bound": bottleneck(stage_rows),
+            }
+        )
+    return summary
+
+
+def write_profile(start_time: float) -> None:
+    build_profile["start"] = start_time
+    build_profile["end"] = time.time()
+    build_profile["duration"] = build_profile["end"] - start_time
+    if build_profile.get("samples"):
+        build_profile["resources"] = resource_summary()
+    with open(config_dir + "mkimage-profile.json", "w") as f:
+        json.dump(build_profile, f, indent=1)
+    if args.trace:
+        with open(config_dir + "mkimage-trace.json", "w") as f:
+            json.dump({"traceEvents": trace_events()}, f)
+    table_pretty = prettytable.PrettyTable(["Stage", "Time", "In", "Out"])
+    for i in build_profile["stages"]:
+        if i["parent"] is not None:
+            continue
+        table_pretty.add_row(
+            [
+                i["stage"] + (" (failed)" if "error" in i else ""),
+                time.strftime("%H:%M:%S", time.gmtime(i.get("duration", 0))),
+                str(int(i["bytes_in"] / 1024**2)) + "M",
+                str(int(i["bytes_out"] / 1024**2)) + "M",
+            ]
+        )
+    logging.info("\n" + table_pretty.get_string(title="Build profile"))
+    if not build_profile.get("resources"):
+        return
+    table_pretty = prettytable.PrettyTable(
+        ["Stage", "Samples", "CPU", "Disk", "Net", "Mem free", "Bound"]
+    )
+    for i in build_profile["resources"]:
+        table_pretty.add_row(
+            [
+                i["stage"],
+                i["samples"],
+                str(i["cpu"]) + "%",
+                str(i["disk_util"]) + "%",
+                str(i["net"]) + "K/s",
+                str(i["mem_avail"]) + "M",
+                i["bound"],
+            ]
+        )
+    logging.info("\n" + table_pretty.get_string(title="Resource usage"))
+
+
+def layout_config(profiledef) -> dict:
+    # Partitioning settings, shared with --check-layout
+    cfg = dict()
     try:
         cfg["part_type"] = "gpt" if profiledef.use_gpt else "msdos"
     except AttributeError:
@@ -115,125 +1012,890 @@ def verify_config():
         cfg["has_uefi"] = profiledef.has_uefi
     except AttributeError:
         cfg["has_uefi"] = False
+    try:
+        cfg["partitioner"] = profiledef.partitioner
+    except AttributeError:
+        cfg["partitioner"] = "parted"
+    return cfg
+
+
+def read_config(config_dir) -> dict:
+    # Settings of a config dir, only reads files so it needs no root
+    profiledef = load_profiledef(config_dir)
+    cfg = dict()
+    cfg["arch"] = profiledef.arch
+    try:
+        cfg["cmdline"] = profiledef.cmdline
+    except AttributeError:
+        cfg["cmdline"] = None
+    cfg["configtxt"] = profiledef.configtxt
+    try:
+        cfg["configtxt_suffix"] = profiledef.configtxt_suffix
+    except AttributeError:
+        cfg["configtxt_suffix"] = None
+    cfg["edition"] = profiledef.edition
+    cfg["fs"] = profiledef.fs
+    cfg["img_backend"] = profiledef.img_backend
+    cfg["img_name"] = profiledef.img_name
+    cfg["img_type"] = profiledef.img_type
+    cfg["img_version"] = profiledef.img_version
+    cfg["perms"] = profiledef.perms
+    try:
+        cfg["mkcmds"] = profiledef.mkcmds
+    except AttributeError:
+        cfg["mkcmds"] = None
+    try:
+        cfg["steps"] = profiledef.steps
+    except AttributeError:
+        cfg["steps"] = None
+    try:
+        cfg["grubcmdl"] = profiledef.grubcmdl
+        cfg["grubdtb"] = profiledef.grubdtb
+    except AttributeError:
+        pass
+    cfg.update(layout_config(profiledef))
     cfg["config_dir"] = config_dir
-    cfg["work_dir"] = work_dir
+    cfg["packages_file"] = config_dir + "packages." + cfg["arch"]
+    return cfg
 
-    packages_file = config_dir + "packages." + cfg["arch"]
-    cfg["packages_file"] = packages_file
 
+def config_errors(cfg) -> list:
+    errors = []
     if cfg["arch"] not in ["aarch64", "armv7h", "riscv64"]:
-        logging.error("Arch incompatible. Use aarch64, armv7h or riscv64")
-        exit(1)
+        errors.append("Arch incompatible. Use aarch64, armv7h or riscv64")
     if not cfg["img_name"]:
-        logging.error("Image name not set")
-        exit(1)
+        errors.append("Image name not set")
     if not cfg["img_version"]:
-        logging.error("Image version not set")
-        exit(1)
-
-    install_dir = work_dir + ("/" if not work_dir.endswith("/") else "") + cfg["arch"]
-    cfg["install_dir"] = install_dir
-    subprocess.run(["mkdir", "-p", install_dir])
-
+        errors.append("Image version not set")
+    if cfg["mkcmds"] is None and cfg["steps"] is None:
+        errors.append("Neither mkcmds nor steps set")
     if cfg["fs"] not in ["ext4", "btrfs"]:
-        logging.error("Filesystem not supported use ext4 or btrfs")
-        exit(1)
-    if not os.path.isfile(packages_file):
-        logging.error(
+        errors.append("Filesystem not supported use ext4 or btrfs")
+    if not os.path.isfile(cfg["packages_file"]):
+        errors.append(
             "packages file doesnt exist create the file packages." + cfg["arch"]
         )
-        exit(1)
     if cfg["img_type"] not in ["image", "rootfs"]:
-        logging.error("Image type not supported use image or rootfs ")
+        errors.append("Image type not supported use image or rootfs ")
+    if cfg["img_backend"] not in ["loop", "offline"]:
+        errors.append("Image backend not supported use loop or offline")
+    elif cfg["img_backend"] == "offline":
+        for i in ["partition_table", "partition_table_boot"]:
+            boot_type = boot_fs_type(cfg.get(i, dict()))
+            if boot_type not in OFFLINE_BOOT_TYPES + [None]:
+                errors.append(
+                    "The offline backend cannot build a "
+                    + boot_type
+                    + " boot partition, use fat32, ext2, ext3 or ext4"
+                )
+    if cfg["partitioner"] not in ["parted", "native"]:
+        errors.append("Partitioner not supported use parted or native")
+    return errors
+
+
+@stage
+def verify_config():
+    if not os.path.exists(config_dir):
+        logging.error("Config directory " + config_dir + " does not exist")
         exit(1)
-    if cfg["img_backend"] not in ["loop"]:
-        logging.error("Image backend not supported use loop")
+    if not os.path.isfile(config_dir + "profiledef"):
+        logging.error("Config directory " + config_dir + " has no profiledef")
         exit(1)
+    cfg = read_config(config_dir)
+    errors = config_errors(cfg)
+    for i in errors:
+        logging.error(i)
+    if errors:
+        exit(1)
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    cfg["out_dir"] = out_dir
+    if not os.path.exists(work_dir):
+        os.mkdir(work_dir)
+    cfg["work_dir"] = work_dir
 
-    with open(packages_file, "r") as f:
-        packages = map(lambda package: package.strip(), f.readlines())
-        packages = list(filter(lambda package: not package.startswith("#"), packages))
+    install_dir = work_dir + ("/" if not work_dir.endswith("/") else "") + cfg["arch"]
+    cfg["install_dir"] = install_dir
+    subprocess.run(["mkdir", "-p", install_dir])
     return cfg
 
 
+def lock_work_dir():
+    # One build per work dir, the lock goes away with the process
+    lock = open(work_dir + "mkimage.lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logging.error("Another build is using " + work_dir)
+        exit(1)
+    lock.write(str(os.getpid()) + "\n")
+    lock.flush()
+    return lock
+
+
+@contextlib.contextmanager
+def host_slot(name: str, limit: int):
+    # Take one of limit lock files shared by every build on this host
+    if limit <= 0:
+        yield
+        return
+    os.makedirs(HOST_LOCK_DIR, exist_ok=True)
+    waiting = False
+    while True:
+        for i in range(limit):
+            lock = open(HOST_LOCK_DIR + name + "." + str(i), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            try:
+                yield
+            finally:
+                lock.close()
+            return
+        if not waiting:
+            logging.info("Waiting for a free " + name + " slot")
+            waiting = True
+        time.sleep(1)
+
+
 def runonce(thing) -> bool:
-    runonce_path = pathlib.Path("/tmp/runonce_" + thing)
+    runonce_path = pathlib.Path(work_dir + "runonce_" + thing)
     if runonce_path.exists():
         return False
-    else:
-        return True
+    # Guarded mkcmds blocks take part in checkpointing like the stages do
+    if checkpoints["enabled"]:
+        skip, _ = checkpoint_skip("runonce_" + thing, ())
+        if skip:
+            return False
+        checkpoint_done("runonce_" + thing, None)
+    return True
+
+
+# Filesystems created by mkimage itself, by partition device name
+fs_table = dict()
+
+
+def fs_uuid(disk: str, idf: str) -> str:
+    # Same image name, version and partition always get the same UUID
+    name = os.path.basename(cfg["images"].get(disk, disk))
+    seed = ":".join([cfg["edition"], cfg["arch"], cfg["img_version"], name, idf])
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "mkimage:" + seed))
+
+
+def probe_partitions(device: str) -> None:
+    # One low-level probe for every partition of the disk instead of a
+    # blkid run per lookup, results land in fs_table
+    disk = re.sub(r"p[0-9]+$", "", device)
+    devices = sorted(glob.glob(disk + "p[0-9]*")) or [device]
+    out = subprocess.run(
+        ["blkid", "-p", "-o", "export"] + devices, stdout=subprocess.PIPE
+    ).stdout.decode("utf-8")
+    for block in out.split("\n\n"):
+        fields = dict(i.split("=", 1) for i in block.splitlines() if "=" in i)
+        if "DEVNAME" in fields and "UUID" in fields:
+            fs_table.setdefault(
+                fields["DEVNAME"], {"UUID": fields["UUID"], "TYPE": fields.get("TYPE")}
+            )
 
 
 def get_fsline(device) -> str:  # type: ignore
-    fl = subprocess.check_output(["blkid", device]).decode("utf-8")
-    spl = fl.split(" ")
-    for i in spl:
-        if i.startswith("UUID="):
-            return str(i.replace('"', ""))
+    if device not in fs_table:
+        probe_partitions(device)
+    if device in fs_table:
+        return "UUID=" + fs_table[device]["UUID"]
 
 
 def get_parttype(device):
-    fl = subprocess.check_output(["blkid", device]).decode("utf-8")
-    spl = fl.split(" ")
-    for i in spl:
-        if i.startswith("TYPE="):
-            return i[6:-1]
+    if device not in fs_table:
+        probe_partitions(device)
+    if device in fs_table:
+        return fs_table[device]["TYPE"]
 
 
 def realpath(item):
-    return subprocess.check_output(["readlink", "-f", item]).decode("utf-8").split()[0]
+    return os.path.realpath(item)
+
+
+def read_ids(path: str) -> dict:
+    # name -> id from a passwd or group file of the image
+    ids = dict()
+    try:
+        with open(path) as f:
+            for line in f.readlines():
+                fields = line.split(":")
+                if len(fields) > 2 and fields[2].isdigit():
+                    ids[fields[0]] = int(fields[2])
+    except FileNotFoundError:
+        logging.warning("No " + path + ", only numeric ids can be used")
+    return ids
+
 
+def resolve_id(name: str, ids: dict) -> int:
+    if name.isdigit():
+        return int(name)
+    if name not in ids:
+        raise KeyError(name)
+    return ids[name]
 
+
+def apply_perms(path: str, uid: int, gid: int, mode) -> int:
+    # Returns 1 if anything had to change
+    st = os.lstat(path)
+    changed = 0
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        changed = 1
+        if args.perms_dry_run:
+            logging.info(
+                path
+                + ": owner "
+                + str(st.st_uid)
+                + ":"
+                + str(st.st_gid)
+                + " -> "
+                + str(uid)
+                + ":"
+                + str(gid)
+            )
+        else:
+            os.chown(path, uid, gid, follow_symlinks=False)
+    if mode is None:
+        return changed
+    if isinstance(mode, str):
+        # Symbolic modes are left to chmod
+        if args.perms_dry_run:
+            logging.info(path + ": mode " + mode)
+        else:
+            subprocess.run(["chmod", "--", mode, path])
+        return 1
+    st = os.stat(path)
+    if stat.S_IMODE(st.st_mode) != mode:
+        changed = 1
+        if args.perms_dry_run:
+            logging.info(
+                path + ": mode " + oct(stat.S_IMODE(st.st_mode)) + " -> " + oct(mode)
+            )
+        else:
+            os.chmod(path, mode)
+    return changed
+
+
+@stage
 def fixperms(target):
     realtarget = realpath(target)
-    for i in cfg["perms"].keys():
-        if realpath(realtarget + i) != realtarget + (i if not i[-1] == "/" else i[:-1]):
+    users = read_ids(realtarget + "/etc/passwd")
+    groups = read_ids(realtarget + "/etc/group")
+    # Later entries win, like the chown/chmod calls used to run in order
+    exact = dict()
+    trees = []
+    for n, i in enumerate(cfg["perms"].keys()):
+        path = realtarget + (i if not i[-1] == "/" else i[:-1])
+        if realpath(realtarget + i) != path:
             raise OSError("Out of bounds permission fix!")
+        owner, group, mode = cfg["perms"][i]
+        try:
+            ids = (n, resolve_id(owner, users), resolve_id(group, groups))
+        except KeyError as e:
+            logging.error("Unknown user or group " + str(e) + " for " + i)
+            continue
+        mode = int(mode, 8) if re.match(r"^[0-7]+$", mode) else mode
+        exact[path] = ids + (mode,)
         if i[-1] == "/":
-            subprocess.run(
-                [
-                    "chown",
-                    "-Rh",
-                    "--",
-                    cfg["perms"][i][0] + ":" + cfg["perms"][i][1],
-                    realtarget + i,
-                ]
-            )
-        else:
-            subprocess.run(
-                [
-                    "chown",
-                    "-hv",
-                    "--",
-                    cfg["perms"][i][0] + ":" + cfg["perms"][i][1],
-                    realtarget + i,
-                ]
-            )
-        subprocess.run(["chmod", "--", cfg["perms"][i][2], realtarget + i])
+            trees.append((path,) + ids)
 
+    def owner_of(path: str, n: int, uid: int, gid: int) -> tuple:
+        for tree, tn, tuid, tgid in trees:
+            if tn > n and (path + "/").startswith(tree + "/"):
+                n, uid, gid = tn, tuid, tgid
+        return uid, gid
 
-def pacstrap_packages(pacman_conf, packages_file, install_dir) -> None:
+    def walk(tree: str, n: int, uid: int, gid: int) -> int:
+        changed = 0
+        for root, dirs, files in os.walk(tree):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if path in exact:
+                    continue
+                changed += apply_perms(path, *owner_of(path, n, uid, gid), None)
+        return changed
+
+    # Only the outermost trees are walked, nested ones are resolved per path
+    tops = [
+        i
+        for i in trees
+        if not any(i[0].startswith(j[0] + "/") for j in trees if j is not i)
+    ]
+    with ThreadPoolExecutor(max_workers=max(len(tops), 1)) as pool:
+        jobs = [pool.submit(walk, *i) for i in tops]
+        changed = sum(
+            apply_perms(path, *owner_of(path, n, uid, gid), mode)
+            for path, (n, uid, gid, mode) in exact.items()
+            if os.path.lexists(path)
+        )
+        changed += sum(i.result() for i in jobs)
+    logging.info(
+        ("Would change " if args.perms_dry_run else "Changed ")
+        + str(changed)
+        + " entries under "
+        + realtarget
+    )
+
+
+def read_packages(packages_file) -> list:
     with open(packages_file) as f:
         packages = map(lambda package: package.strip(), f.readlines())
-        packages = list(
+        return list(
             filter(
                 lambda package: not (package.startswith("#") or not len(package)),
                 packages,
             )
         )
-    logging.info("Install dir is:" + install_dir)
-    logging.info("Running pacstrap")
+
+
+# Databases synced by this run, estimate_rootfs and pacstrap share them
+synced_dbs = []
+
+
+def sync_databases(pacman_conf) -> str:
+    # Keep a private copy of the repo databases, one per pacman.conf
+    with open(pacman_conf, "rb") as f:
+        conf_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    dbpath = cache_dir + "db/" + conf_hash
+    if dbpath in synced_dbs:
+        return dbpath
+    os.makedirs(dbpath, exist_ok=True)
+    # Builds running side by side share the dbpath, serialize the sync
+    with open(dbpath + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            age = time.time() - os.path.getmtime(dbpath + ".synced")
+        except OSError:
+            age = None
+        if age is not None and age < args.db_max_age:
+            logging.info("Reusing package databases synced " + str(int(age)) + "s ago")
+        else:
+            logging.info("Syncing package databases into " + dbpath)
+            subprocess.run(
+                [
+                    "pacman",
+                    "-Sy",
+                    "--noconfirm",
+                    "--config",
+                    pacman_conf,
+                    "--dbpath",
+                    dbpath,
+                ],
+                check=True,
+            )
+            pathlib.Path(dbpath + ".synced").touch()
+    synced_dbs.append(dbpath)
+    return dbpath
+
+
+def pacman_includes(pacman_conf) -> list:
+    # Files an Include = line pulls in, like /etc/pacman.d/mirrorlist
+    found = []
+    with open(pacman_conf) as f:
+        for line in f:
+            name, _, value = line.partition("=")
+            if name.strip() == "Include" and value.strip():
+                for i in sorted(glob.glob(value.strip())):
+                    if os.path.isfile(i) and i not in found:
+                        found.append(i)
+    return found
+
+
+def rootfs_cache_key(pacman_conf, packages, dbpath) -> str:
+    key = hashlib.sha256()
+    key.update("\n".join(sorted(packages)).encode("utf-8"))
+    with open(pacman_conf, "rb") as f:
+        key.update(f.read())
+    for i in pacman_includes(pacman_conf):
+        key.update(i.encode("utf-8"))
+        with open(i, "rb") as f:
+            key.update(f.read())
+    sync_dir = dbpath + "/sync/"
+    for db in sorted(os.listdir(sync_dir)):
+        if not db.endswith(".db"):
+            continue
+        key.update(db.encode("utf-8"))
+        with open(sync_dir + db, "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def rootfs_cache_path(key) -> str:
+    return cache_dir + "rootfs/" + key + ".tar.zst"
+
+
+def restore_rootfs(key, install_dir) -> bool:
+    snapshot = rootfs_cache_path(key)
+    if not os.path.isfile(snapshot):
+        return False
+    logging.info("Rootfs cache hit, restoring " + snapshot)
     subprocess.run(
-        ["pacstrap", "-c", "-C", pacman_conf, "-M", "-G", install_dir] + packages,
+        [
+            "tar",
+            "--xattrs",
+            "--xattrs-include=*",
+            "--acls",
+            "--numeric-owner",
+            "-I",
+            "zstd -T0",
+            "-xpf",
+            snapshot,
+            "-C",
+            install_dir,
+        ],
         check=True,
     )
+    # Mark as recently used for eviction
+    os.utime(snapshot)
+    return True
+
+
+def store_rootfs(key, install_dir) -> None:
+    snapshot = rootfs_cache_path(key)
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    logging.info("Storing rootfs snapshot " + snapshot)
+    # Builds of the same key at the same time each write their own part
+    part = snapshot + "." + str(os.getpid()) + ".part"
+    try:
+        subprocess.run(
+            [
+                "tar",
+                "--xattrs",
+                "--xattrs-include=*",
+                "--acls",
+                "--numeric-owner",
+                "-I",
+                "zstd -T0 -3",
+                "-cpf",
+                part,
+                "-C",
+                install_dir,
+                ".",
+            ],
+            check=True,
+        )
+        os.rename(part, snapshot)
+    finally:
+        # evict_cache leaves parts alone, a failed one has to go here
+        if os.path.exists(part):
+            os.remove(part)
+    evict_cache(cache_dir + "rootfs/", args.cache_max_size * 1024**3)
+
+
+def evict_cache(directory, max_size=None) -> None:
+    # Drop entries by age, then the least recently used ones over max_size
+    entries = []
+    for i in os.listdir(directory):
+        # Downloads and snapshots other builds are still writing
+        if i.endswith(".part"):
+            continue
+        st = os.stat(directory + i)
+        entries.append((st.st_mtime, st.st_size, directory + i))
+    entries.sort()
+    oldest = time.time() - args.cache_max_age * 86400
+    total = sum(i[1] for i in entries)
+    for mtime, size, path in entries:
+        if mtime >= oldest and (max_size is None or total <= max_size):
+            break
+        logging.info("Evicting cache entry " + path)
+        os.remove(path)
+        total -= size
+
+
+def fetch_package(url, pkg_dir) -> int:
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    dest = pkg_dir + name
+    if os.path.exists(dest):
+        os.utime(dest)
+        return 0
+    part = dest + "." + str(os.getpid()) + ".part"
+    try:
+        with urllib.request.urlopen(url, timeout=60) as r, open(part, "wb") as f:
+            shutil.copyfileobj(r, f, 1024 * 1024)
+        os.rename(part, dest)
+    except OSError as e:
+        logging.warning("Prefetch of " + url + " failed: " + str(e))
+        if os.path.exists(part):
+            os.remove(part)
+        return 0
+    return os.path.getsize(dest)
+
+
+def prefetch_packages(pacman_conf, packages, dbpath) -> str:
+    # Download the whole transaction into the shared cache before pacstrap
+    pkg_dir = cache_dir + "pkg/"
+    os.makedirs(pkg_dir, exist_ok=True)
+    urls = subprocess.check_output(
+        [
+            "pacman",
+            "-Sp",
+            "--noconfirm",
+            "--config",
+            pacman_conf,
+            "--dbpath",
+            dbpath,
+            "--cachedir",
+            pkg_dir,
+        ]
+        + packages
+    ).decode("utf-8")
+    cached = [i for i in urls.split() if i.startswith("file://" + pkg_dir)]
+    urls = [i for i in urls.split() if "://" in i and i not in cached]
+    # Packages pacman found in the cache are in use, keep them from eviction
+    for i in cached:
+        if os.path.exists(i[len("file://") :]):
+            os.utime(i[len("file://") :])
+    logging.info(
+        "Prefetching "
+        + str(len(urls))
+        + " packages with "
+        + str(args.fetch_jobs)
+        + " jobs"
+    )
+    with ThreadPoolExecutor(max_workers=max(args.fetch_jobs, 1)) as pool:
+        fetched = sum(pool.map(lambda url: fetch_package(url, pkg_dir), urls))
+    logging.info("Prefetched " + str(int(fetched / 1024 / 1024)) + "M of packages")
+    stage_bytes(bytes_in=fetched)
+    evict_cache(pkg_dir)
+    return pkg_dir
+
+
+@stage
+def pacstrap_packages(pacman_conf, packages_file, install_dir) -> None:
+    packages = read_packages(packages_file)
+    logging.info("Install dir is:" + install_dir)
+    if args.rootfs_from:
+        # The matrix build pacstrapped it once for the whole rootfs group
+        if cfg.get("btrfs_send"):
+            rootfs_subvolume(install_dir)
+        logging.info("Pacstrap skipped, rootfs copied from " + args.rootfs_from)
+        subprocess.run(
+            ["cp", "-a", "--reflink=auto", args.rootfs_from + "/.", install_dir],
+            check=True,
+        )
+        return
+    dbpath = sync_databases(pacman_conf)
+    key = None if args.no_cache else rootfs_cache_key(pacman_conf, packages, dbpath)
+    if cfg.get("btrfs_send"):
+        if key and restore_subvolume(key, install_dir):
+            logging.info("Pacstrap skipped, rootfs snapshotted from cache")
+            return
+        rootfs_subvolume(install_dir)
+    if key and restore_rootfs(key, install_dir):
+        logging.info("Pacstrap skipped, rootfs restored from cache")
+        return
+    with host_slot("pacstrap", args.max_pacstrap):
+        pkg_dir = prefetch_packages(pacman_conf, packages, dbpath)
+        logging.info("Running pacstrap")
+        subprocess.run(
+            ["pacstrap", "-c", "-C", pacman_conf, "-M", "-G", install_dir]
+            + packages
+            + ["--cachedir", pkg_dir],
+            check=True,
+        )
     logging.info("Pacstrap complete")
+    if key and cfg.get("btrfs_send"):
+        # The snapshot is the cache entry, a tarball of it would be a copy
+        snapshot_ro(install_dir, subvolume_cache_path(key))
+        evict_snapshots("rootfs-", [subvolume_cache_path(key)])
+    elif key:
+        store_rootfs(key, install_dir)
+
+
+def mem_available() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def fs_type(path: str) -> str:
+    # Filesystem type of the longest mount point holding path
+    path = os.path.realpath(path).rstrip("/") + "/"
+    best, ftype = "", ""
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            mount, mtype = line.split()[1:3]
+            mount = mount.replace("\\040", " ").rstrip("/") + "/"
+            if path.startswith(mount) and len(mount) >= len(best):
+                best, ftype = mount, mtype
+    return ftype
+
+
+def estimate_rootfs(pacman_conf, packages_file) -> int:
+    # Installed size of the whole transaction, dependencies included,
+    # from the synced databases. 0 if pacman can not tell.
+    env = dict(os.environ, LC_ALL="C")
+    try:
+        dbpath = sync_databases(pacman_conf)
+        pacman = ["pacman", "--noconfirm", "--config", pacman_conf]
+        pacman += ["--dbpath", dbpath]
+        names = subprocess.run(
+            pacman + ["-Sp", "--print-format", "%n"] + read_packages(packages_file),
+            stdout=subprocess.PIPE,
+            env=env,
+            check=True,
+        ).stdout.decode("utf-8")
+        info = subprocess.run(
+            pacman + ["-Si"] + names.split(),
+            stdout=subprocess.PIPE,
+            env=env,
+            check=True,
+        ).stdout.decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    units = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+    total = 0
+    for line in info.splitlines():
+        if line.startswith("Installed Size"):
+            value, unit = line.split(":", 1)[1].split()
+            total += int(float(value) * units[unit])
+    return total
 
 
+def spill_dir(work_dir: str) -> str:
+    spill = os.path.abspath(args.spill_dir) + "/"
+    return spill + hashlib.sha256(work_dir.encode("utf-8")).hexdigest()[:12] + "/"
+
+
+def image_dir(work_dir: str) -> str:
+    # Where plan_placement() puts the image of a build in work_dir
+    if args.placement == "auto" and fs_type(work_dir) in ["tmpfs", "ramfs"]:
+        return spill_dir(work_dir)
+    return work_dir
+
+
+def plan_placement(pacman_conf) -> None:
+    # Decide once, before mkcmds runs, what lives in RAM and what on disk
+    cfg["img_dir"] = work_dir
+    cfg["stage_dir"] = None
+    cfg["tmpfs"] = []
+    cfg["btrfs_send"] = False
+    if args.btrfs_send:
+        backends = cfg["fs"] == "btrfs" and cfg["img_backend"] == "loop"
+        cfg["btrfs_send"] = backends and fs_type(work_dir) == "btrfs"
+        if not cfg["btrfs_send"]:
+            logging.warning(
+                "--btrfs-send needs fs btrfs, the loop backend and a work dir"
+                + " on btrfs, copying files instead"
+            )
+    if args.placement == "work":
+        if args.overlap:
+            cfg["rootfs_estimate"] = estimate_rootfs(pacman_conf, cfg["packages_file"])
+        return
+    spill = spill_dir(work_dir)
+    rootfs = estimate_rootfs(pacman_conf, cfg["packages_file"])
+    cfg["rootfs_estimate"] = rootfs
+    mem = mem_available()
+    work_fs = fs_type(work_dir)
+    in_ram = work_fs in ["tmpfs", "ramfs"]
+    logging.info(
+        "Placement: rootfs needs about "
+        + str(rootfs // 1024**2)
+        + "M, "
+        + str(mem // 1024**2)
+        + "M of RAM available, "
+        + str(shutil.disk_usage(work_dir).free // 1024**2)
+        + "M free in "
+        + work_dir
+        + " ("
+        + work_fs
+        + ")"
+    )
+    # Half of the available memory, the rest is for page cache and mkfs
+    fits = rootfs and rootfs * 5 // 4 < mem // 2
+    if args.resume or cfg["btrfs_send"]:
+        # A rootfs left by the interrupted run is on disk, keep it there,
+        # and a subvolume to send has to be on the btrfs work dir
+        fits = False
+    if fits and not in_ram:
+        os.makedirs(cfg["install_dir"], exist_ok=True)
+        subprocess.run(
+            ["mount", "-t", "tmpfs", "-o", "size=" + str(mem * 3 // 4), "tmpfs"]
+            + [cfg["install_dir"]],
+            check=True,
+        )
+        cfg["tmpfs"].append(cfg["install_dir"])
+        logging.info("Placement: rootfs in tmpfs at " + cfg["install_dir"])
+    elif in_ram and not fits:
+        cfg["install_dir"] = spill + cfg["arch"]
+        os.makedirs(cfg["install_dir"], exist_ok=True)
+        logging.info("Placement: rootfs does not fit in RAM, using " + spill)
+    else:
+        logging.info("Placement: rootfs in " + cfg["install_dir"])
+    if in_ram:
+        # The image is the largest file, it never goes into RAM
+        cfg["img_dir"] = spill
+        os.makedirs(spill, exist_ok=True)
+    logging.info(
+        "Placement: image in "
+        + cfg["img_dir"]
+        + ", "
+        + str(shutil.disk_usage(cfg["img_dir"]).free // 1024**2)
+        + "M free"
+    )
+    if cfg["img_backend"] != "offline":
+        # mkcmds formats and mounts it on the loop device itself
+        logging.info("Placement: boot partition written in place in the image")
+    elif fs_type("/dev/shm") == "tmpfs":
+        cfg["stage_dir"] = "/dev/shm/mkimage-" + spill.split("/")[-2] + "/"
+        logging.info(
+            "Placement: boot partition built in " + cfg["stage_dir"] + " if it fits"
+        )
+
+
+def release_placement() -> None:
+    for i in cfg.get("tmpfs", []):
+        subprocess.run(["umount", "-R", i])
+    cfg["tmpfs"] = []
+    if cfg.get("stage_dir"):
+        shutil.rmtree(cfg["stage_dir"], ignore_errors=True)
+
+
+SIZE_UNITS = {
+    "s": 512,
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+    "%": None,
+}
+
+
+def size_unit(value: str) -> str:
+    # Unit of a parted style size, plain numbers are MB like in parted
+    value = str(value).strip()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return unit
+    return ""
+
+
+def parse_size(value: str, disk_size: int = 0) -> int:
+    # parted style sizes to bytes
+    value = str(value).strip()
+    unit = size_unit(value)
+    number = float(value[: len(value) - len(unit)])
+    if unit == "%":
+        return int(number * disk_size / 100)
+    return int(number * SIZE_UNITS[unit or "MB"])
+
+
+def compress_ratio(samples: list) -> float:
+    # btrfs compresses per 128K extent and keeps incompressible data as is
+    raw = packed = 0
+    for path in samples:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(128 * 1024)
+        except OSError:
+            continue
+        raw += len(data)
+        packed += min(len(zlib.compress(data, 3)), len(data))
+    return packed / raw if raw else 1.0
+
+
+def measure_rootfs(install_dir: str, fs: str) -> int:
+    # Estimated filesystem size in KiB needed to hold install_dir
+    data = inodes = 0
+    seen = set()
+    files = []
+    for root, dirs, names in os.walk(install_dir):
+        for name in dirs + names:
+            st = os.lstat(os.path.join(root, name))
+            inodes += 1
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            if stat.S_ISREG(st.st_mode):
+                data += -(-st.st_size // 4096) * 4096
+                files.append(os.path.join(root, name))
+    if fs == "btrfs":
+        ratio = compress_ratio(files[:: max(len(files) // 2000, 1)])
+        logging.info("Estimated btrfs compression ratio " + str(round(ratio, 2)))
+        # DUP metadata for every inode plus chunk and global reserves
+        need = data * ratio + inodes * 2048 + 512 * 1024**2
+    else:
+        # Journal, 5% reserved blocks, inode tables and group metadata
+        need = max((data + 128 * 1024**2) / 0.9, inodes * 16384 * 1.2)
+    logging.info(
+        "Rootfs holds "
+        + str(int(data / 1024**2))
+        + "M in "
+        + str(inodes)
+        + " inodes, needs "
+        + str(int(need / 1024**2))
+        + "M as "
+        + fs
+    )
+    return int(need / 1024)
+
+
+def estimate_fs_size(fs: str) -> int:
+    # KiB for the rootfs from the package estimate, before anything is
+    # installed. No compression or inode counts yet, so err on the large side.
+    data = cfg["rootfs_estimate"]
+    if fs == "btrfs":
+        need = data * 1.1 + 512 * 1024**2
+    else:
+        need = (data + 128 * 1024**2) / 0.9
+    logging.info(
+        "Packages install about "
+        + str(int(data / 1024**2))
+        + "M, sizing for "
+        + str(int(need / 1024**2))
+        + "M as "
+        + fs
+    )
+    return int(need / 1024)
+
+
+def auto_img_size(fs: str, rootfs_size: int) -> int:
+    # Everything up to the start of the root partition plus the rootfs
+    if "partition_table" in cfg:
+        entries = list(cfg["partition_table"].values())
+    else:
+        entries = list(cfg["partition_table_boot"].values()) + list(
+            cfg["partition_table_root"].values()
+        )
+    root_start = 0
+    for i in entries:
+        if "%" in str(i[0]):
+            continue
+        if i[3] in ["ext4", "btrfs"]:
+            root_start = max(root_start, parse_size(i[0]))
+        elif "%" not in str(i[1]):
+            root_start = max(root_start, parse_size(i[1]))
+    # Round up to MiB and keep room for the backup GPT
+    return (
+        -(-root_start // 1024**2) * 1024 + rootfs_size + args.headroom * 1024 + 1024
+    )
+
+
+@stage
 def makeimg(size, fs, img_name, backend):
     format = "raw"
     image_ext = ".img"
-    if not fs == "btrfs":
+    if args.auto_size and sized_early():
+        # pacstrap is still filling install_dir, go by the package estimate
+        img_size = auto_img_size(fs, estimate_fs_size(fs))
+        logging.info("Sized image from estimate to " + str(img_size // 1024) + "M")
+    elif args.auto_size and os.listdir(cfg["install_dir"]):
+        img_size = auto_img_size(fs, measure_rootfs(cfg["install_dir"], fs))
+        logging.info("Auto sized image to " + str(int(img_size / 1024)) + "M")
+    elif not fs == "btrfs":
         img_size = size + int(1100000)
     else:
         img_size = size
@@ -244,25 +1906,435 @@ def makeimg(size, fs, img_name, backend):
             "fallocate",
             "-l",
             str(img_size) + "K",
-            work_dir + "/" + img_name + ".img",
+            cfg["img_dir"] + img_name + ".img",
         ]
     )
+    if backend == "offline":
+        # The image file itself stands in for the loop device
+        ldev = cfg["img_dir"] + img_name + ".img"
+        cfg.setdefault("images", dict())[ldev] = ldev
+        logging.info("Image file created")
+        stage_bytes(bytes_out=img_size * 1024)
+        return img_size, ldev
 
+    ldev = attach_image(cfg["img_dir"] + img_name + ".img")
+    logging.info("Image file created")
+    stage_bytes(bytes_out=img_size * 1024)
+    return img_size, ldev
+
+
+def attach_image(img: str) -> str:
     subprocess.run(["modprobe", "loop"])
-    logging.info(
-        "Attaching image file " + img_name + ".img to loop device " + next_loop()
+    # Claim and attach in one step, other builds may be looking for a free loop
+    ldev = (
+        subprocess.check_output(["losetup", "-f", "--show", "-P", img])
+        .decode("utf-8")
+        .strip("\n")
     )
-    ldev = next_loop()
-    subprocess.run(["losetup", "-P", ldev, work_dir + "/" + img_name + ".img"])
-
-    logging.info("Image file created")
+    logging.info("Attached image file " + img + " to loop device " + ldev)
+    cfg.setdefault("images", dict())[ldev] = img
     if args.ci:
-        subprocess.run(["ln", "-s", ldev, ldev.replace("/dev/", "/dev/mapper/")])
+        subprocess.run(["ln", "-sf", ldev, ldev.replace("/dev/", "/dev/mapper/")])
         ldev = ldev.replace("/dev/", "/dev/mapper/")
-    
-    return img_size, ldev
+        cfg["images"][ldev] = img
+    return ldev
 
 
+SECTOR = 512
+# 1 MiB, what parted --align optimal uses for images
+ALIGN = 2048
+GPT_HEADER = "<8sIIIIQQQQ16sQIII"
+GPT_ENTRY = "<16s16sQQQ72s"
+GPT_TYPES = {
+    "esp": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+    "linux": "0FC63DAF-8483-4772-8E79-3D69D8477DE4",
+}
+MBR_ENTRY = "<B3sB3sII"
+DD_UNITS = {
+    "": 1,
+    "c": 1,
+    "w": 2,
+    "b": 512,
+    "kB": 1000,
+    "K": 1024,
+    "KiB": 1024,
+    "MB": 1000**2,
+    "M": 1024**2,
+    "MiB": 1024**2,
+    "GB": 1000**3,
+    "G": 1024**3,
+    "GiB": 1024**3,
+}
+
+
+def read_partitions(disk: str) -> dict:
+    # GPT or MBR of an image file or block device, without parted/sfdisk
+    with open(disk, "rb") as f:
+        sectors = f.seek(0, os.SEEK_END) // SECTOR
+        f.seek(0)
+        mbr = f.read(SECTOR)
+        header = f.read(SECTOR)
+        layout = {"label": None, "sectors": sectors, "partitions": []}
+        if mbr[510:512] != b"\x55\xaa":
+            return layout
+        if header[:8] == b"EFI PART":
+            hdr = struct.unpack_from(GPT_HEADER, header)
+            f.seek(hdr[10] * SECTOR)
+            entries = f.read(hdr[11] * hdr[12])
+            layout.update(label="gpt", disk_id=uuid.UUID(bytes_le=hdr[9]))
+            for n in range(hdr[11]):
+                ptype, guid, start, end, attrs, name = struct.unpack_from(
+                    GPT_ENTRY, entries, n * hdr[12]
+                )
+                if ptype == bytes(16):
+                    continue
+                layout["partitions"].append(
+                    {
+                        "number": n + 1,
+                        "start": start,
+                        "end": end,
+                        "type": str(uuid.UUID(bytes_le=ptype)).upper(),
+                        "guid": uuid.UUID(bytes_le=guid),
+                        "attrs": attrs,
+                        "name": name.decode("utf-16-le").rstrip("\x00"),
+                        "boot": False,
+                    }
+                )
+            return layout
+        layout.update(label="msdos", disk_id=struct.unpack_from("<I", mbr, 440)[0])
+        for n in range(4):
+            status, _, ptype, _, start, size = struct.unpack_from(
+                MBR_ENTRY, mbr, 446 + n * 16
+            )
+            if ptype:
+                layout["partitions"].append(
+                    {
+                        "number": n + 1,
+                        "start": start,
+                        "end": start + size - 1,
+                        "type": ptype,
+                        "boot": status == 0x80,
+                    }
+                )
+        return layout
+
+
+def parted_position(value: str, sectors: int, end: bool = False) -> tuple:
+    # Sector parted makes of a start or end, and the range it may move it
+    # in to align it: half a unit either way, none for sectors and powers
+    # of two. Ends in IEC units are the sector before, so 1MiB-2MiB is 1 MiB.
+    value = str(value).strip()
+    unit = size_unit(value)
+    number = float(value[: len(value) - len(unit)])
+    unit = unit or "MB"
+    if unit == "%":
+        unit_size = sectors * SECTOR // 100
+    else:
+        unit_size = SIZE_UNITS[unit]
+    sector = min(max(int(number * unit_size / SECTOR), 0), sectors - 1)
+    radius = max(-(-unit_size // SECTOR) // 2 - 1, 0)
+    if not unit_size & (unit_size - 1):
+        radius = 0
+    if end and unit.endswith("iB"):
+        sector -= 1
+    return sector, max(sector - radius, 0), min(sector + radius, sectors - 1)
+
+
+def align_start(sector: int, low: int, high: int) -> int:
+    # The ALIGN multiple in low-high closest to sector, lower one on a tie
+    down = min(sector, high) // ALIGN * ALIGN
+    up = -(-max(sector, low) // ALIGN) * ALIGN
+    fits = [i for i in [down, up] if low <= i <= high]
+    if fits:
+        return min(fits, key=lambda i: (abs(i - sector), i))
+    # parted --script then keeps the exact position, unaligned
+    if low <= high:
+        return min(max(sector, low), high)
+    return up
+
+
+def plan_partitions(disk: str, partition_table: dict, has_uefi: bool) -> dict:
+    # Same partitions, numbers and flags the parted command line creates
+    layout = read_partitions(disk)
+    sectors = layout["sectors"]
+    if layout["label"] is None or (cfg["recreate_part_table"] and not has_uefi):
+        disk_id = uuid.UUID(fs_uuid(disk, "disk"))
+        layout = {"label": cfg["part_type"], "sectors": sectors, "partitions": []}
+        layout["disk_id"] = disk_id if cfg["part_type"] == "gpt" else disk_id.int >> 96
+    gpt = layout["label"] == "gpt"
+    layout["first"], layout["last"] = (34, sectors - 34) if gpt else (1, sectors - 1)
+    for i in partition_table.values():
+        if i[3] == "NONE":
+            continue
+        used = [p["number"] for p in layout["partitions"]]
+        number = min(set(range(1, len(used) + 2)) - set(used))
+        start, low, high = parted_position(i[0], sectors)
+        # parted moves a start inside a partition to the free space after it
+        for p in layout["partitions"]:
+            if p["start"] <= start <= p["end"] < high:
+                start = p["end"] + 1
+                low = max(low, start)
+        start = align_start(start, max(low, layout["first"]), high)
+        end, low, high = parted_position(i[1], sectors, end=True)
+        if end > layout["last"] >= low:
+            end = layout["last"]
+        part = {"number": number, "start": start, "end": end, "boot": False}
+        if gpt:
+            guid = uuid.UUID(fs_uuid(disk, "part" + str(number)))
+            part.update(guid=guid, attrs=0, name="primary", type=GPT_TYPES["linux"])
+        else:
+            part["type"] = 0x83
+        if i[3] == "fat32":
+            # parted: boot on GPT means the ESP type, esp on msdos means 0xef
+            part["boot"] = True
+            if gpt:
+                part["type"] = GPT_TYPES["esp"]
+            else:
+                part["type"] = 0xEF if cfg["boot_set_esp"] else 0x0C
+        layout["partitions"].append(part)
+    return layout
+
+
+def gpt_header(layout: dict, current: int, backup: int, entries: int, crc: int):
+    hdr = bytearray(
+        struct.pack(
+            GPT_HEADER,
+            b"EFI PART",
+            0x10000,
+            92,
+            0,
+            0,
+            current,
+            backup,
+            layout["first"],
+            layout["last"],
+            layout["disk_id"].bytes_le,
+            entries,
+            128,
+            128,
+            crc,
+        )
+    )
+    struct.pack_into("<I", hdr, 16, zlib.crc32(hdr))
+    return bytes(hdr) + bytes(SECTOR - len(hdr))
+
+
+def write_partitions(disk: str, layout: dict) -> None:
+    sectors = layout["sectors"]
+    with open(disk, "r+b") as f:
+        # Boot code in the first 440 bytes stays, like with parted
+        mbr = bytearray(f.read(SECTOR))
+        mbr[446:510] = bytes(64)
+        mbr[510:512] = b"\x55\xaa"
+        if layout["label"] == "gpt":
+            entries = bytearray(128 * 128)
+            for p in layout["partitions"]:
+                struct.pack_into(
+                    GPT_ENTRY,
+                    entries,
+                    (p["number"] - 1) * 128,
+                    uuid.UUID(p["type"]).bytes_le,
+                    p["guid"].bytes_le,
+                    p["start"],
+                    p["end"],
+                    p["attrs"],
+                    p["name"].encode("utf-16-le"),
+                )
+            crc = zlib.crc32(entries)
+            # Protective MBR, one 0xee partition over the whole disk
+            struct.pack_into(
+                MBR_ENTRY,
+                mbr,
+                446,
+                0,
+                b"\x00\x02\x00",
+                0xEE,
+                b"\xff\xff\xff",
+                1,
+                min(sectors - 1, 0xFFFFFFFF),
+            )
+            f.seek(0)
+            f.write(mbr + gpt_header(layout, 1, sectors - 1, 2, crc) + entries)
+            f.seek((sectors - 33) * SECTOR)
+            f.write(entries + gpt_header(layout, sectors - 1, 1, sectors - 33, crc))
+        else:
+            struct.pack_into("<I", mbr, 440, layout["disk_id"])
+            for p in layout["partitions"]:
+                struct.pack_into(
+                    MBR_ENTRY,
+                    mbr,
+                    446 + (p["number"] - 1) * 16,
+                    0x80 if p["boot"] else 0,
+                    b"\xfe\xff\xff",
+                    p["type"],
+                    b"\xfe\xff\xff",
+                    p["start"],
+                    p["end"] - p["start"] + 1,
+                )
+            f.seek(0)
+            f.write(mbr)
+            # A GPT left by partition_prefix would shadow the new MBR
+            if f.read(8) == b"EFI PART":
+                f.seek(SECTOR)
+                f.write(bytes(SECTOR))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def dd_number(value: str) -> int:
+    number, unit = re.fullmatch(r"([0-9]+)([A-Za-z]*)", value).groups()
+    return int(number) * DD_UNITS[unit]
+
+
+def blob_write(entry, disk: str):  # type: ignore
+    # partition_prefix/suffix entry as {"file", "offset", "skip", "length"},
+    # None for commands that have to run as they are
+    if isinstance(entry, dict):
+        blob = dict(entry)
+        for i in ["offset", "skip"]:
+            if isinstance(blob.get(i, 0), str):
+                blob[i] = parse_size(blob[i])
+        blob.setdefault("skip", 0)
+        blob.setdefault("length", os.path.getsize(blob["file"]) - blob["skip"])
+        return blob
+    if isinstance(entry, str) or entry[0] != "dd":
+        return None
+    ops = dict(i.split("=", 1) for i in entry[1:] if "=" in i)
+    if len(ops) != len(entry) - 1 or ops.get("of") != disk or "if" not in ops:
+        return None
+    known = ["if", "of", "bs", "ibs", "obs", "seek", "skip", "count", "conv", "status"]
+    if set(ops) - set(known + ["oflag", "iflag"]):
+        return None
+    flags = ops.get("conv", "notrunc") + "," + ops.get("oflag", "sync")
+    if set(flags.split(",") + ops.get("iflag", "sync").split(",")) - set(
+        ["notrunc", "fsync", "fdatasync", "sync", "dsync", "direct"]
+    ):
+        return None
+    if "count" not in ops and not os.path.isfile(ops["if"]):
+        return None
+    try:
+        ibs = dd_number(ops.get("ibs", ops.get("bs", "512")))
+        obs = dd_number(ops.get("obs", ops.get("bs", "512")))
+        blob = {
+            "file": ops["if"],
+            "offset": dd_number(ops.get("seek", "0")) * obs,
+            "skip": dd_number(ops.get("skip", "0")) * ibs,
+        }
+        if "count" in ops:
+            blob["length"] = dd_number(ops["count"]) * ibs
+        else:
+            blob["length"] = os.path.getsize(ops["if"]) - blob["skip"]
+    except (AttributeError, KeyError):
+        return None
+    return blob
+
+
+def write_blob(disk: str, blob: dict) -> None:
+    with open(blob["file"], "rb") as src, open(disk, "r+b") as dst:
+        src.seek(blob["skip"])
+        dst.seek(blob["offset"])
+        left = blob["length"]
+        for chunk in iter(lambda: src.read(min(CHUNK_SIZE, left)), b""):
+            dst.write(chunk)
+            left -= len(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def layout_errors(layout: dict, prefix: list, suffix: list) -> list:
+    errors = []
+    size = layout["sectors"] * SECTOR
+    parts = sorted(layout["partitions"], key=lambda p: p["start"])
+    if layout["label"] == "msdos" and max([p["number"] for p in parts] + [0]) > 4:
+        errors.append("msdos tables hold 4 primary partitions")
+    areas = []
+    for p in parts:
+        name = "partition " + str(p["number"])
+        if p["end"] < p["start"]:
+            errors.append(name + " ends before it starts")
+        elif p["start"] < layout["first"] or p["end"] > layout["last"]:
+            errors.append(
+                name
+                + " ("
+                + str(p["start"])
+                + "s-"
+                + str(p["end"])
+                + "s) is outside of "
+                + str(layout["first"])
+                + "s-"
+                + str(layout["last"])
+                + "s"
+            )
+        areas.append((p["start"] * SECTOR, (p["end"] + 1) * SECTOR, name))
+    for a, b in zip(parts, parts[1:]):
+        if b["start"] <= a["end"]:
+            errors.append(
+                "partition " + str(a["number"]) + " overlaps " + str(b["number"])
+            )
+    # Written after the table, so the suffix must not touch it either
+    table = [(440, layout["first"] * SECTOR, "the partition table")]
+    if layout["label"] == "gpt":
+        table.append(((layout["last"] + 1) * SECTOR, size, "the backup GPT"))
+    for blobs, reserved in [(prefix, areas), (suffix, areas + table)]:
+        for blob in blobs:
+            name = os.path.basename(blob["file"]) + " at " + str(blob["offset"])
+            end = blob["offset"] + blob["length"]
+            if end > size:
+                errors.append(name + " ends after the end of the image")
+            for start, stop, what in reserved:
+                if blob["offset"] < stop and end > start:
+                    errors.append(name + " overlaps " + what)
+    return errors
+
+
+def layout_table(layout: dict) -> str:
+    table = prettytable.PrettyTable(["Partition", "Start", "End", "Size", "Type"])
+    for p in layout["partitions"]:
+        size = (p["end"] - p["start"] + 1) * SECTOR
+        ptype = p["type"] if layout["label"] == "gpt" else hex(p["type"])
+        table.add_row(
+            [
+                p["number"],
+                str(p["start"]) + "s",
+                str(p["end"]) + "s",
+                str(size // 1024**2) + "MiB",
+                ptype + (" boot" if p["boot"] else ""),
+            ]
+        )
+    return table.get_string(title=layout["label"] + " " + str(layout["sectors"]) + "s")
+
+
+def native_partition(disk: str, partition_table: dict, has_uefi: bool, split: bool):
+    # Blobs and the table are written straight into the image, dd commands
+    # that do more than copy a file to an offset still run as they are
+    writes = []
+    for hook in [] if split else ["partition_prefix", "partition_suffix"]:
+        entries = cfg[hook](config_dir, disk)
+        writes.append([(i, blob_write(i, disk)) for i in entries])
+    prefix, suffix = writes or [[], []]
+    for i, blob in prefix:
+        if blob is None:
+            subprocess.run(notrunc(i))
+        else:
+            write_blob(disk, blob)
+    layout = plan_partitions(disk, partition_table, has_uefi)
+    errors = layout_errors(
+        layout, [i[1] for i in prefix if i[1]], [i[1] for i in suffix if i[1]]
+    )
+    for i in errors:
+        logging.error(i)
+    if errors:
+        exit(1)
+    write_partitions(disk, layout)
+    logging.info("\n" + layout_table(layout))
+    for i, blob in suffix:
+        if blob is None:
+            subprocess.run(notrunc(i))
+        else:
+            write_blob(disk, blob)
+
+
+@stage
 def partition(disk, fs, img_size, partition_table, split=False, has_uefi=False):
     table = [["Partition", "Start", "End", "Size", "Filesystem"]]
     if has_uefi or not cfg["recreate_part_table"]:
@@ -326,57 +2398,71 @@ def partition(disk, fs, img_size, partition_table, split=False, has_uefi=False):
         )
     )
 
-    if not split:
-        for i in cfg["partition_prefix"](config_dir, disk):
-            subprocess.run(i)
+    offline = cfg["img_backend"] == "offline"
+    if cfg["partitioner"] == "native":
+        native_partition(disk, partition_table, has_uefi, split)
+        if args.ci and not offline:
+            subprocess.run(["kpartx", "-avf", disk])
+        elif not offline:
+            subprocess.run(["blockdev", "--rereadpt", disk])
+    else:
+        if not split:
+            for i in cfg["partition_prefix"](config_dir, disk):
+                blob = blob_write(i, disk) if isinstance(i, dict) else None
+                if blob is not None:
+                    write_blob(disk, blob)
+                else:
+                    subprocess.run(notrunc(i) if offline else i)
 
-    if args.ci:
-        subprocess.run(["kpartx", "-avf", disk])
+        if args.ci and not offline:
+            subprocess.run(["kpartx", "-avf", disk])
 
-    logging.info(f"Full command: {prtd_cmd}")
-    subprocess.run(prtd_cmd)
+        logging.info(f"Full command: {prtd_cmd}")
+        subprocess.run(prtd_cmd)
 
-    if args.ci:
-        subprocess.run(["kpartx", "-avf", disk])
+        if args.ci and not offline:
+            subprocess.run(["kpartx", "-avf", disk])
 
+        if not split:
+            for i in cfg["partition_suffix"](config_dir, disk):
+                blob = blob_write(i, disk) if isinstance(i, dict) else None
+                if blob is not None:
+                    write_blob(disk, blob)
+                else:
+                    subprocess.run(notrunc(i) if offline else i)
     if not split:
-        for i in cfg["partition_suffix"](config_dir, disk):
-            subprocess.run(i)
+        # --variant-of checks its partitioning against this
+        with open(cfg["images"].get(disk, disk) + ".layout.json", "w") as f:
+            json.dump(layout_record(partition_table, has_uefi), f)
 
     if not os.path.exists(mnt_dir):
         os.mkdir(mnt_dir)
 
-    # idf = "p3" if has_uefi else ("p2" if not split else "p1")
-    if has_uefi:
-        idf="p3"
-    elif cfg["uboot_parts"]:
-        idf="p" + str(2 + cfg["uboot_parts"])
-    elif not split:
-        idf="p2"
-    else:
-        idf="p1"
+    idf = root_idf(split, has_uefi)
+    cfg["root_part"] = disk + idf
+    if offline:
+        stage_offline(disk, fs, idf, partition_table, has_uefi)
+        logging.info("Partitioned successfully")
+        return
     subprocess.run(["lsblk"])
+    root_uuid = fs_uuid(disk, idf)
+    fs_table[disk + idf] = {"UUID": root_uuid, "TYPE": fs}
     if fs == "ext4":
-        subprocess.run("mkfs.ext4 -F -L PRIMARY " + disk + idf, shell=True)
-        subprocess.run("mount " + disk + idf + " " + mnt_dir, shell=True)
+        subprocess.run(
+            "mkfs.ext4 -F -L PRIMARY -U " + root_uuid + " " + disk + idf, shell=True
+        )
+        mount_root(disk + idf, fs)
         os.mkdir(mnt_dir + "/boot")
         if has_uefi:
             os.mkdir(mnt_dir + "/boot/efi")
     elif fs == "btrfs":
         p2 = disk + idf + " "
-        subprocess.run("mkfs.btrfs -f -L ROOTFS " + p2, shell=True)
+        subprocess.run("mkfs.btrfs -f -L ROOTFS -U " + root_uuid + " " + p2, shell=True)
         subprocess.run("mount -t btrfs -o compress=zstd " + p2 + mnt_dir, shell=True)
         for i in ["/@", "/@home", "/@log", "/@pkg", "/@.snapshots"]:
             subprocess.run("btrfs su cr " + mnt_dir + i, shell=True)
         subprocess.run("umount " + p2, shell=True)
-        subprocess.run(
-            "mount -t btrfs -o compress=zstd,subvol=@ " + p2 + mnt_dir, shell=True
-        )
-        os.mkdir(mnt_dir + "/home")
-        subprocess.run(
-            "mount -t btrfs -o compress=zstd,subvol=@home " + p2 + mnt_dir + "/home",
-            shell=True,
-        )
+        mount_root(disk + idf, fs)
         os.mkdir(mnt_dir + "/boot")
         if has_uefi:
             os.mkdir(mnt_dir + "/boot/efi")
@@ -384,6 +2470,35 @@ def partition(disk, fs, img_size, partition_table, split=False, has_uefi=False):
     logging.info("Partitioned successfully")
 
 
+def root_idf(split: bool, has_uefi: bool) -> str:
+    # idf = "p3" if has_uefi else ("p2" if not split else "p1")
+    if has_uefi:
+        idf="p3"
+    elif cfg["uboot_parts"]:
+        idf="p" + str(2 + cfg["uboot_parts"])
+    elif not split:
+        idf="p2"
+    else:
+        idf="p1"
+    return idf
+
+
+def mount_root(part: str, fs: str) -> None:
+    if fs == "ext4":
+        subprocess.run("mount " + part + " " + mnt_dir, shell=True)
+        return
+    p2 = part + " "
+    subprocess.run(
+        "mount -t btrfs -o compress=zstd,subvol=@ " + p2 + mnt_dir, shell=True
+    )
+    os.makedirs(mnt_dir + "/home", exist_ok=True)
+    subprocess.run(
+        "mount -t btrfs -o compress=zstd,subvol=@home " + p2 + mnt_dir + "/home",
+        shell=True,
+    )
+
+
+@stage
 def create_fstab(fs, ldev, ldev_alt=None, simple_vfat=False) -> None:
     if cfg["has_uefi"]:
         id1 = get_fsline(ldev + "p2") # EFI
@@ -467,6 +2582,7 @@ def create_fstab(fs, ldev, ldev_alt=None, simple_vfat=False) -> None:
             )
 
 
+@stage
 def copy_skel_to_users() -> None:
     non_root_users = []
 
@@ -479,143 +2595,1362 @@ def copy_skel_to_users() -> None:
             username = parts[0]
             uid = int(parts[2])
 
-            if (
-                uid != 0 and uid > 1000 and uid < 2000
-            ):  # Check if the user ID is not root (UID 0)
-                non_root_users.append(username)
+            if (
+                uid != 0 and uid > 1000 and uid < 2000
+            ):  # Check if the user ID is not root (UID 0)
+                non_root_users.append(username)
+
+    except FileNotFoundError:
+        print("Error: No passwd file not found.")
+
+    for user in non_root_users:
+        logging.info("Copying skel to " + user)
+        os.makedirs(cfg["install_dir"] + "/home/" + user, exist_ok=True)
+        copy_tree(
+            cfg["install_dir"] + "/etc/skel",
+            cfg["install_dir"] + "/home/" + user,
+            manifest=False,
+        )
+
+    with open(cfg["install_dir"] + "/version", "w") as f:
+        f.write("BredOS " + cfg["img_version"] + "\n")
+
+
+@stage
+def u_boot_update(mnt_dir: str, configtxt: str) -> None:
+    logging.info("Updating U-Boot")
+    if not os.path.exists(mnt_dir + "/etc/default/"):
+        os.makedirs(mnt_dir + "/etc/default/")
+    with open(mnt_dir + "/etc/default/u-boot", "w") as f:
+        f.write(configtxt)
+    run_chroot_cmd(mnt_dir, ["u-boot-update"])
+
+@stage
+def create_extlinux_conf(mnt_dir, configtxt, cmdline, ldev) -> None:
+    if not os.path.exists(mnt_dir + "/boot/extlinux"):
+        os.mkdir(mnt_dir + "/boot/extlinux")
+        subprocess.run(["touch", mnt_dir + "/boot/extlinux/extlinux.conf"])
+    with open(mnt_dir + "/boot/extlinux/extlinux.conf", "w") as f:
+        f.write(configtxt)
+        # add append root=UUID=... + cmdline
+        if "partition_table_root" in cfg:
+            root_uuid = get_fsline(ldev + "p1")
+        elif cfg["uboot_parts"]:
+            root_uuid = get_fsline(ldev + "p" + str(2 + cfg["uboot_parts"]))
+        else:
+            root_uuid = get_fsline(ldev + "p2")
+        f.write("    append root=" + root_uuid + " " + cmdline)
+        if cfg["configtxt_suffix"] is not None:
+            f.write(cfg["configtxt_suffix"])
+
+
+def run_chroot_cmd(work_dir: str, cmd: list) -> None:
+    subprocess.run(["arch-chroot", work_dir] + cmd)
+
+
+@stage
+def grub_install(mnt_dir: str, arch: str ="arm64-efi") -> None:
+    grubfile = open(mnt_dir + "/etc/default/grub")
+    grubconf = grubfile.read()
+    grubfile.close()
+    grubcmdl = cfg["grubcmdl"]
+    grubdtb = cfg["grubdtb"]
+    grubconf = grubconf.replace('GRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet"', f'GRUB_CMDLINE_LINUX_DEFAULT="{grubcmdl}"')
+    if grubdtb:
+        grubconf = grubconf.replace('# GRUB_DTB="path_to_dtb_file"', f'GRUB_DTB="{grubdtb}"')
+    grubfile = open(mnt_dir + "/etc/default/grub", "w")
+    grubfile.write(grubconf)
+    grubfile.close()
+    run_chroot_cmd(mnt_dir, ["grub-install", f"--target={arch}", "--efi-directory=/boot/efi", "--removable", "--bootloader-id=BredOS"])
+    if not os.path.exists(mnt_dir + "/boot/grub"):
+        os.mkdir(mnt_dir + "/boot/grub")
+    run_chroot_cmd(mnt_dir, ["grub-mkconfig", "-o", "/boot/grub/grub.cfg"])
+
+
+def subvolumes_under(path: str) -> list:
+    # Subvolume roots have inode 256, rm cannot remove read-only ones.
+    # Mounted images are not ours to delete from
+    found = []
+    for root, dirs, _ in os.walk(path):
+        for i in list(dirs):
+            if os.path.ismount(os.path.join(root, i)):
+                dirs.remove(i)
+            elif os.lstat(os.path.join(root, i)).st_ino == 256:
+                found.append(os.path.join(root, i))
+                dirs.remove(i)
+    return found
+
+
+def cleanup(work_dir: str) -> None:
+    logging.info("Cleaning up")
+    if fs_type(work_dir) == "btrfs":
+        for i in subvolumes_under(work_dir):
+            subprocess.run(["btrfs", "subvolume", "delete", i])
+    subprocess.run(["rm", "-rf", work_dir])
+
+
+@stage
+def unmount(img_backend: str, mnt_dir: str, ldev: str, ldev_alt: str = None) -> None:
+    logging.info("Unmounting!")
+    if img_backend == "offline":
+        assemble_offline()
+        return
+    if img_backend == "loop":
+        trim_mounts(mnt_dir)
+    subprocess.run(["umount", "-R", mnt_dir])
+    shrink = None
+    if args.shrink and img_backend == "loop":
+        for dev in [ldev, ldev_alt]:
+            if dev is not None and cfg.get("root_part", "").startswith(dev + "p"):
+                fs_bytes = shrink_rootfs(cfg["root_part"], cfg["fs"])
+                if fs_bytes:
+                    shrink = (cfg["images"][dev], cfg["root_part"][len(dev) + 1 :])
+    if img_backend == "loop" and not args.ci:
+        subprocess.run(["losetup", "-d", ldev])
+        if ldev_alt is not None:
+            subprocess.run(["losetup", "-d", ldev_alt])
+    elif img_backend == "loop" and args.ci:
+        subprocess.run(["kpartx", "-d", ldev])
+        subprocess.run(["losetup", "-d", ldev])
+        if ldev_alt is not None:
+            subprocess.run(["kpartx", "-d", ldev_alt])
+            subprocess.run(["losetup", "-d", ldev_alt])
+        subprocess.run(["unlink", ldev])
+    for dev in [ldev, ldev_alt]:
+        if dev is not None:
+            cfg["images"].pop(dev, None)
+            cfg["images"].pop(dev.replace("/dev/mapper/", "/dev/"), None)
+            # The loop device can be reused, forget what was probed on it
+            for part in [i for i in fs_table if re.match(re.escape(dev) + "p[0-9]", i)]:
+                del fs_table[part]
+    if shrink is not None:
+        shrink_image(shrink[0], shrink[1], fs_bytes)
+
+
+def notrunc(cmd: list) -> list:
+    # dd into a plain image file would cut it off after the written blob
+    if cmd[0] != "dd":
+        return cmd
+    for n, i in enumerate(cmd):
+        if i.startswith("conv="):
+            return cmd[:n] + [i + ",notrunc"] + cmd[n + 1 :]
+    return cmd + ["conv=notrunc"]
+
+
+# Boot filesystems mkfs_offline can build from a directory
+OFFLINE_BOOT_TYPES = ["fat32", "ext2", "ext3", "ext4"]
+
+
+def boot_fs_type(partition_table: dict) -> str:
+    # A fat32 partition is the boot partition, otherwise the one before root
+    types = [i[3] for i in partition_table.values() if i[3] != "NONE"]
+    if "fat32" in types:
+        return "fat32"
+    return types[-2] if len(types) > 1 else None
+
+
+def stage_offline(disk, fs, idf, partition_table, has_uefi) -> None:
+    # mnt_dir becomes a plain directory, filesystems are built at unmount
+    os.makedirs(mnt_dir + "/boot/efi" if has_uefi else mnt_dir + "/boot", exist_ok=True)
+    if fs == "btrfs":
+        os.makedirs(mnt_dir + "/home", exist_ok=True)
+    cfg.setdefault("offline_parts", []).append((disk, idf, fs, mnt_dir))
+    fs_table[disk + idf] = {"UUID": fs_uuid(disk, idf), "TYPE": fs}
+    boot_type = boot_fs_type(partition_table)
+    if boot_type is None:
+        return
+    if has_uefi:
+        boot = "p2"
+    elif cfg["uboot_parts"]:
+        boot = "p" + str(1 + cfg["uboot_parts"])
+    else:
+        boot = "p1"
+    boot_dir = mnt_dir + ("/boot/efi" if has_uefi else "/boot")
+    if boot_type == "fat32":
+        volid = uuid.UUID(fs_uuid(disk, boot)).hex[:8].upper()
+        fs_table[disk + boot] = {"UUID": volid[:4] + "-" + volid[4:], "TYPE": "vfat"}
+        cfg["offline_parts"].insert(0, (disk, boot, "vfat", boot_dir))
+    else:
+        fs_table[disk + boot] = {"UUID": fs_uuid(disk, boot), "TYPE": boot_type}
+        cfg["offline_parts"].insert(0, (disk, boot, boot_type, boot_dir))
+
+
+def mkfs_offline(fs_img: str, fs: str, src: str, uuid_: str) -> None:
+    if fs == "vfat":
+        subprocess.run(
+            ["mkfs.vfat", "-F", "32", "-i", uuid_.replace("-", ""), fs_img],
+            check=True,
+        )
+        if os.listdir(src):
+            subprocess.run(
+                ["mcopy", "-s", "-p", "-m", "-Q", "-i", fs_img]
+                + [src + "/" + i for i in os.listdir(src)]
+                + ["::"],
+                check=True,
+            )
+    elif fs in ["ext2", "ext3", "ext4"]:
+        label = "PRIMARY" if src.rstrip("/") == mnt_dir.rstrip("/") else "BOOT"
+        subprocess.run(
+            ["mkfs." + fs, "-F", "-L", label, "-U", uuid_, "-d", src, fs_img],
+            check=True,
+        )
+    elif fs == "btrfs":
+        # Same subvolume layout partition() creates on a loop device
+        layout = work_dir + "offline/layout/"
+        os.makedirs(layout)
+        os.rename(src, layout + "@")
+        os.rename(layout + "@/home", layout + "@home")
+        os.mkdir(layout + "@/home")
+        subvols = []
+        for i in ["@", "@home", "@log", "@pkg", "@.snapshots"]:
+            os.makedirs(layout + i, exist_ok=True)
+            subvols += ["--subvol", i]
+        subprocess.run(
+            ["mkfs.btrfs", "-f", "-L", "ROOTFS", "-U", uuid_, "--rootdir", layout]
+            + subvols
+            + [fs_img],
+            check=True,
+        )
+
+
+def assemble_offline() -> None:
+    # Build every filesystem from its directory and write it at its offset
+    subprocess.run(["rm", "-rf", work_dir + "offline/"])
+    os.makedirs(work_dir + "offline/")
+    for disk, idf, fs, src in cfg["offline_parts"]:
+        table = read_partitions(disk)
+        part = [i for i in table["partitions"] if i["number"] == int(idf[1:])][0]
+        size = (part["end"] - part["start"] + 1) * SECTOR
+        fs_img = cfg["img_dir"] + "offline-" + idf + "." + fs
+        if src.rstrip("/") != mnt_dir.rstrip("/"):
+            # Pull the boot files out of the root tree, the partition is separate
+            os.rename(src, work_dir + "offline/" + idf + ".d")
+            os.mkdir(src)
+            src = work_dir + "offline/" + idf + ".d"
+            # The small boot filesystem is built in RAM when it fits
+            if cfg["stage_dir"] and size < mem_available() // 4:
+                os.makedirs(cfg["stage_dir"], exist_ok=True)
+                fs_img = cfg["stage_dir"] + idf + "." + fs
+                logging.info("Placement: " + fs + " staged in " + cfg["stage_dir"])
+        with open(fs_img, "wb") as f:
+            f.truncate(size)
+        logging.info("Creating " + fs + " for " + disk + idf + " from " + src)
+        mkfs_offline(fs_img, fs, src, fs_table[disk + idf]["UUID"])
+        with open(fs_img, "rb") as fsrc, open(disk, "r+b") as fdst:
+            for first, last in image_ranges(fs_img):
+                start = first * BMAP_BLOCK_SIZE
+                fsrc.seek(start)
+                fdst.seek(part["start"] * SECTOR + start)
+                left = (last - first + 1) * BMAP_BLOCK_SIZE
+                for chunk in iter(lambda: fsrc.read(min(CHUNK_SIZE, left)), b""):
+                    fdst.write(chunk)
+                    left -= len(chunk)
+        os.remove(fs_img)
+    subprocess.run(["rm", "-rf", work_dir + "offline/"])
+    logging.info("Filesystems written into the image")
+
+
+def trim_mounts(mnt_dir: str) -> None:
+    # Discarded blocks become holes in the image file behind the loop device
+    with open("/proc/self/mountinfo") as f:
+        mounts = [i.split()[4] for i in f.readlines()]
+    for i in mounts:
+        if i == mnt_dir.rstrip("/") or i.startswith(mnt_dir):
+            subprocess.run(["fstrim", "-v", i])
+
+
+def shrink_rootfs(part: str, fs: str) -> int:
+    # Shrink to the minimum plus headroom, returns the new size in bytes
+    logging.info("Shrinking " + fs + " on " + part)
+    headroom = args.headroom * 1024**2
+    try:
+        if fs == "ext4":
+            if subprocess.run(["e2fsck", "-fy", part]).returncode > 1:
+                raise subprocess.CalledProcessError(1, "e2fsck")
+            out = subprocess.check_output(["resize2fs", "-P", part]).decode("utf-8")
+            min_blocks = int(out.split()[-1])
+            out = subprocess.check_output(["dumpe2fs", "-h", part]).decode("utf-8")
+            block_size = 0
+            for line in out.splitlines():
+                if line.startswith("Block size:"):
+                    block_size = int(line.split()[-1])
+            if not block_size:
+                raise ValueError("no block size in dumpe2fs output")
+            blocks = min_blocks + headroom // block_size
+            subprocess.run(["resize2fs", part, str(blocks)], check=True)
+            return blocks * block_size
+        shrink_dir = work_dir + "shrink/"
+        os.makedirs(shrink_dir, exist_ok=True)
+        subprocess.run(["mount", "-t", "btrfs", part, shrink_dir], check=True)
+        try:
+            out = subprocess.check_output(
+                ["btrfs", "inspect-internal", "min-dev-size", shrink_dir]
+            ).decode("utf-8")
+            size = int(out.split()[0]) + headroom
+            subprocess.run(
+                ["btrfs", "filesystem", "resize", str(size), shrink_dir], check=True
+            )
+        finally:
+            subprocess.run(["umount", shrink_dir])
+        return size
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logging.warning("Could not shrink " + part + ": " + str(e))
+        return 0
+
+
+def shrink_image(img: str, partnum: str, fs_bytes: int) -> None:
+    table = json.loads(subprocess.check_output(["sfdisk", "-J", img]))
+    table = table["partitiontable"]
+    sector = table.get("sectorsize", 512)
+    last = max(table["partitions"], key=lambda i: i["start"])
+    if last["node"][len(img) :] != partnum:
+        logging.warning("Root partition is not the last one, not shrinking " + img)
+        return
+    # Keep the partition end MiB aligned
+    sectors = -(-fs_bytes // (1024**2)) * (1024**2) // sector
+    subprocess.run(
+        ["sfdisk", "--no-reread", "--no-tell-kernel", "-N", partnum, img],
+        input=(str(last["start"]) + "," + str(sectors) + "\n").encode("utf-8"),
+        check=True,
+    )
+    end = (last["start"] + sectors) * sector
+    if table["label"] == "gpt":
+        end += 33 * sector
+    os.truncate(img, end)
+    if table["label"] == "gpt":
+        subprocess.run(["sfdisk", "--relocate", "gpt-bak-std", img], check=True)
+    logging.info("Shrunk " + img + " to " + str(int(end / 1024**2)) + "M")
+
+
+def codec_cmd(codec: str) -> list:
+    if codec == "xz":
+        level = 1 if args.fast_forward else args.xz_level
+        return ["xz", "-" + str(level), "-T0", "-M", "65%", "-c"]
+    elif codec == "zstd":
+        level = 1 if args.fast_forward else args.zstd_level
+        return ["zstd", "-" + str(level), "-T0", "-q", "-c"] + (
+            ["--ultra"] if level > 19 else []
+        )
+    raise ValueError("Unknown codec " + codec)
+
+
+def new_checksums() -> dict:
+    return {i: hashlib.new(i) for i in args.checksums.split(",") if i}
+
+
+def drain_codec(stream, path: str, sums: dict, errors: list) -> None:
+    try:
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+                for i in sums.values():
+                    i.update(chunk)
+                f.write(chunk)
+    except OSError as e:
+        # The codec gets EPIPE instead of blocking the image reader
+        errors.append(e)
+        stream.close()
+
+
+def stop_codecs(procs: list) -> None:
+    # After a failure no codec keeps running and no .part is left behind
+    for name, proc, drain, _ in procs:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        drain.join()
+        if os.path.exists(out_dir + name + ".part"):
+            os.remove(out_dir + name + ".part")
+
+
+def write_checksums(img_name: str, files: dict) -> None:
+    # One sha256sum style sidecar per algorithm, covering every artifact
+    for algo in args.checksums.split(","):
+        if not algo:
+            continue
+        with open(out_dir + img_name + "." + algo, "w") as f:
+            for name, sums in files.items():
+                f.write(sums[algo].hexdigest() + "  " + name + "\n")
+
+
+BMAP_BLOCK_SIZE = 4096
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def image_ranges(img: str) -> list:
+    # Inclusive (first, last) block ranges that hold data, holes are skipped
+    ranges = []
+    with open(img, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            first = start // BMAP_BLOCK_SIZE
+            last = (end - 1) // BMAP_BLOCK_SIZE
+            if ranges and ranges[-1][1] >= first - 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+            else:
+                ranges.append((first, last))
+            pos = end
+    return ranges
+
+
+def image_chunks(img: str, ranges: list, range_sums: list):
+    # Yields (chunk, is_hole), holes are never read, only zeros are handed out
+    zeros = memoryview(bytes(CHUNK_SIZE))
+    size = os.path.getsize(img)
+    pos = 0
+    with open(img, "rb") as f:
+        for first, last in ranges + [(size // BMAP_BLOCK_SIZE + 1, None)]:
+            start = min(first * BMAP_BLOCK_SIZE, size)
+            while pos < start:
+                n = min(CHUNK_SIZE, start - pos)
+                yield zeros[:n], True
+                pos += n
+            if last is None:
+                break
+            end = min((last + 1) * BMAP_BLOCK_SIZE, size)
+            f.seek(pos)
+            range_sum = hashlib.sha256()
+            while pos < end:
+                chunk = f.read(min(CHUNK_SIZE, end - pos))
+                range_sum.update(chunk)
+                yield chunk, False
+                pos += len(chunk)
+            range_sums.append(range_sum.hexdigest())
+
+
+def write_bmap(img: str, bmap: str, ranges: list, range_sums: list) -> None:
+    # bmaptool 2.0 format, the file checksum is taken with the field zeroed
+    size = os.path.getsize(img)
+    blocks = -(-size // BMAP_BLOCK_SIZE)
+    mapped = sum(last - first + 1 for first, last in ranges)
+    lines = [
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        "    <ImageSize> " + str(size) + " </ImageSize>",
+        "    <BlockSize> " + str(BMAP_BLOCK_SIZE) + " </BlockSize>",
+        "    <BlocksCount> " + str(blocks) + " </BlocksCount>",
+        "    <MappedBlocksCount> " + str(mapped) + " </MappedBlocksCount>",
+        "    <ChecksumType> sha256 </ChecksumType>",
+        "    <BmapFileChecksum> " + 64 * "0" + " </BmapFileChecksum>",
+        "    <BlockMap>",
+    ]
+    for (first, last), range_sum in zip(ranges, range_sums):
+        blk = str(first) if first == last else str(first) + "-" + str(last)
+        lines.append('        <Range chksum="' + range_sum + '"> ' + blk + " </Range>")
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    text = "\n".join(lines)
+    checksum = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with open(bmap, "w") as f:
+        f.write(text.replace(64 * "0", checksum, 1))
+    logging.info(
+        "Wrote " + bmap + ", " + str(mapped) + " of " + str(blocks) + " blocks mapped"
+    )
+
+
+@stage
+def compressimage(img_name: str) -> None:
+    # Read the raw image once and feed every codec at the same time
+    with host_slot("compress", args.max_compress), contextlib.ExitStack() as stack:
+        feeds = output_feeds(stack)
+        codecs = args.codecs.split(",")
+        logging.info("Compressing " + img_name + ".img with " + ", ".join(codecs))
+        files = {img_name + ".img": new_checksums()}
+        procs = []
+        stack.callback(stop_codecs, procs)
+        for codec in codecs:
+            name = img_name + ".img." + ("zst" if codec == "zstd" else codec)
+            files[name] = new_checksums()
+            proc = subprocess.Popen(
+                codec_cmd(codec), stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            errors = []
+            drain = threading.Thread(
+                target=drain_codec,
+                args=(proc.stdout, out_dir + name + ".part", files[name], errors),
+            )
+            drain.start()
+            procs.append((name, proc, drain, errors))
+
+        img = cfg["img_dir"] + img_name + ".img"
+        ranges = image_ranges(img)
+        range_sums = []
+        broken = None
+        try:
+            for chunk, hole in image_chunks(img, ranges, range_sums):
+                for i in files[img_name + ".img"].values():
+                    i.update(chunk)
+                for _, proc, _, _ in procs:
+                    proc.stdin.write(chunk)
+                for i in feeds.values():
+                    i.feed(chunk, hole)
+        except BrokenPipeError as e:
+            # A codec or its output went away, the checks below say which
+            broken = e
+        for _, proc, _, _ in procs:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for name, proc, drain, errors in procs:
+            drain.join()
+            if errors:
+                logging.error("Cannot write " + out_dir + name + ": " + str(errors[0]))
+                raise errors[0]
+            if proc.wait():
+                logging.error(proc.args[0] + " failed writing " + out_dir + name)
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        if broken:
+            raise broken
+        for name, proc, drain, errors in procs:
+            os.rename(out_dir + name + ".part", out_dir + name)
+            stage_bytes(bytes_out=os.path.getsize(out_dir + name))
+            logging.info("Wrote " + out_dir + name)
+        stage_bytes(bytes_in=os.path.getsize(img))
+        write_checksums(img_name, files)
+        if not args.no_bmap:
+            write_bmap(img, out_dir + img_name + ".img.bmap", ranges, range_sums)
+        if "chunks" in feeds:
+            chunkimage(img_name, feeds["chunks"].close())
+        if "hashes" in feeds:
+            hashimage(img_name, feeds["hashes"].close())
+        subprocess.run(["chmod", "-R", "777", out_dir])
+        logging.info("Compressed " + img_name + ".img")
+
+
+def reflink(src: str, dst: str) -> bool:
+    # Shares all extents on btrfs and XFS, False where that is not possible
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def clone_file(src: str, dst: str) -> str:
+    if reflink(src, dst):
+        return "reflink"
+    # copy_file_range still shares extents on NFS and some others and keeps
+    # the data in the kernel elsewhere, holes stay holes
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        fdst.truncate(size)
+        for first, last in image_ranges(src):
+            offset = first * BMAP_BLOCK_SIZE
+            left = min((last + 1) * BMAP_BLOCK_SIZE, size) - offset
+            while left > 0:
+                try:
+                    n = os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), left, offset, offset
+                    )
+                except OSError as e:
+                    if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL]:
+                        raise
+                    fdst.seek(offset)
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, left)
+                if not n:
+                    break
+                offset += n
+                left -= n
+    return "copy_file_range"
+
+
+@stage
+def copyimage(img_name: str) -> None:
+    logging.info("Copying " + img_name + ".img")
+    # Copy only the data ranges, the output keeps the holes of the image
+    img = cfg["img_dir"] + img_name + ".img"
+    dest = out_dir + img_name + ".img"
+    files = {img_name + ".img": new_checksums()}
+    ranges = image_ranges(img)
+    range_sums = []
+    # A reflink leaves only the checksums to do
+    cloned = reflink(img, dest + ".part")
+    stack = contextlib.ExitStack()
+    with stack, open(dest + ".part", "r+b" if cloned else "wb") as f:
+        feeds = output_feeds(stack)
+        for chunk, hole in image_chunks(img, ranges, range_sums):
+            for i in files[img_name + ".img"].values():
+                i.update(chunk)
+            for i in feeds.values():
+                i.feed(chunk, hole)
+            if cloned:
+                continue
+            if hole:
+                f.seek(len(chunk), os.SEEK_CUR)
+            else:
+                f.write(chunk)
+        if not cloned:
+            f.truncate()
+        if "chunks" in feeds:
+            chunkimage(img_name, feeds["chunks"].close())
+        hashes = feeds["hashes"].close() if "hashes" in feeds else None
+    os.rename(dest + ".part", dest)
+    stage_bytes(os.path.getsize(img), os.path.getsize(img))
+    write_checksums(img_name, files)
+    if not args.no_bmap:
+        write_bmap(img, dest + ".bmap", ranges, range_sums)
+    if hashes is not None:
+        hashimage(img_name, hashes)
+    subprocess.run(["chmod", "-R", "777", out_dir])
+    logging.info("Copied " + img_name + ".img")
+
+
+# Content-defined chunking: a chunk may end after an anchor byte when the
+# crc32 of the 32 bytes up to it ends in 8 zero bits. Cuts depend only on
+# nearby content, so they line up again right after an insert. Finding the
+# anchors with bytes.find keeps the per-byte work in C, a rolling hash
+# would need a Python loop per byte.
+CDC_MIN = 16 * 1024
+CDC_MAX = 256 * 1024
+CDC_ANCHOR = b"\x8b"
+# Segments are chunked in parallel, cuts at their edges are fixed offsets
+CDC_SEGMENT = 64 * 1024 * 1024
+
+
+def cut_point(data: bytes, start: int, end: int) -> int:
+    if end - start <= CDC_MIN:
+        return end
+    limit = min(end, start + CDC_MAX)
+    pos = data.find(CDC_ANCHOR, start + CDC_MIN, limit)
+    while pos >= 0:
+        if not zlib.crc32(data[pos - 31 : pos + 1]) & 0xFF:
+            return pos + 1
+        pos = data.find(CDC_ANCHOR, pos + 1, limit)
+    return limit
+
+
+def chunk_path(store: str, digest: str) -> str:
+    return store + "/" + digest[:4] + "/" + digest + ".cnk"
+
+
+def chunk_segment(img: str, start: int, end: int, store: str) -> list:
+    with open(img, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return cut_segment(start, data, store)
+
+
+def cut_segment(start: int, data: bytes, store: str) -> list:
+    # Runs in a worker process, new chunks are stored zlib compressed
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        cut = cut_point(data, pos, len(data))
+        digest = hashlib.sha256(data[pos:cut]).hexdigest()
+        stored = 0
+        if store is not None and not os.path.exists(chunk_path(store, digest)):
+            path = chunk_path(store, digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            packed = zlib.compress(data[pos:cut], 6)
+            with open(path + "." + str(os.getpid()), "wb") as f:
+                f.write(packed)
+            os.replace(path + "." + str(os.getpid()), path)
+            stored = len(packed)
+        chunks.append([start + pos, cut - pos, digest, stored])
+        pos = cut
+    return chunks
+
+
+def data_segments(img: str, step: int) -> list:
+    # (start, stop) of the data in the image, also cut at multiples of step
+    size = os.path.getsize(img)
+    segments = []
+    for first, last in image_ranges(img):
+        start = first * BMAP_BLOCK_SIZE
+        end = min((last + 1) * BMAP_BLOCK_SIZE, size)
+        while start < end:
+            stop = min(end, (start // step + 1) * step)
+            segments.append((start, stop))
+            start = stop
+    return segments
+
+
+def chunk_image(img: str, store: str = None) -> dict:
+    # Index of the whole image, holes are entries without a chunk
+    segments = data_segments(img, CDC_SEGMENT)
+    chunks = []
+    with ProcessPoolExecutor() as pool:
+        for i in pool.map(
+            chunk_segment,
+            [img] * len(segments),
+            [i[0] for i in segments],
+            [i[1] for i in segments],
+            [store] * len(segments),
+        ):
+            chunks += i
+    return chunk_index(img, chunks)
+
+
+def chunk_index(img: str, chunks: list) -> dict:
+    # Holes between the chunks become entries without a digest
+    size = os.path.getsize(img)
+    index = []
+    pos = 0
+    for i in chunks:
+        if i[0] > pos:
+            index.append([pos, i[0] - pos, None, 0])
+        index.append(i)
+        pos = i[0] + i[1]
+    if pos < size:
+        index.append([pos, size - pos, None, 0])
+    return {"image": os.path.basename(img), "size": size, "chunks": index}
+
+
+class SegmentFeed:
+    # Cuts the image_chunks() stream of the output stage into the segments
+    # data_segments() gives and runs work(start, data) on each in a pool,
+    # so the hash manifest and chunk index need no read of their own
+    def __init__(self, step: int, pool, workers: int, work):
+        self.step = step
+        self.pool = pool
+        self.workers = workers
+        self.work = work
+        self.pos = 0
+        self.start = 0
+        self.buf = bytearray()
+        self.results = []
+
+    def feed(self, chunk, hole: bool) -> None:
+        if hole:
+            self.flush()
+            self.pos += len(chunk)
+            return
+        view = memoryview(chunk)
+        while view:
+            n = min(len(view), self.step - self.pos % self.step)
+            if not self.buf:
+                self.start = self.pos
+            self.buf += view[:n]
+            self.pos += n
+            view = view[n:]
+            if not self.pos % self.step:
+                self.flush()
+
+    def flush(self) -> None:
+        if not self.buf:
+            return
+        # Only a few segments wait in memory when the pool falls behind
+        pending = [i[2] for i in self.results if not i[2].done()]
+        if len(pending) >= 2 * self.workers:
+            pending[0].result()
+        future = self.pool.submit(self.work, self.start, bytes(self.buf))
+        self.results.append((self.start, len(self.buf), future))
+        self.buf = bytearray()
+
+    def close(self) -> list:
+        # (start, length, result) of every segment
+        self.flush()
+        return [(start, length, i.result()) for start, length, i in self.results]
+
+
+def output_feeds(stack) -> dict:
+    # Work on the raw image riding along with the output stage's read
+    feeds = dict()
+    if args.chunk_store:
+        workers = os.cpu_count() or 1
+        # Forked workers would hold the codec stdin pipes open
+        forkserver = multiprocessing.get_context("forkserver")
+        pool = stack.enter_context(ProcessPoolExecutor(workers, forkserver))
+        work = functools.partial(cut_segment, store=abspath(args.chunk_store))
+        feeds["chunks"] = SegmentFeed(CDC_SEGMENT, pool, workers, work)
+    if not args.no_hashes:
+        workers = max(args.hash_jobs, 1)
+        pool = stack.enter_context(ThreadPoolExecutor(workers))
+        feeds["hashes"] = SegmentFeed(HASH_CHUNK, pool, workers, segment_digest)
+    return feeds
+
+
+@stage
+def chunkimage(img_name: str, segments: list = None) -> None:
+    # Chunk store plus index next to the image, see --reassemble. The
+    # output stages pass the segments they chunked while reading the image
+    store = abspath(args.chunk_store)
+    img = cfg["img_dir"] + img_name + ".img"
+    if segments is None:
+        logging.info("Chunking " + img_name + ".img into " + store)
+        index = chunk_image(img, store)
+    else:
+        index = chunk_index(img, [j for i in segments for j in i[2]])
+    chunks = [i for i in index["chunks"] if i[2] is not None]
+    stored = sum(1 for i in chunks if i[3])
+    stored_bytes = sum(i[3] for i in chunks)
+    stage_bytes(sum(i[1] for i in chunks), stored_bytes)
+    for i in index["chunks"]:
+        del i[3]
+    os.makedirs(store + "/indexes", exist_ok=True)
+    previous = sorted(
+        (i for i in os.scandir(store + "/indexes") if i.name != img_name + ".json"),
+        key=lambda i: i.stat().st_mtime,
+    )
+    for path in [
+        out_dir + img_name + ".img.chunks.json",
+        store + "/indexes/" + img_name + ".json",
+    ]:
+        with open(path + ".part", "w") as f:
+            json.dump(index, f)
+        os.rename(path + ".part", path)
+    logging.info(
+        str(len(chunks))
+        + " chunks, "
+        + str(stored)
+        + " new in the store ("
+        + str(stored_bytes // 1024**2)
+        + " MiB)"
+    )
+    if previous:
+        with open(previous[-1].path) as f:
+            known = set(i[2] for i in json.load(f)["chunks"])
+        shared = [i for i in chunks if i[2] in known]
+        logging.info(
+            str(len(shared))
+            + " of "
+            + str(len(chunks))
+            + " chunks ("
+            + str(sum(i[1] for i in shared) // 1024**2)
+            + " of "
+            + str(sum(i[1] for i in chunks) // 1024**2)
+            + " MiB) are shared with "
+            + previous[-1].name[: -len(".json")]
+        )
+
+
+def read_chunk(store: str, digest: str) -> bytes:
+    if store.startswith(("http://", "https://")):
+        with urllib.request.urlopen(chunk_path(store, digest)) as r:
+            data = zlib.decompress(r.read())
+    else:
+        with open(chunk_path(store, digest), "rb") as f:
+            data = zlib.decompress(f.read())
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError("Chunk " + digest + " is corrupt")
+    return data
+
+
+def reassemble(index_path: str) -> int:
+    # Rebuild an image from its index, taking every chunk the --seed images
+    # already have from them and only the rest from --chunk-store
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt=LOGGING_DATE_FORMAT,
+        encoding="utf-8",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    with open(index_path) as f:
+        index = json.load(f)
+    seeds = dict()
+    for seed in args.seed or []:
+        if os.path.isfile(seed + ".chunks.json"):
+            with open(seed + ".chunks.json") as f:
+                seed_index = json.load(f)
+        else:
+            logging.info("Chunking seed " + seed)
+            seed_index = chunk_image(seed)
+        for offset, length, digest in (i[:3] for i in seed_index["chunks"]):
+            if digest is not None:
+                seeds[digest] = (seed, offset, length)
+    dest = out_dir + index["image"]
+    chunks = [i for i in index["chunks"] if i[2] is not None]
+    from_seed = from_store = 0
+
+    def fetch(chunk):
+        if chunk[2] in seeds:
+            seed, offset, length = seeds[chunk[2]]
+            with open(seed, "rb") as s:
+                s.seek(offset)
+                data = s.read(length)
+            if hashlib.sha256(data).hexdigest() == chunk[2]:
+                return data, True
+        if args.chunk_store is None:
+            raise ValueError("Chunk " + chunk[2] + " is in no seed, set --chunk-store")
+        return read_chunk(args.chunk_store, chunk[2]), False
+
+    if os.path.exists(out_dir.rstrip("/")) and not os.path.isdir(out_dir):
+        logging.error("Output directory " + out_dir + " is not a directory")
+        return 1
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        with open(dest + ".part", "wb") as f, ThreadPoolExecutor(
+            max(args.fetch_jobs, 1)
+        ) as pool:
+            f.truncate(index["size"])
+            # Batches keep the memory bounded
+            for n in range(0, len(chunks), 256):
+                batch = chunks[n : n + 256]
+                for chunk, (data, seeded) in zip(batch, pool.map(fetch, batch)):
+                    f.seek(chunk[0])
+                    f.write(data)
+                    if seeded:
+                        from_seed += len(data)
+                    else:
+                        from_store += len(data)
+        os.rename(dest + ".part", dest)
+    except (OSError, ValueError, zlib.error) as e:
+        logging.error("Cannot reassemble " + dest + ": " + str(e))
+        return 1
+    finally:
+        # Interrupted or failed, no half written image is left behind
+        if os.path.exists(dest + ".part"):
+            os.remove(dest + ".part")
+    logging.info(
+        "Wrote "
+        + dest
+        + ", "
+        + str(from_seed // 1024**2)
+        + " MiB from seeds, "
+        + str(from_store // 1024**2)
+        + " MiB from the chunk store"
+    )
+    return 0
+
+
+# Fixed size chunks of the hash manifest, small enough to point at the bad
+# region of a flashed card, large enough to keep the manifest short
+HASH_CHUNK = 4 * 1024 * 1024
+
+
+def hash_chunk(fd: int, offset: int, length: int) -> str:
+    # hashlib drops the GIL while hashing, so threads run in parallel
+    return hashlib.sha256(os.pread(fd, length, offset)).hexdigest()
+
+
+def segment_digest(start: int, data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@stage
+def hashimage(img_name: str, segments: list = None) -> None:
+    # sha256 of every HASH_CHUNK of data in the raw image, holes are left
+    # out as bmaptool does not write them, see --verify. The output stages
+    # pass the digests they took while reading the image
+    img = cfg["img_dir"] + img_name + ".img"
+    if segments is None:
+        segments = data_segments(img, HASH_CHUNK)
+        with open(img, "rb") as f, ThreadPoolExecutor(max(args.hash_jobs, 1)) as p:
+            digests = p.map(
+                functools.partial(hash_chunk, f.fileno()),
+                [i[0] for i in segments],
+                [i[1] - i[0] for i in segments],
+            )
+            segments = [(i[0], i[1] - i[0], d) for i, d in zip(segments, digests)]
+    chunks = [list(i) for i in segments]
+    stage_bytes(bytes_in=sum(i[1] for i in chunks))
+    manifest = {
+        "image": img_name + ".img",
+        "size": os.path.getsize(img),
+        "algorithm": "sha256",
+        "chunk_size": HASH_CHUNK,
+        "chunks": chunks,
+    }
+    path = out_dir + img_name + ".img.hashes.json"
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f)
+    os.rename(path + ".part", path)
+    logging.info("Wrote " + path + ", " + str(len(chunks)) + " chunks")
+
+
+def verify(manifest_path: str) -> int:
+    # Check every chunk of the manifest in parallel, stop at the first bad one
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt=LOGGING_DATE_FORMAT,
+        encoding="utf-8",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    target = args.verify_target or os.path.join(
+        os.path.dirname(abspath(manifest_path)), manifest["image"]
+    )
+    chunks = manifest["chunks"]
+    end = max((i[0] + i[1] for i in chunks), default=0)
+    start_time = time.time()
+    stop = threading.Event()
+
+    def check(chunk):
+        # None for chunks skipped after a mismatch
+        if stop.is_set():
+            return None
+        ok = hash_chunk(fd, chunk[0], chunk[1]) == chunk[2]
+        if not ok:
+            stop.set()
+        return ok
+
+    fd = os.open(target, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size < end:
+            logging.error(
+                target + " is " + str(size) + " bytes, the image needs " + str(end)
+            )
+            return 1
+        # Read a freshly flashed device back from the medium, not the cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        logging.info(
+            "Verifying "
+            + target
+            + " against "
+            + manifest_path
+            + ", "
+            + str(len(chunks))
+            + " chunks"
+        )
+        with ThreadPoolExecutor(max(args.hash_jobs, 1)) as pool:
+            results = list(pool.map(check, chunks))
+    finally:
+        os.close(fd)
+    bad = [chunk for chunk, ok in zip(chunks, results) if ok is False]
+    for offset, length, _ in bad:
+        logging.error(
+            "Mismatch at bytes "
+            + str(offset)
+            + "-"
+            + str(offset + length - 1)
+            + " ("
+            + str(offset // 1024**2)
+            + " MiB into "
+            + target
+            + ")"
+        )
+    if bad:
+        return 1
+    total = sum(i[1] for i in chunks)
+    secs = max(time.time() - start_time, 0.001)
+    logging.info(
+        "Verified "
+        + str(total // 1024**2)
+        + " MiB in "
+        + str(round(secs, 1))
+        + "s ("
+        + str(round(total / 1024**2 / secs))
+        + " MiB/s), "
+        + target
+        + " matches"
+    )
+    return 0
+
+
+FICLONE = 0x40049409
+
+
+def copy_metadata(src: str, dst: str, st) -> None:
+    # chown clears setuid bits and file capabilities, so it goes first
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    try:
+        for i in os.listxattr(src, follow_symlinks=False):
+            os.setxattr(
+                dst,
+                i,
+                os.getxattr(src, i, follow_symlinks=False),
+                follow_symlinks=False,
+            )
+    except OSError as e:
+        if e.errno not in [errno.ENOTSUP, errno.EPERM]:
+            raise
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def copy_data(src: str, dst: str, st) -> None:
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            # Shares the extents when both sides are on the same btrfs/XFS
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        left = st.st_size
+        try:
+            while left > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), left)
+                if not n:
+                    break
+                left -= n
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL]:
+                raise
+            while left > 0:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), None, left)
+                if not n:
+                    break
+                left -= n
+
+
+def copy_file(src: str, dst: str, st) -> int:
+    if os.path.lexists(dst) and not stat.S_ISREG(os.lstat(dst).st_mode):
+        if not remove_path(dst):
+            return 0
+    copy_data(src, dst, st)
+    copy_metadata(src, dst, st)
+    return st.st_size
 
-    except FileNotFoundError:
-        print("Error: No passwd file not found.")
 
-    for user in non_root_users:
-        logging.info("Copying skel to " + user)
-        subprocess.run(["mkdir", "-p", cfg["install_dir"] + "/home/" + user])
-        subprocess.run(
-            "cp -r "
-            + cfg["install_dir"]
-            + "/etc/skel/. "
-            + cfg["install_dir"]
-            + "/home/"
-            + user,
-            shell=True,
-        )
+def remove_path(path: str) -> bool:
+    # Directories are never replaced by files, cp refuses that as well
+    if os.path.isdir(path) and not os.path.islink(path):
+        logging.warning("Cannot overwrite directory " + path + " with non-directory")
+        return False
+    os.remove(path)
+    return True
 
-    with open(cfg["install_dir"] + "/version", "w") as f:
-        f.write("BredOS " + cfg["img_version"] + "\n")
 
+def copy_tree(ot: str, to: str, manifest=True) -> None:
+    # Like cp -a ot/. to, files are copied by a pool of workers
+    ot = ot.rstrip("/")
+    to = to.rstrip("/")
+    if not os.path.isdir(ot):
+        # cp failed on a missing overlay dir and the build went on
+        logging.warning("Not copying " + ot + ", it is not a directory")
+        return
+    manifest_path = (
+        work_dir
+        + "copy-"
+        + hashlib.sha256((ot + " " + to).encode("utf-8")).hexdigest()[:16]
+        + ".json"
+    )
+    previous = dict()
+    if manifest and os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    current = dict()
+    dirs = []
+    links = []
+    seen = dict()
+    skipped = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(args.copy_jobs, 1)) as pool:
+        jobs = []
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            for entry in os.scandir(ot + rel):
+                src = entry.path
+                dst = to + rel + "/" + entry.name
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    # Existing directories and symlinks to them are kept, like cp
+                    if os.path.lexists(dst) and not os.path.isdir(dst):
+                        os.remove(dst)
+                    if not os.path.isdir(dst):
+                        os.mkdir(dst)
+                    dirs.append((src, dst, st))
+                    stack.append(rel + "/" + entry.name)
+                elif stat.S_ISREG(st.st_mode):
+                    if st.st_nlink > 1:
+                        if (st.st_dev, st.st_ino) in seen:
+                            links.append((seen[(st.st_dev, st.st_ino)], dst))
+                            continue
+                        seen[(st.st_dev, st.st_ino)] = dst
+                    # ctime and inode change with every write or replace of
+                    # the source, even when the editor keeps size and mtime
+                    sig = [st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid]
+                    sig += [st.st_ctime_ns, st.st_ino]
+                    current[rel + "/" + entry.name] = sig
+                    if previous.get(rel + "/" + entry.name) == sig:
+                        try:
+                            dst_st = os.lstat(dst)
+                            if [dst_st.st_size, dst_st.st_mtime_ns] == sig[:2]:
+                                skipped += 1
+                                continue
+                        except FileNotFoundError:
+                            pass
+                    jobs.append(pool.submit(copy_file, src, dst, st))
+                else:
+                    if os.path.lexists(dst) and not remove_path(dst):
+                        continue
+                    if stat.S_ISLNK(st.st_mode):
+                        os.symlink(os.readlink(src), dst)
+                    elif stat.S_ISSOCK(st.st_mode):
+                        continue
+                    else:
+                        os.mknod(dst, st.st_mode, st.st_rdev)
+                    copy_metadata(src, dst, st)
+        copied = sum(i.result() for i in jobs)
 
-def u_boot_update(mnt_dir: str, configtxt: str) -> None:
-    logging.info("Updating U-Boot")
-    if not os.path.exists(mnt_dir + "/etc/default/"):
-        os.makedirs(mnt_dir + "/etc/default/")
-    with open(mnt_dir + "/etc/default/u-boot", "w") as f:
-        f.write(configtxt)
-    run_chroot_cmd(mnt_dir, ["u-boot-update"])
+    for target, dst in links:
+        if os.path.lexists(dst) and not remove_path(dst):
+            continue
+        os.link(target, dst)
+    # Deepest first so creating entries does not bump the parent mtime again
+    for src, dst, st in reversed(dirs):
+        copy_metadata(src, dst, st)
+    if manifest:
+        with open(manifest_path, "w") as f:
+            json.dump(current, f)
+    stage_bytes(copied, copied)
+    took = max(time.time() - start, 0.001)
+    logging.info(
+        "Copied "
+        + str(len(jobs))
+        + " files ("
+        + str(int(copied / 1024**2))
+        + "M, "
+        + str(int(copied / 1024**2 / took))
+        + "M/s), "
+        + str(len(links))
+        + " hardlinks, "
+        + str(skipped)
+        + " unchanged"
+    )
 
-def create_extlinux_conf(mnt_dir, configtxt, cmdline, ldev) -> None:
-    if not os.path.exists(mnt_dir + "/boot/extlinux"):
-        os.mkdir(mnt_dir + "/boot/extlinux")
-        subprocess.run(["touch", mnt_dir + "/boot/extlinux/extlinux.conf"])
-    with open(mnt_dir + "/boot/extlinux/extlinux.conf", "w") as f:
-        f.write(configtxt)
-        # add append root=UUID=... + cmdline
-        if "partition_table_root" in cfg:
-            root_uuid = get_fsline(ldev + "p1")
-        elif cfg["uboot_parts"]:
-            root_uuid = get_fsline(ldev + "p" + str(2 + cfg["uboot_parts"]))
-        else:
-            root_uuid = get_fsline(ldev + "p2")
-        f.write("    append root=" + root_uuid + " " + cmdline)
-        if cfg["configtxt_suffix"] is not None:
-            f.write(cfg["configtxt_suffix"])
 
+def is_subvolume(path: str) -> bool:
+    # The top directory of every btrfs subvolume is inode 256
+    return fs_type(path) == "btrfs" and os.stat(path).st_ino == 256
 
-def run_chroot_cmd(work_dir: str, cmd: list) -> None:
-    subprocess.run(["arch-chroot", work_dir] + cmd)
 
+def rootfs_subvolume(install_dir: str) -> None:
+    # pacstrap into a subvolume so the rootfs can be snapshotted and sent
+    if is_subvolume(install_dir):
+        return
+    if os.listdir(install_dir):
+        raise OSError(install_dir + " is not empty, can not make it a subvolume")
+    os.rmdir(install_dir)
+    subprocess.run(["btrfs", "subvolume", "create", install_dir], check=True)
+    # Written compressed like in the image, send passes the extents on as is
+    subprocess.run(
+        ["btrfs", "property", "set", install_dir, "compression", "zstd"], check=True
+    )
 
-def grub_install(mnt_dir: str, arch: str ="arm64-efi") -> None:
-    grubfile = open(mnt_dir + "/etc/default/grub")
-    grubconf = grubfile.read()
-    grubfile.close()
-    grubcmdl = cfg["grubcmdl"]
-    grubdtb = cfg["grubdtb"]
-    grubconf = grubconf.replace('GRUB_CMDLINE_LINUX_DEFAULT="loglevel=3 quiet"', f'GRUB_CMDLINE_LINUX_DEFAULT="{grubcmdl}"')
-    if grubdtb:
-        grubconf = grubconf.replace('# GRUB_DTB="path_to_dtb_file"', f'GRUB_DTB="{grubdtb}"')
-    grubfile = open(mnt_dir + "/etc/default/grub", "w")
-    grubfile.write(grubconf)
-    grubfile.close()
-    run_chroot_cmd(mnt_dir, ["grub-install", f"--target={arch}", "--efi-directory=/boot/efi", "--removable", "--bootloader-id=BredOS"])
-    if not os.path.exists(mnt_dir + "/boot/grub"):
-        os.mkdir(mnt_dir + "/boot/grub")
-    run_chroot_cmd(mnt_dir, ["grub-mkconfig", "-o", "/boot/grub/grub.cfg"])
 
+def snapshot_ro(src: str, dst: str) -> None:
+    if os.path.exists(dst):
+        subprocess.run(["btrfs", "subvolume", "delete", dst], check=True)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    subprocess.run(["btrfs", "subvolume", "snapshot", "-r", src, dst], check=True)
 
-def cleanup(work_dir: str) -> None:
-    logging.info("Cleaning up")
-    subprocess.run(["rm", "-rf", work_dir])
 
+def snapshot_created(path: str) -> str:
+    # Root inode times come from the source, btrfs keeps the creation time
+    show = subprocess.run(
+        ["btrfs", "subvolume", "show", path], stdout=subprocess.PIPE, text=True
+    )
+    for line in show.stdout.splitlines():
+        if line.strip().startswith("Creation time:"):
+            return line.split(":", 1)[1].strip()
+    return ""
 
-def unmount(img_backend: str, mnt_dir: str, ldev: str, ldev_alt: str = None) -> None:
-    logging.info("Unmounting!")
-    subprocess.run(["umount", "-R", mnt_dir])
-    if img_backend == "loop" and not args.ci:
-        subprocess.run(["losetup", "-d", ldev])
-        if ldev_alt is not None:
-            subprocess.run(["losetup", "-d", ldev_alt])
-    elif img_backend == "loop" and args.ci:
-        subprocess.run(["kpartx", "-d", ldev])
-        subprocess.run(["losetup", "-d", ldev])
-        if ldev_alt is not None:
-            subprocess.run(["kpartx", "-d", ldev_alt])
-            subprocess.run(["losetup", "-d", ldev_alt])
-        subprocess.run(["unlink", ldev])
 
+def evict_snapshots(prefix: str, keep: list) -> None:
+    # Only the newest --btrfs-keep snapshots starting with prefix stay
+    snapshots = work_dir + "snapshots/"
+    names = [i for i in os.listdir(snapshots) if i.startswith(prefix)]
+    names.sort(key=lambda i: snapshot_created(snapshots + i), reverse=True)
+    for name in names[max(args.btrfs_keep, 1) :]:
+        if snapshots + name in keep:
+            continue
+        logging.info("Deleting old snapshot " + snapshots + name)
+        subprocess.run(["btrfs", "subvolume", "delete", snapshots + name])
 
-def compressimage(img_name: str) -> None:
-    logging.info("Compressing " + img_name + ".img")
+
+def subvolume_cache_path(key) -> str:
+    # Snapshots have to stay on the filesystem of the work dir
+    return work_dir + "snapshots/rootfs-" + key[:16]
+
+
+def restore_subvolume(key, install_dir) -> bool:
+    snapshot = subvolume_cache_path(key)
+    if not os.path.isdir(snapshot) or os.listdir(install_dir):
+        return False
+    logging.info("Rootfs cache hit, snapshotting " + snapshot)
+    os.rmdir(install_dir)
     subprocess.run(
-        [
-            "xz",
-            "-k",
-            "-5" if not args.fast_forward else "-1",
-            "-T0",
-            "--verbose",
-            "-f",
-            "-M",
-            "65%",
-            work_dir + "/" + img_name + ".img",
-        ]
+        ["btrfs", "subvolume", "snapshot", snapshot, install_dir], check=True
     )
-    # Move the image to the correct output directory
-    subprocess.run(
-        [
-            "mv",
-            work_dir + "/" + img_name + ".img.xz",
-            out_dir + "/" + img_name + ".img.xz",
-        ]
+    return True
+
+
+def send_cmd(snapshot: str, parent: str = None) -> list:
+    cmd = ["btrfs", "send"]
+    if parent is not None:
+        cmd += ["-p", parent]
+    # Protocol 2 sends zstd extents without decompressing and recompressing
+    usage = subprocess.run(
+        ["btrfs", "send", "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
     )
-    subprocess.run(["chmod", "-R", "777", out_dir])
-    logging.info("Compressed " + img_name + ".img")
+    if b"--compressed-data" in usage.stdout:
+        cmd += ["--compressed-data"]
+    return cmd + [snapshot]
 
 
-def copyimage(img_name: str) -> None:
-    logging.info("Copying " + img_name + ".img")
-    # Move the image to the correct output directory
+def send_rootfs(install_dir: str, mnt_dir: str) -> None:
+    # The rootfs goes in as one send stream and becomes @
+    name = cfg["img_name"] + "-" + cfg["img_version"]
+    snapshot = work_dir + "snapshots/" + name
+    snapshot_ro(install_dir, snapshot)
+    keep = [snapshot]
+    if args.btrfs_parent:
+        parent = args.btrfs_parent
+        if "/" not in parent:
+            parent = work_dir + "snapshots/" + parent
+        keep.append(abspath(parent))
+        delta = out_dir + cfg["img_name"] + ".btrfs-delta"
+        logging.info("Writing the changes since " + parent + " to " + delta)
+        cmd = send_cmd(snapshot, parent)[:-1] + ["-f", delta, snapshot]
+        if subprocess.run(cmd).returncode:
+            logging.warning("Could not write " + delta)
+    # Earlier releases of this image, the parent of the delta stays
+    evict_snapshots(cfg["img_name"] + "-", keep)
+    dev = cfg["root_part"]
+    mounts = mounts_under(mnt_dir)
+    subprocess.run(["umount", "-R", mnt_dir], check=True)
+    top = work_dir + "btrfs-top/"
+    os.makedirs(top, exist_ok=True)
     subprocess.run(
-        ["cp", work_dir + "/" + img_name + ".img", out_dir + "/" + img_name + ".img"]
+        ["mount", "-t", "btrfs", "-o", "subvolid=5,compress=zstd", dev, top], check=True
     )
-    subprocess.run(["chmod", "-R", "777", out_dir])
-    logging.info("Copied " + img_name + ".img")
+    try:
+        logging.info("Sending " + snapshot + " into " + dev)
+        send = subprocess.Popen(send_cmd(snapshot), stdout=subprocess.PIPE)
+        subprocess.run(["btrfs", "receive", top], stdin=send.stdout, check=True)
+        send.stdout.close()
+        if send.wait():
+            raise subprocess.CalledProcessError(send.returncode, send.args)
+        # The received snapshot stays read-only as the parent for updates
+        subprocess.run(["btrfs", "subvolume", "delete", top + "@"], check=True)
+        subprocess.run(
+            ["btrfs", "subvolume", "snapshot", top + name, top + "@"], check=True
+        )
+        # /home is its own subvolume, like with the file copy
+        os.makedirs(top + "@/home", exist_ok=True)
+        copy_tree(top + "@/home", top + "@home", manifest=False)
+        for i in os.listdir(top + "@/home"):
+            subprocess.run(["rm", "-rf", top + "@/home/" + i], check=True)
+    finally:
+        subprocess.run(["umount", top])
+    # @ is new, the old subvolid in the mount options would point nowhere
+    for source, target, fstype, options in mounts:
+        options = ",".join(i for i in options.split(",") if "subvolid=" not in i)
+        os.makedirs(target, exist_ok=True)
+        subprocess.run(
+            ["mount", "-t", fstype, "-o", options, source, target], check=True
+        )
+    logging.info("Rootfs received as @ on " + dev)
 
 
+@stage
 def copyfiles(ot: str, to: str, retainperms=False) -> None:
+    if cfg.get("btrfs_send") and abspath(ot) == abspath(cfg["install_dir"]):
+        if abspath(to) == abspath(mnt_dir):
+            send_rootfs(ot, to)
+            return
     logging.info("Copying files to " + to)
-    if retainperms:
-        subprocess.run("cp -apr " + ot + "/* " + to, shell=True)
-    else:
-        subprocess.run("cp -ar " + ot + "/* " + to, shell=True)
+    copy_tree(ot, to)
 
 
 def machine_id():
@@ -632,6 +3967,367 @@ def machine_id():
     )
 
 
+# Built-in step graph: what each builder function reads and writes.
+# "rootfs" is install_dir, "root" the tree under mnt_dir, "image" the image
+# file and its partitions. "*" orders a step against every other step.
+STEP_RESOURCES = {
+    "pacstrap_packages": (["config"], ["rootfs"]),
+    "makeimg": ([], ["image"]),
+    "partition": (["image"], ["image", "root"]),
+    "copy_skel_to_users": (["rootfs"], ["rootfs"]),
+    "create_fstab": (["image"], ["root/etc/fstab"]),
+    "create_extlinux_conf": (["image"], ["root/boot/extlinux"]),
+    "u_boot_update": (["image"], ["root"]),
+    "grub_install": (["image"], ["root"]),
+    "unmount": (["image", "root"], ["image", "root"]),
+    "compressimage": (["image"], ["output/compressed"]),
+    "copyimage": (["image"], ["output/raw"]),
+    "chunkimage": (["image"], ["output/chunks"]),
+    "get_fsline": (["image"], []),
+    "get_parttype": (["image"], []),
+}
+STEP_PURE = [
+    "abspath",
+    "int",
+    "len",
+    "logging.error",
+    "logging.info",
+    "logging.warning",
+    "os.path.exists",
+    "os.path.isdir",
+    "os.path.isfile",
+    "os.path.join",
+    "print",
+    "range",
+    "runonce",
+    "str",
+]
+STEP_COMMANDS = {
+    "dd": (["image"], ["image"]),
+    "mkfs": (["image"], ["image"]),
+    "mount": (["image"], ["root"]),
+    "umount": (["root"], ["root"]),
+}
+
+
+def tree_of(node) -> str:  # type: ignore
+    # Which tree a path expression points into, by the variables it uses
+    text = ast.unparse(node)
+    if "mnt_dir" in text:
+        return "root"
+    if "install_dir" in text:
+        return "rootfs"
+
+
+def sized_early() -> bool:
+    return args.overlap and bool(cfg.get("rootfs_estimate"))
+
+
+def call_resources(call) -> tuple:
+    name = ast.unparse(call.func)
+    if name in STEP_PURE:
+        return [], []
+    if name in STEP_RESOURCES:
+        inputs, outputs = STEP_RESOURCES[name]
+        if name == "makeimg" and args.auto_size and not sized_early():
+            inputs = inputs + ["rootfs"]
+        return inputs, outputs
+    first = call.args[0] if call.args else None
+    if name in ["copyfiles", "fixperms", "run_chroot_cmd", "os.mkdir", "os.makedirs"]:
+        target = call.args[1] if name == "copyfiles" else first
+        inputs = [tree_of(first) or "config"] if name == "copyfiles" else []
+        if target is not None and tree_of(target):
+            return inputs, [tree_of(target)]
+    if name.startswith("subprocess.") and isinstance(first, (ast.List, ast.Constant)):
+        cmd = first.elts[0] if isinstance(first, ast.List) else first
+        if isinstance(cmd, ast.Constant) and isinstance(cmd.value, str):
+            tool = cmd.value.split(" ")[0].split(".")[0]
+            if tool in STEP_COMMANDS:
+                return STEP_COMMANDS[tool]
+    return ["*"], ["*"]
+
+
+def code_resources(tree, calls=True) -> tuple:
+    # Variables are resources too, so values flow between steps in order
+    inputs, outputs = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            store = isinstance(node.ctx, ast.Store)
+            (outputs if store else inputs).add("var/" + node.id)
+        elif isinstance(node, (ast.Subscript, ast.Attribute)):
+            if isinstance(node.ctx, ast.Store):
+                outputs.add("var/" + ast.unparse(node).split("[")[0].split(".")[0])
+        elif isinstance(node, ast.Call) and calls:
+            i, o = call_resources(node)
+            inputs.update(i)
+            outputs.update(o)
+    return inputs, outputs
+
+
+def mkcmds_steps(mkcmds: str) -> list:
+    # Every top level statement of mkcmds becomes a step
+    steps = []
+    for node in ast.parse(mkcmds, "<mkcmds>").body:
+        inputs, outputs = code_resources(node)
+        calls = [ast.unparse(i.func) for i in ast.walk(node) if isinstance(i, ast.Call)]
+        name = next((i for i in calls if i not in STEP_PURE), "step")
+        steps.append(
+            {
+                "name": name + ":" + str(node.lineno),
+                "code": compile(ast.Module([node], []), "<mkcmds>", "exec"),
+                "inputs": inputs,
+                "outputs": outputs,
+            }
+        )
+    return steps
+
+
+def profile_steps(steps: list) -> list:
+    # profiledef steps: {"name", "run", "inputs", "outputs"}, where run is
+    # code like mkcmds or a function, undeclared resources come from the code
+    result = []
+    for i in steps:
+        step = {"name": i["name"], "inputs": set(), "outputs": set()}
+        declared = "inputs" in i or "outputs" in i
+        if callable(i["run"]):
+            step["code"] = i["run"]
+        else:
+            tree = ast.parse(i["run"], "<" + i["name"] + ">")
+            step["code"] = compile(tree, "<" + i["name"] + ">", "exec")
+            step["inputs"], step["outputs"] = code_resources(tree, not declared)
+        if declared:
+            step["inputs"].update(i.get("inputs", []))
+            step["outputs"].update(i.get("outputs", []))
+        else:
+            step["inputs"].add("*")
+            step["outputs"].add("*")
+        result.append(step)
+    return result
+
+
+def resources_conflict(a: set, b: set) -> bool:
+    for i in a:
+        for j in b:
+            if "*" in [i, j] or i == j:
+                return True
+            if i.startswith(j + "/") or j.startswith(i + "/"):
+                return True
+    return False
+
+
+def step_deps(steps: list) -> list:
+    # A step waits for the earlier steps whose writes it touches or that
+    # read what it writes, so the result matches running them in order
+    deps = []
+    for n, step in enumerate(steps):
+        touched = step["inputs"] | step["outputs"]
+        deps.append(
+            set(
+                i
+                for i in range(n)
+                if resources_conflict(steps[i]["outputs"], touched)
+                or resources_conflict(steps[i]["inputs"], step["outputs"])
+            )
+        )
+    return deps
+
+
+def run_step(step: dict, namespace: dict) -> None:
+    logging.info("Step " + step["name"] + " started")
+    if callable(step["code"]):
+        step["code"]()
+    else:
+        exec(step["code"], namespace)
+    logging.info("Step " + step["name"] + " finished")
+
+
+def run_steps(steps: list, namespace: dict) -> None:
+    deps = step_deps(steps)
+    for step, need in zip(steps, deps):
+        after = ", ".join(steps[i]["name"] for i in sorted(need))
+        logging.info("Step " + step["name"] + (" after " + after if after else ""))
+    jobs = 1 if args.resume else max(1, args.step_jobs)
+    if jobs > 1:
+        # The checkpoint chain needs the stages in a fixed order
+        logging.info("Running steps in parallel, checkpoints need --resume")
+        checkpoints["enabled"] = False
+    done, running, failed = set(), dict(), None
+    try:
+        with ThreadPoolExecutor(jobs) as pool:
+            while failed is None and len(done) < len(steps):
+                ready = [
+                    n
+                    for n in range(len(steps))
+                    if n not in done and n not in running.values() and deps[n] <= done
+                ]
+                for n in ready[: jobs - len(running)]:
+                    running[pool.submit(run_step, steps[n], namespace)] = n
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    n = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(n)
+                    except BaseException as e:
+                        logging.error("Step " + steps[n]["name"] + " failed")
+                        failed = failed or e
+            # Let the steps already running finish before rolling back
+            wait(running)
+    except BaseException as e:
+        failed = failed or e
+    if failed is not None:
+        teardown()
+        raise failed
+
+
+# What a variant runs again on the clone of the base image, the rootfs and
+# the filesystems come from the base. mount and mkdir commands are kept too.
+VARIANT_CALLS = [
+    "copyfiles",
+    "fixperms",
+    "create_extlinux_conf",
+    "u_boot_update",
+    "grub_install",
+    "run_chroot_cmd",
+    "unmount",
+    "compressimage",
+    "copyimage",
+    "chunkimage",
+    "makeimg",
+    "partition",
+    "create_fstab",
+]
+
+
+def variant_statement(node) -> bool:
+    for call in [i for i in ast.walk(node) if isinstance(i, ast.Call)]:
+        name = ast.unparse(call.func)
+        if name == "copyfiles" and tree_of(call.args[0]) == "rootfs":
+            return False
+        if name in STEP_PURE or name in VARIANT_CALLS:
+            continue
+        if name.startswith("subprocess.") and command_name(call) in ["mount", "mkdir"]:
+            continue
+        return False
+    return True
+
+
+def command_name(call) -> str:
+    # First word of a command, also of "mount " + ldev + "p1 " + ... strings
+    first = call.args[0] if call.args else None
+    while isinstance(first, ast.BinOp):
+        first = first.left
+    if isinstance(first, ast.List) and first.elts:
+        first = first.elts[0]
+    if isinstance(first, ast.Constant) and isinstance(first.value, str):
+        return first.value.split(" ")[0]
+    return ""
+
+
+def variant_body(body: list) -> list:
+    kept = []
+    for node in body:
+        if isinstance(node, (ast.If, ast.For, ast.While, ast.With, ast.Try)):
+            node.body = variant_body(node.body) or [ast.Pass()]
+            if getattr(node, "orelse", None):
+                node.orelse = variant_body(node.orelse)
+            kept.append(node)
+        elif variant_statement(node):
+            kept.append(node)
+        else:
+            logging.info("Variant: skipping " + ast.unparse(node).split("\n")[0])
+    return kept
+
+
+@stage
+def clone_image(base_img: str, img_name: str) -> tuple:
+    img = cfg["img_dir"] + img_name + ".img"
+    how = clone_file(base_img, img)
+    logging.info("Cloned " + base_img + " to " + img + " (" + how + ")")
+    img_size = os.path.getsize(img) // 1024
+    return img_size, attach_image(img)
+
+
+def layout_record(partition_table: dict, has_uefi: bool) -> dict:
+    # What the partitioning of an image was made from, in JSON types
+    record = {
+        "partition_table": list(partition_table.items()),
+        "part_type": cfg["part_type"],
+        "uboot_parts": cfg["uboot_parts"],
+        "has_uefi": has_uefi,
+    }
+    return json.loads(json.dumps(record))
+
+
+@stage
+def variant_partition(disk, fs, img_size, partition_table, split=False, has_uefi=False):
+    # The base partitioned the same way, only the raw writes differ
+    base = cfg["variant_of"]
+    try:
+        with open(base + ".layout.json") as f:
+            record = json.load(f)
+    except OSError:
+        logging.error(base + " has no partitioning record, build it in full")
+        exit(1)
+    if record != layout_record(partition_table, has_uefi):
+        logging.error("The base image is partitioned differently, build it in full")
+        exit(1)
+    for hook in [] if split else ["partition_prefix", "partition_suffix"]:
+        for i in cfg[hook](config_dir, disk):
+            blob = blob_write(i, disk)
+            if blob is None:
+                subprocess.run(i)
+            else:
+                write_blob(disk, blob)
+    idf = root_idf(split, has_uefi)
+    cfg["root_part"] = disk + idf
+    if fs == "btrfs":
+        # A clone has the fsid of its base, kernels without temp-fsid
+        # support refuse to mount both, so give it its own
+        subprocess.run(
+            ["btrfstune", "-f", "-M", fs_uuid(disk, idf), cfg["root_part"]],
+            input=b"y\n",
+            check=True,
+        )
+        fs_table.pop(cfg["root_part"], None)
+    mount_root(cfg["root_part"], fs)
+    logging.info("Wrote the bootloader of " + cfg["edition"] + " to " + disk)
+
+
+@stage
+def variant_fstab(fs, ldev, ldev_alt=None, simple_vfat=False) -> None:
+    # The cloned fstab mounts the base's filesystems by UUID, a btrfs clone
+    # has a new one, so the generated entries are written again from blkid
+    with open(mnt_dir + "/etc/fstab") as f:
+        lines = [i for i in f if not i.startswith("UUID=")]
+    with open(mnt_dir + "/etc/fstab", "w") as f:
+        f.writelines(lines)
+    create_fstab(fs, ldev, ldev_alt, simple_vfat)
+
+
+def variant_code(mkcmds: str):
+    tree = ast.parse(mkcmds, "<mkcmds>")
+    tree.body = variant_body(tree.body)
+    return compile(ast.fix_missing_locations(tree), "<mkcmds>", "exec")
+
+
+def run_variant(base_img: str, namespace: dict) -> None:
+    if cfg["mkcmds"] is None or cfg["img_backend"] != "loop":
+        logging.error("--variant-of needs mkcmds and the loop backend")
+        exit(1)
+    if "partition_table" not in cfg:
+        logging.error("--variant-of does not support split boot and root images")
+        exit(1)
+    logging.info("Building a variant of " + base_img)
+    cfg["variant_of"] = base_img
+    namespace["makeimg"] = lambda size, fs, img_name, backend: clone_image(
+        base_img, img_name
+    )
+    namespace["partition"] = variant_partition
+    namespace["create_fstab"] = variant_fstab
+    exec(variant_code(cfg["mkcmds"]), namespace)
+
+
 def main():
     logging.basicConfig(
         format="%(asctime)s %(levelname)s: %(message)s",
@@ -660,12 +4356,27 @@ def main():
     logging.info("               Image type:   " + cfg["img_type"])
     logging.info("          Image file name:   " + cfg["img_name"])
     logging.info("            Packages File:   " + cfg["packages_file"])
-    exec(cfg["mkcmds"])
+    plan_placement(pacman_conf)
+    try:
+        if args.variant_of:
+            namespace = dict(globals(), pacman_conf=pacman_conf, build_date=build_date)
+            run_variant(os.path.abspath(args.variant_of), namespace)
+        elif cfg["steps"] is not None or args.step_graph or args.overlap:
+            namespace = dict(globals(), pacman_conf=pacman_conf, build_date=build_date)
+            if cfg["steps"] is not None:
+                run_steps(profile_steps(cfg["steps"]), namespace)
+            else:
+                run_steps(mkcmds_steps(cfg["mkcmds"]), namespace)
+        else:
+            exec(cfg["mkcmds"])
+        release_reattached()
+    finally:
+        # A failed build must not leave its tmpfs holding the host's RAM,
+        # --resume puts the rootfs on disk and pacstraps it again anyway
+        release_placement()
 
 
-def handler(signal_received, frame):
-    # Handle any cleanup here
-    logging.error("SIGINT or CTRL-C detected. Exiting gracefully")
+def teardown() -> None:
     try:
         subprocess.run(["umount", "-R", mnt_dir])
     except:
@@ -674,11 +4385,21 @@ def handler(signal_received, frame):
         subprocess.run("umount -R " + cfg["install_dir"] + "/*", shell=True)
     except:
         pass
-    try:
-        if cfg["img_backend"] == "loop":
-            subprocess.run(["losetup", "-d", ldev])
-    except:
-        pass
+    # Only release the loop devices this build attached
+    devs = cfg.get("images", dict())
+    for dev in sorted(devs, key=lambda i: not i.startswith("/dev/mapper/")):
+        if dev.startswith("/dev/mapper/"):
+            subprocess.run(["kpartx", "-d", dev])
+            subprocess.run(["unlink", dev])
+        elif dev.startswith("/dev/"):
+            subprocess.run(["losetup", "-d", dev])
+    release_placement()
+
+
+def handler(signal_received, frame):
+    # Handle any cleanup here
+    logging.error("SIGINT or CTRL-C detected. Exiting gracefully")
+    teardown()
     exit(0)
 
 
@@ -686,17 +4407,532 @@ def next_loop() -> str:
     return subprocess.check_output(["losetup", "-f"]).decode("utf-8").strip("\n")
 
 
+def load_profiledef(config_dir):
+    loader = importlib.machinery.SourceFileLoader(
+        "profiledef", config_dir + "profiledef"
+    )
+    spec = importlib.util.spec_from_loader("profiledef", loader)
+    profiledef = importlib.util.module_from_spec(spec)
+    loader.exec_module(profiledef)
+    return profiledef
+
+
+def rootfs_group(config_dir) -> tuple:
+    # Configs with the same key pacstrap to the same rootfs
+    arch = load_profiledef(config_dir).arch
+    packages = read_packages(config_dir + "packages." + arch)
+    with open(config_dir + "pacman.conf." + arch, "rb") as f:
+        conf_hash = hashlib.sha256(f.read()).hexdigest()
+    return (arch, "\n".join(sorted(packages)), conf_hash)
+
+
+def board_argv(board_config_dir, board_work_dir) -> list:
+    # Our own command line with the config and work dirs swapped out, the
+    # status file and database age are set per board by matrix_build
+    argv = [sys.executable, os.path.abspath(sys.argv[0])]
+    options = ["--config_dir", "--work_dir", "--status-file", "--db-max-age"]
+    options += ["--rootfs-from"]
+    skip = False
+    for i in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif i in ["-c", "-w"] + options:
+            skip = True
+        elif not i.startswith(("-c", "-w") + tuple(j + "=" for j in options)):
+            argv.append(i)
+    return argv + ["-c", board_config_dir, "-w", board_work_dir]
+
+
+def check_layout(size: str) -> int:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt=LOGGING_DATE_FORMAT,
+        encoding="utf-8",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    profiledef = load_profiledef(config_dir)
+    cfg.update(layout_config(profiledef))
+    for i in ["edition", "arch", "img_version"]:
+        cfg[i] = getattr(profiledef, i)
+    if "partition_table" in cfg:
+        tables = [("image", cfg["partition_table"], False)]
+    else:
+        tables = [
+            ("boot", cfg["partition_table_boot"], False),
+            ("root", cfg["partition_table_root"], True),
+        ]
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, table, split in tables:
+            # A sparse file stands in for the image, nothing needs root
+            disk = tmp + "/" + name + ".img"
+            with open(disk, "wb") as f:
+                f.truncate(parse_size(size))
+            errors = []
+            blobs = [[], []]
+            for n, hook in enumerate(["partition_prefix", "partition_suffix"]):
+                for i in [] if split else cfg[hook](config_dir, disk):
+                    try:
+                        blob = blob_write(i, disk)
+                    except OSError as e:
+                        errors.append(str(e))
+                        continue
+                    if blob is None:
+                        logging.warning("Not checked, runs as a command: " + str(i))
+                    else:
+                        blobs[n].append(blob)
+            for blob in blobs[0]:
+                if blob["offset"] + blob["length"] <= parse_size(size):
+                    write_blob(disk, blob)
+            layout = plan_partitions(disk, table, cfg["has_uefi"])
+            errors += layout_errors(layout, blobs[0], blobs[1])
+            logging.info(name + " layout\n" + layout_table(layout))
+            for i in errors:
+                logging.error(name + ": " + i)
+            failed = failed or bool(errors)
+    if not failed:
+        logging.info("Layout is valid")
+    return 1 if failed else 0
+
+
+def matrix_build() -> int:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt=LOGGING_DATE_FORMAT,
+        encoding="utf-8",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    groups = dict()
+    for i in config_dirs:
+        if not os.path.isfile(i + "profiledef"):
+            logging.error("Config directory " + i + " has no profiledef")
+            return 1
+        groups.setdefault(rootfs_group(i), []).append(i)
+    if not os.path.exists(work_dir):
+        os.mkdir(work_dir)
+    # Databases synced from here on are the ones the group pacstraps used
+    started = time.time()
+    # Rootfs group of every board that shares its pacstrap, None if it failed
+    shared = dict()
+
+    for n, (key, boards) in enumerate(groups.items()):
+        logging.info(
+            "Rootfs group "
+            + key[0]
+            + ": "
+            + ", ".join(os.path.basename(i.rstrip("/")) for i in boards)
+        )
+        if len(boards) < 2:
+            continue
+        # Pacstrap once, the boards copy it or clone the first one's image.
+        # Not as a stage, the matrix has no checkpoints of its own
+        install_dir = work_dir + "matrix-" + key[0] + "-" + str(n)
+        subprocess.run(["rm", "-rf", install_dir])
+        os.makedirs(install_dir)
+        try:
+            pacstrap_packages.__wrapped__(
+                boards[0] + "pacman.conf." + key[0],
+                boards[0] + "packages." + key[0],
+                install_dir,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error("Pacstrap of rootfs group " + key[0] + " failed: " + repr(e))
+            subprocess.run(["rm", "-rf", install_dir])
+            install_dir = None
+        shared.update((i, install_dir) for i in boards)
+
+    def board_work_dir(board) -> str:
+        return work_dir + os.path.basename(board.rstrip("/")) + "/"
+
+    def build_board(board, base=None) -> int:
+        if board in shared and shared[board] is None:
+            return "without rootfs"
+        argv = board_argv(board, board_work_dir(board))
+        # A board syncing newer databases would miss the group's rootfs key
+        db_max_age = int(time.time() - started) + 1
+        argv += ["--db-max-age", str(max(args.db_max_age, db_max_age))]
+        if args.status_file:
+            root, ext = os.path.splitext(args.status_file)
+            name = os.path.basename(board.rstrip("/"))
+            argv += ["--status-file", root + "." + name + (ext or ".json")]
+        if base is not None:
+            # The base finished, its raw image is still in its work dir
+            img = image_dir(board_work_dir(base)) + load_profiledef(base).img_name
+            argv += ["--variant-of", img + ".img"]
+        elif board in shared:
+            argv += ["--rootfs-from", shared[board]]
+        logging.info("Building " + board + " in " + board_work_dir(board))
+        return subprocess.run(argv).returncode
+
+    with contextlib.ExitStack() as stack, ThreadPoolExecutor(
+        max_workers=max(args.jobs, 1)
+    ) as pool:
+        for i in set(shared.values()) - {None}:
+            stack.callback(subprocess.run, ["rm", "-rf", i])
+        if not args.variants:
+            results = list(pool.map(build_board, config_dirs))
+        else:
+            # One full build per rootfs group, then the others as its clones
+            bases = [boards[0] for boards in groups.values()]
+            done = dict(zip(bases, pool.map(build_board, bases)))
+            variants = [
+                (i, boards[0])
+                for boards in groups.values()
+                for i in boards[1:]
+                if not done[boards[0]]
+            ]
+            jobs = [pool.submit(build_board, *i) for i in variants]
+            done.update((i[0], job.result()) for i, job in zip(variants, jobs))
+            results = [done.get(i, "without base") for i in config_dirs]
+
+    table_pretty = prettytable.PrettyTable(["Config", "Result"])
+    for board, result in zip(config_dirs, results):
+        table_pretty.add_row([board, "OK" if not result else "FAILED " + str(result)])
+    logging.info("\n" + table_pretty.get_string(title="Matrix build"))
+    return 1 if any(results) else 0
+
+
+# ioctl of /dev/loop-control that creates /dev/loopN
+LOOP_CTL_ADD = 0x4C80
+SPOOL_DIRS = ["new", "queue", "running", "done", "failed", "logs", "status"]
+
+
+def warm_loop_devices(count: int) -> None:
+    # Create the device nodes once, jobs then only have to attach
+    subprocess.run(["modprobe", "loop"])
+    try:
+        fd = os.open("/dev/loop-control", os.O_RDWR)
+    except OSError as e:
+        logging.warning("Cannot open /dev/loop-control: " + str(e))
+        return
+    try:
+        for i in range(count):
+            if os.path.exists("/dev/loop" + str(i)):
+                continue
+            try:
+                fcntl.ioctl(fd, LOOP_CTL_ADD, i)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    logging.warning("Cannot create /dev/loop" + str(i) + ": " + str(e))
+                    break
+    finally:
+        os.close(fd)
+
+
+def submit_job(spool: str) -> int:
+    # Everything but --submit is the command line of the job
+    argv = []
+    skip = False
+    for i in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif i == "--submit":
+            skip = True
+        elif not i.startswith("--submit="):
+            argv.append(i)
+    job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+    job = {"id": job_id, "argv": argv, "cwd": os.getcwd(), "submitted": time.time()}
+    spool = abspath(spool) + "/"
+    os.makedirs(spool + "new", exist_ok=True)
+    # The service only picks up complete files
+    with open(spool + "new/." + job_id + ".json", "w") as f:
+        json.dump(job, f)
+    os.rename(spool + "new/." + job_id + ".json", spool + "new/" + job_id + ".json")
+    print(job_id)
+    return 0
+
+
+def check_job(job) -> str:
+    # Turn broken jobs away when they are queued, not when their turn comes
+    try:
+        job_args = parser.parse_args(job["argv"])
+    except SystemExit:
+        return "Invalid arguments"
+    if job_args.serve or job_args.submit:
+        return "Jobs cannot use --serve or --submit"
+    if job_args.config_dir is None or None in [job_args.work_dir, job_args.out_dir]:
+        return "Jobs need -c, -w and -o"
+    for i in job_args.config_dir:
+        errors = Builder(os.path.join(job["cwd"], i), "/", "/").check()
+        if errors:
+            return "; ".join(errors)
+    return ""
+
+
+def move_job(spool: str, job, state: str) -> None:
+    # The directory a job file is in is its state
+    old = spool + job["state"] + "/" + job["id"] + ".json"
+    job["state"] = state
+    new = spool + state + "/" + job["id"] + ".json"
+    with open(spool + state + "/." + job["id"] + ".json", "w") as f:
+        json.dump(job, f)
+    os.rename(spool + state + "/." + job["id"] + ".json", new)
+    if old != new and os.path.exists(old):
+        os.remove(old)
+
+
+def start_job(spool: str, job) -> subprocess.Popen:
+    argv = [sys.executable, os.path.abspath(sys.argv[0])] + job["argv"]
+    argv += ["--status-file", spool + "status/" + job["id"] + ".json"]
+    # Caches and host limits of the service, unless the job sets its own
+    for opt, value in [
+        ("--cache_dir", cache_dir),
+        ("--max-pacstrap", args.max_pacstrap),
+        ("--max-compress", args.max_compress),
+        ("--db-max-age", args.db_max_age or 3600),
+    ]:
+        if not any(i == opt or i.startswith(opt + "=") for i in job["argv"]):
+            argv += [opt, str(value)]
+    job.pop("position", None)
+    job["started"] = time.time()
+    job["log"] = spool + "logs/" + job["id"] + ".log"
+    move_job(spool, job, "running")
+    logging.info("Starting job " + job["id"] + ": " + " ".join(job["argv"]))
+    with open(job["log"], "w") as log:
+        return subprocess.Popen(
+            argv, cwd=job["cwd"], stdout=log, stderr=subprocess.STDOUT
+        )
+
+
+def job_stage(spool: str, job_id: str) -> dict:
+    try:
+        with open(spool + "status/" + job_id + ".json") as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    return {
+        "stage": status["stage"],
+        "stages_done": status["done"],
+        "stages_failed": status["failed"],
+    }
+
+
+def write_service_status(spool: str, jobs, running) -> None:
+    queued = sorted(i for i in jobs if jobs[i]["state"] == "queue")
+    for n, job_id in enumerate(queued):
+        jobs[job_id]["position"] = n + 1
+    for job_id in running:
+        jobs[job_id].update(job_stage(spool, job_id))
+    status = {
+        "pid": os.getpid(),
+        "updated": time.time(),
+        "running": len(running),
+        "queued": len(queued),
+        "jobs": [jobs[i] for i in sorted(jobs)],
+    }
+    with open(spool + ".status.json", "w") as f:
+        json.dump(status, f, indent=1)
+    os.replace(spool + ".status.json", spool + "status.json")
+
+
+def stop_serving(signal_received, frame):
+    raise KeyboardInterrupt
+
+
+def serve(spool: str) -> int:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt=LOGGING_DATE_FORMAT,
+        encoding="utf-8",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    spool = abspath(spool) + "/"
+    for i in SPOOL_DIRS:
+        os.makedirs(spool + i, exist_ok=True)
+    warm_loop_devices(args.loop_pool)
+    jobs = dict()
+    for state in ["done", "failed", "running", "queue"]:
+        for name in os.listdir(spool + state):
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+            with open(spool + state + "/" + name) as f:
+                job = json.load(f)
+            job["state"] = state
+            jobs[job["id"]] = job
+            if state == "running":
+                # The service stopped while it ran, run it again
+                move_job(spool, job, "queue")
+    running = dict()
+    signal(SIGTERM, stop_serving)
+    logging.info("Serving jobs from " + spool + ", " + str(args.jobs) + " at a time")
+    try:
+        while True:
+            for name in sorted(os.listdir(spool + "new")):
+                if name.startswith(".") or not name.endswith(".json"):
+                    continue
+                try:
+                    with open(spool + "new/" + name) as f:
+                        job = json.load(f)
+                    job["state"] = "new"
+                    error = check_job(job)
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.error("Unreadable job " + name + ": " + repr(e))
+                    os.rename(spool + "new/" + name, spool + "failed/" + name)
+                    continue
+                jobs[job["id"]] = job
+                if error:
+                    logging.error("Rejected job " + job["id"] + ": " + error)
+                    job["error"] = error
+                    move_job(spool, job, "failed")
+                else:
+                    logging.info("Queued job " + job["id"])
+                    move_job(spool, job, "queue")
+            for job_id, proc in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                del running[job_id]
+                job = jobs[job_id]
+                job.update(job_stage(spool, job_id))
+                job["finished"] = time.time()
+                job["returncode"] = proc.returncode
+                logging.info("Job " + job_id + " finished with " + str(proc.returncode))
+                move_job(spool, job, "failed" if proc.returncode else "done")
+            queued = sorted(i for i in jobs if jobs[i]["state"] == "queue")
+            for job_id in queued[: max(args.jobs, 1) - len(running)]:
+                running[job_id] = start_job(spool, jobs[job_id])
+            write_service_status(spool, jobs, running)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("Stopping, running jobs go back to the queue")
+        for proc in running.values():
+            proc.terminate()
+        for job_id, proc in running.items():
+            proc.wait()
+            move_job(spool, jobs[job_id], "queue")
+        write_service_status(spool, jobs, dict())
+    return 0
+
+
+class Builder:
+    # One build of one config dir, what the command line runs. Options are
+    # the argparse names, e.g. Builder(cfg, work, out, codecs="zstd").
+    # Loading and checking the config needs no root. The running build
+    # lives at module level, so run() takes over this process and refuses
+    # to start while another run() is going; start() forks a child for
+    # it, which lets several builds run side by side.
+    def __init__(self, config_dir, work_dir, out_dir, **options):
+        self.args = parser.parse_args([])
+        if isinstance(config_dir, str):
+            config_dir = [config_dir]
+        options.update(config_dir=config_dir, work_dir=work_dir, out_dir=out_dir)
+        for name, value in options.items():
+            if not hasattr(self.args, name):
+                raise TypeError("Unknown mkimage option " + name)
+            setattr(self.args, name, value)
+        if len(self.args.config_dir) != 1:
+            raise ValueError("A Builder takes one config dir, use one per board")
+        self.paths = build_paths(self.args)
+        self.cfg = None
+
+    @classmethod
+    def from_argv(cls, argv: list) -> "Builder":
+        return cls(**vars(parser.parse_args(argv)))
+
+    def load(self) -> dict:
+        # The profiledef settings, read once
+        if self.cfg is None:
+            self.cfg = read_config(self.paths["config_dir"])
+        return self.cfg
+
+    def check(self) -> list:
+        config_dir = self.paths["config_dir"]
+        if not os.path.isfile(config_dir + "profiledef"):
+            return ["Config directory " + config_dir + " has no profiledef"]
+        try:
+            return config_errors(self.load())
+        except Exception as e:
+            return ["Cannot load the profiledef of " + config_dir + ": " + repr(e)]
+
+    def run(self) -> int:
+        # cfg, the paths, args, fs_table, checkpoints and the profile are
+        # module level, a second build in this process would overwrite them
+        if not running_lock.acquire(blocking=False):
+            raise RuntimeError(
+                "Another build is running in this process, use start() to run "
+                + self.paths["config_dir"]
+                + " next to it"
+            )
+        try:
+            return self.run_build()
+        finally:
+            running_lock.release()
+
+    def run_build(self) -> int:
+        # Point the module level state at this build
+        vars(args).update(vars(self.args))
+        globals().update(self.paths)
+        cfg.clear()
+        build_profile.clear()
+        build_profile.update(stages=[], procs=[])
+        synced_dbs.clear()
+        fs_table.clear()
+        popen = subprocess.Popen
+        handlers = None
+        try:
+            cfg.update(verify_config())
+            build_lock = lock_work_dir()
+            load_checkpoints()
+            # Signals can only be caught on the main thread
+            if threading.current_thread() is threading.main_thread():
+                handlers = signal(SIGINT, handler), signal(SIGTERM, handler)
+            # get start time
+            start_time = time.time()
+            subprocess.Popen = TimedPopen
+            if args.sample_interval:
+                sampler = start_sampler()
+            try:
+                main()
+            finally:
+                if args.sample_interval:
+                    sampler[0].set()
+                    sampler[1].join()
+                write_profile(start_time)
+                build_lock.close()
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                logging.error(e.code)
+            return e.code if isinstance(e.code, int) else int(e.code is not None)
+        finally:
+            subprocess.Popen = popen
+            if handlers is not None:
+                signal(SIGINT, handlers[0])
+                signal(SIGTERM, handlers[1])
+        # get end time
+        end_time = time.time()
+        # calculate total time taken convert to human readable format
+        total_time = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
+        logging.info("Total time taken: " + total_time)
+        return 0
+
+    def start(self) -> multiprocessing.Process:
+        # The exit code of the build is the exit code of the child
+        process = multiprocessing.get_context("fork").Process(
+            target=lambda: exit(self.run()), name="mkimage " + self.paths["config_dir"]
+        )
+        process.start()
+        return process
+
+    def build(self) -> int:
+        process = self.start()
+        process.join()
+        return process.exitcode
+
+
 if __name__ == "__main__":
-    cfg = verify_config()
-    if cfg["img_backend"] == "loop":
-        ldev = next_loop()
-    signal(SIGINT, handler)
-    signal(SIGTERM, handler)
-    # get start time
-    start_time = time.time()
-    main()
-    # get end time
-    end_time = time.time()
-    # calculate total time taken convert to human readable format
-    total_time = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
-    logging.info("Total time taken: " + total_time)
+    if args.submit:
+        exit(submit_job(args.submit))
+    if args.serve:
+        exit(serve(args.serve))
+    if args.reassemble:
+        exit(reassemble(args.reassemble))
+    if args.verify:
+        exit(verify(args.verify))
+    if args.check_layout:
+        cfg["images"] = {}
+        exit(check_layout(args.check_layout))
+    if len(config_dirs) > 1:
+        exit(matrix_build())
+    exit(Builder(**vars(args)).run())
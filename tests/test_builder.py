@@ -0,0 +1,91 @@
+# Builds run one after the other in one process must not share state
+
+import json
+import os
+import shutil
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+FIXTURE = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/bench/fixture"
+
+
+def builder(tmp_path, name: str, **options) -> mkimage.Builder:
+    config_dir = str(tmp_path / name)
+    shutil.copytree(FIXTURE, config_dir)
+    return mkimage.Builder(
+        config_dir,
+        str(tmp_path / (name + "-work")),
+        str(tmp_path / (name + "-out")),
+        placement="work",
+        **options
+    )
+
+
+def profile(b: mkimage.Builder) -> dict:
+    with open(b.paths["config_dir"] + "mkimage-profile.json") as f:
+        return json.load(f)
+
+
+def test_check_needs_no_build(tmp_path):
+    b = builder(tmp_path, "check")
+    assert b.check() == []
+    assert not os.path.exists(b.paths["work_dir"])
+    assert mkimage.Builder(str(tmp_path), "w", "o").check() != []
+
+
+def test_sequential_builds_start_clean(tmp_path, monkeypatch):
+    # Only the state around main() matters here, not the stages themselves
+    monkeypatch.setattr(mkimage, "main", lambda: time.sleep(0.5))
+    first = builder(tmp_path, "first", sample_interval=0.1)
+    assert first.run() == 0
+    assert profile(first)["resources"]
+    assert mkimage.cfg["config_dir"] == first.paths["config_dir"]
+
+    second = builder(tmp_path, "second")
+    assert second.run() == 0
+    assert mkimage.cfg["config_dir"] == second.paths["config_dir"]
+    assert mkimage.work_dir == second.paths["work_dir"]
+    assert not mkimage.args.sample_interval
+    for key in ["samples", "resources", "mem_total"]:
+        assert key not in profile(second)
+    assert [i["stage"] for i in profile(second)["stages"]] == ["verify_config"]
+
+
+def test_failed_build_releases_placement(tmp_path, monkeypatch):
+    released = []
+
+    def plan_placement(pacman_conf):
+        # A rootfs tmpfs is up and the first stage of mkcmds fails
+        mkimage.cfg.update(tmpfs=["/tmpfs"], stage_dir=None, steps=None)
+        mkimage.cfg["mkcmds"] = "raise RuntimeError('stage failed')"
+
+    monkeypatch.setattr(mkimage, "plan_placement", plan_placement)
+    monkeypatch.setattr(
+        mkimage, "release_placement", lambda: released.append(mkimage.cfg["tmpfs"])
+    )
+    with pytest.raises(RuntimeError):
+        builder(tmp_path, "failed").run()
+    assert released == [["/tmpfs"]]
+
+
+def test_concurrent_run_is_refused(tmp_path, monkeypatch):
+    # A second run() while one is going would take over its state
+    second = builder(tmp_path, "second")
+    errors = []
+
+    def main():
+        with pytest.raises(RuntimeError):
+            second.run()
+        errors.append(mkimage.cfg["config_dir"])
+
+    monkeypatch.setattr(mkimage, "main", main)
+    first = builder(tmp_path, "first")
+    assert first.run() == 0
+    assert errors == [first.paths["config_dir"]]
+    monkeypatch.setattr(mkimage, "main", lambda: None)
+    assert second.run() == 0
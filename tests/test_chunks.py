@@ -0,0 +1,54 @@
+# Chunking from the output stream against chunking the image file
+
+import functools
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+
+def sparse_image(tmp_path) -> str:
+    img = str(tmp_path / "disk.img")
+    rand = random.Random(0)
+    with open(img, "wb") as f:
+        f.truncate(3 * mkimage.CDC_SEGMENT)
+        # Data across a segment boundary, a hole, then a tail at the end
+        f.seek(mkimage.CDC_SEGMENT - 1024**2)
+        f.write(rand.randbytes(2 * 1024**2 + 12345))
+        f.seek(3 * mkimage.CDC_SEGMENT - 1024**2)
+        f.write(rand.randbytes(1024**2))
+    return img
+
+
+def streamed(img: str, step: int, work) -> list:
+    with ThreadPoolExecutor(2) as pool:
+        feed = mkimage.SegmentFeed(step, pool, 2, work)
+        ranges = mkimage.image_ranges(img)
+        for chunk, hole in mkimage.image_chunks(img, ranges, []):
+            feed.feed(chunk, hole)
+        return feed.close()
+
+
+def test_streamed_index_matches_file(tmp_path):
+    img = sparse_image(tmp_path)
+    store = str(tmp_path / "store")
+    expected = mkimage.chunk_image(img, store)
+    work = functools.partial(mkimage.cut_segment, store=store)
+    segments = streamed(img, mkimage.CDC_SEGMENT, work)
+    chunks = [j for i in segments for j in i[2]]
+    index = mkimage.chunk_index(img, chunks)
+    assert [i[:3] for i in index["chunks"]] == [i[:3] for i in expected["chunks"]]
+
+
+def test_streamed_hashes_match_file(tmp_path):
+    img = sparse_image(tmp_path)
+    segments = streamed(img, mkimage.HASH_CHUNK, mkimage.segment_digest)
+    with open(img, "rb") as f:
+        expected = [
+            (start, end - start, mkimage.hash_chunk(f.fileno(), start, end - start))
+            for start, end in mkimage.data_segments(img, mkimage.HASH_CHUNK)
+        ]
+    assert segments == expected
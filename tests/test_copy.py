@@ -0,0 +1,30 @@
+# copy_tree as the overlay copy of copyfiles uses it
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+
+def test_missing_source_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(mkimage, "work_dir", str(tmp_path) + "/")
+    (tmp_path / "to").mkdir()
+    mkimage.copy_tree(str(tmp_path / "alarmimg"), str(tmp_path / "to"))
+    assert os.listdir(tmp_path / "to") == []
+
+
+def test_same_size_edit_is_copied_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(mkimage, "work_dir", str(tmp_path) + "/")
+    src = tmp_path / "overlay"
+    src.mkdir()
+    (src / "motd").write_text("old")
+    (tmp_path / "to").mkdir()
+    mkimage.copy_tree(str(src), str(tmp_path / "to"))
+    assert (tmp_path / "to" / "motd").read_text() == "old"
+    # Same size and mtime, like a restore that keeps the timestamps
+    st = os.stat(src / "motd")
+    (src / "motd").write_text("new")
+    os.utime(src / "motd", ns=(st.st_atime_ns, st.st_mtime_ns))
+    mkimage.copy_tree(str(src), str(tmp_path / "to"))
+    assert (tmp_path / "to" / "motd").read_text() == "new"
@@ -0,0 +1,15 @@
+# The command line every board of a matrix build runs with
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+
+def test_board_argv_drops_per_board_options(monkeypatch):
+    argv = ["mkimage.py", "-c", "a/", "-c", "b/", "-w", "work/", "--codecs", "zstd"]
+    argv += ["--rootfs-from", "work/matrix-aarch64-0", "--status-file=s.json"]
+    monkeypatch.setattr(mkimage.sys, "argv", argv)
+    board = mkimage.board_argv("b/", "work/b/")
+    assert board[2:] == ["--codecs", "zstd", "-c", "b/", "-w", "work/b/"]
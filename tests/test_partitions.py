@@ -0,0 +1,115 @@
+# The native partitioner against parted --align optimal on an 8 GiB image
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+SIZE = 8 * 1024**3
+LAST = SIZE // 512 - 34
+
+# Boot and root start/end as (start, end) sectors, what parted writes
+CASES = {
+    "MB": (
+        {"boot": ["16MB", "528MB", "", "fat32"], "root": ["528MB", "100%", "", "ext4"]},
+        [(30720, 1031250), (1032192, LAST)],
+    ),
+    "MiB": (
+        {
+            "boot": ["16MiB", "528MiB", "", "fat32"],
+            "root": ["528MiB", "100%", "", "ext4"],
+        },
+        [(32768, 1081343), (1081344, LAST)],
+    ),
+    "%": (
+        {"boot": ["1%", "10%", "", "fat32"], "root": ["10%", "100%", "", "ext4"]},
+        [(167936, 1677721), (1679360, LAST)],
+    ),
+}
+
+
+@pytest.fixture
+def image(tmp_path):
+    mkimage.cfg.clear()
+    mkimage.cfg.update(
+        recreate_part_table=True,
+        part_type="gpt",
+        boot_set_esp=True,
+        images={},
+        edition="test",
+        arch="aarch64",
+        img_version="1",
+    )
+    path = str(tmp_path / "disk.img")
+    with open(path, "wb") as f:
+        f.truncate(SIZE)
+    return path
+
+
+def planned(image: str, table: dict) -> list:
+    layout = mkimage.plan_partitions(image, table, False)
+    return [(p["start"], p["end"]) for p in layout["partitions"]]
+
+
+@pytest.mark.parametrize("unit", CASES)
+def test_plan_matches_parted(image, unit):
+    table, expected = CASES[unit]
+    assert planned(image, table) == expected
+    for start, _ in expected:
+        assert start % mkimage.ALIGN == 0
+
+
+@pytest.mark.skipif(shutil.which("parted") is None, reason="needs parted")
+@pytest.mark.parametrize("unit", CASES)
+def test_plan_against_parted(image, unit):
+    table, _ = CASES[unit]
+    cmd = ["parted", "--script", image, "--align", "optimal", "mklabel", "gpt"]
+    for i in table.values():
+        cmd += ["mkpart", "primary", i[3], i[0], i[1]]
+    subprocess.run(cmd, check=True)
+    layout = mkimage.read_partitions(image)
+    parted = [(p["start"], p["end"]) for p in layout["partitions"]]
+    assert planned(image, table) == parted
+
+
+def test_sector_and_iec_ends_are_exact():
+    # No range to align in, 1MiB-2MiB ends one sector before 2 MiB
+    assert mkimage.parted_position("2048s", 16384) == (2048, 2048, 2048)
+    assert mkimage.parted_position("2MiB", 16384, end=True) == (4095, 4095, 4095)
+    assert mkimage.parted_position("2MB", 16384, end=True) == (3906, 2930, 4882)
+
+
+def test_offline_boot_type():
+    fat = {
+        "boot": ["16MiB", "272MiB", "", "fat32"],
+        "root": ["272MiB", "100%", "", "ext4"],
+    }
+    ext = dict(fat, boot=["16MiB", "272MiB", "", "ext2"])
+    xfs = dict(fat, boot=["16MiB", "272MiB", "", "xfs"])
+    assert mkimage.boot_fs_type(fat) == "fat32"
+    assert mkimage.boot_fs_type(ext) == "ext2"
+    assert mkimage.boot_fs_type({"root": fat["root"]}) is None
+    config = dict(
+        arch="aarch64",
+        img_name="test",
+        edition="test",
+        img_version="1",
+        mkcmds="",
+        steps=None,
+        fs="ext4",
+        packages_file=__file__,
+        img_type="image",
+        img_backend="offline",
+        partitioner="native",
+    )
+    assert mkimage.config_errors(dict(config, partition_table=ext)) == []
+    errors = mkimage.config_errors(dict(config, partition_table=xfs))
+    assert errors == [
+        "The offline backend cannot build a xfs boot partition, "
+        "use fat32, ext2, ext3 or ext4"
+    ]
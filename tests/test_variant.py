@@ -0,0 +1,62 @@
+# A --variant-of clone has to mount the filesystems it actually has
+
+import os
+import re
+import subprocess
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkimage  # noqa: E402
+
+
+def blkid_uuid(path: str) -> str:
+    out = subprocess.check_output(["blkid", "-p", "-o", "value", "-s", "UUID", path])
+    return out.decode("utf-8").strip()
+
+
+def test_variant_fstab_matches_blkid(tmp_path, monkeypatch):
+    # Files named like the partitions of a loop device stand in for the
+    # clone, p2 already has the new UUID btrfstune gives a btrfs root
+    ldev = str(tmp_path / "loop0")
+    for part in ["p1", "p2"]:
+        with open(ldev + part, "wb") as f:
+            f.truncate(8 * 1024**2)
+        subprocess.run(["mkfs.ext4", "-q", "-F", ldev + part], check=True)
+    mnt = tmp_path / "mnt"
+    (mnt / "etc").mkdir(parents=True)
+    base = [str(uuid.uuid4()), str(uuid.uuid4())]
+    (mnt / "etc" / "fstab").write_text(
+        "# Static information about the filesystems.\n"
+        + "UUID="
+        + base[1]
+        + " / btrfs rw,subvol=/@ 0 0\n"
+        + "UUID="
+        + base[1]
+        + " /home btrfs rw,subvol=/@home 0 0\n"
+        + "UUID="
+        + base[0]
+        + " /boot ext4 rw 0 2\n"
+    )
+    monkeypatch.setattr(mkimage, "mnt_dir", str(mnt))
+    monkeypatch.setitem(mkimage.checkpoints, "enabled", False)
+    monkeypatch.setattr(mkimage, "fs_table", {})
+    monkeypatch.setattr(mkimage, "cfg", dict(has_uefi=False, uboot_parts=0))
+
+    mkimage.variant_fstab("btrfs", ldev)
+
+    fstab = (mnt / "etc" / "fstab").read_text()
+    assert fstab.startswith("# Static information")
+    mounts = {m: u for u, m in re.findall(r"^UUID=(\S+)\s+(\S+)", fstab, re.M)}
+    assert {i: mounts[i] for i in ["/", "/home", "/boot"]} == {
+        "/": blkid_uuid(ldev + "p2"),
+        "/home": blkid_uuid(ldev + "p2"),
+        "/boot": blkid_uuid(ldev + "p1"),
+    }
+    assert not set(base) & set(mounts.values())
+
+
+def test_variant_keeps_create_fstab():
+    code = 'partition(ldev, "btrfs", 1, {})\ncreate_fstab(cfg["fs"], ldev)\n'
+    body = mkimage.variant_body(mkimage.ast.parse(code).body)
+    assert "create_fstab" in mkimage.ast.unparse(body)